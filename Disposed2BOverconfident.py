@@ -5,10 +5,34 @@
 
 # %%
 
-from random import choices
+import argparse
+import collections
+import contextlib
+import csv
+import datetime
+import hashlib
+import itertools
 import json
-from json import JSONEncoder
-from copy import copy, deepcopy
+import math
+import multiprocessing
+import os
+import queue
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from array import array
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from copy import deepcopy
+from enum import Enum
+from functools import lru_cache
+from itertools import accumulate
+from multiprocessing import shared_memory
+from random import getrandbits
+import numpy as np
 
 CSV_DELIMITER = ";"
 
@@ -22,35 +46,67 @@ def convertObjectToDict(obj):
     "__class__": obj.__class__.__name__,
     "__module__": obj.__module__
   }
-  #  Populate the dictionary with object properties
-  obj_dict.update(obj.__dict__)
+  #  Populate the dictionary with object properties (objects that keep derived state provide their own toDict)
+  if hasattr(obj, "toDict"):
+    obj_dict.update(obj.toDict())
+  else:
+    obj_dict.update(obj.__dict__)
   return obj_dict
 
+# Classes that JSON files may contain, by the name written in "__class__" (see registerJSONClass)
+JSON_CLASSES = {}
+
+# Class decorator adding a class to JSON_CLASSES
+def registerJSONClass(cls):
+  JSON_CLASSES[cls.__name__] = cls
+  return cls
+
 """
 Function that takes in a dict and returns a custom object associated with the dict.
-This function makes use of the "__module__" and "__class__" metadata in the dictionary
-to know which object type to create.
+The "__class__" metadata is looked up in JSON_CLASSES, so nothing is imported per object and the
+"__module__" metadata (which is "__main__" in the files written from the notebook) is ignored.
+Used as the object_hook of json.load / json.loads, so a file is parsed and its objects built in one pass.
 """
 def convertDictToObject(our_dict):
   if "__class__" in our_dict:
     # Pop ensures we remove metadata from the dict to leave only the instance arguments
     class_name = our_dict.pop("__class__")
-    
-    # Get the module name from the dict and import it
-    module_name = our_dict.pop("__module__")
-    
-    # We use the built in __import__ function since the module name is not yet known at runtime
-    module = __import__(module_name)
-    
-    # Get the class from the module
-    class_ = getattr(module, class_name)
+    our_dict.pop("__module__", None)
+    if (class_name not in JSON_CLASSES):
+      raise ValueError(f'{class_name} is not a registered JSON class')
     
     # Use dictionary unpacking to initialize the object
-    obj = class_(**our_dict)
+    obj = JSON_CLASSES[class_name](**our_dict)
   else:
     obj = our_dict
   return obj
 
+# file extensions of newline-delimited JSON (one object per line)
+NDJSON_EXTENSIONS = ('.ndjson', '.jsonl')
+
+"""
+Reads the objects of a JSON file: a JSON array (.json) is parsed in one pass, and newline-delimited JSON
+(.ndjson or .jsonl) is streamed, so only one object is parsed at a time.
+Returns an iterator over the objects.
+"""
+def iterJSONObjects(fileName):
+  if (fileName.endswith(NDJSON_EXTENSIONS)):
+    return iterNDJSONObjects(fileName)
+  with open(fileName, "r") as jsonFile:
+    return iter(json.load(jsonFile, object_hook=convertDictToObject))
+
+def iterNDJSONObjects(fileName):
+  with open(fileName, "r") as ndjsonFile:
+    for line in ndjsonFile:
+      if (line.strip()):
+        yield json.loads(line, object_hook=convertDictToObject)
+
+# Writes objects as newline-delimited JSON, one object per line, without building the whole file in memory
+def writeNDJSONObjects(objects, fileName):
+  with open(fileName, "w") as ndjsonFile:
+    for obj in objects:
+      ndjsonFile.write(json.dumps(obj, default=convertObjectToDict, sort_keys=True) + "\n")
+
 ## Stock Class ##
 QUALITIES = ['good', 'bad']
 QUALITY_WEIGHTS = [0.25, 0.75]
@@ -58,12 +114,160 @@ PRICE_CHANGES = [-3, -1, 1, 5]
 PRICE_CHANGE_WEIGHTS_GOOD = [0.2, 0.2, 0.3, 0.3]
 PRICE_CHANGE_WEIGHTS_BAD = [0.3, 0.3, 0.2, 0.2]
 INITIAL_PRICE = 10
+# price changes recorded with a stock (in JSON files, CSV results and snapshots); a stock with a path seed draws the later ones on demand
+PRICE_CHANGE_HISTORY_LENGTH = 10
+# the price changes at the start of a history occur before the stock's first test period (see Stock.gainsPrevious)
+WARM_UP_PERIODS = 3
+# test periods a recorded history covers, the experiment length of the original study
+RECORDED_TEST_PERIODS = PRICE_CHANGE_HISTORY_LENGTH - WARM_UP_PERIODS
+
+# byte flags used for quality in the array representation of a market
+QUALITY_GOOD = 1
+QUALITY_BAD = 0
+QUALITY_NAMES = {QUALITY_GOOD: 'good', QUALITY_BAD: 'bad'}
+QUALITY_FLAGS = {'good': QUALITY_GOOD, 'bad': QUALITY_BAD}
+
+# generator used by markets that are not given their own
+RNG = np.random.default_rng()
+
+"""
+Draws a whole batch of stocks in a few array calls. A stock is a 64-bit seed: its quality and price path are drawn
+from the seed (see stocksOfSeeds), so the seed is all it takes to extend the path later.
+Returns an int8 quality vector (QUALITY_GOOD / QUALITY_BAD), an int8 matrix with the first historyLength price changes
+of each stock's path per row and the uint64 vector of the seeds.
+"""
+def generateStockPaths(numStocks, rng = None, historyLength = PRICE_CHANGE_HISTORY_LENGTH):
+  if (rng is None):
+    rng = RNG
+  # raw 64-bit outputs of the bit generator, which are cheaper than integers() for small batches
+  pathSeeds = rng.bit_generator.random_raw(numStocks)
+  qualities, priceChangeHistories = stocksOfSeeds(pathSeeds, historyLength)
+  return qualities, priceChangeHistories, pathSeeds
+
+SPLITMIX64_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+
+# The splitmix64 output function on a uint64 array (the arithmetic wraps around, as in the C original)
+def splitmix64(states):
+  states = (states ^ (states >> 30)) * np.uint64(0xBF58476D1CE4E5B9)
+  states = (states ^ (states >> 27)) * np.uint64(0x94D049BB133111EB)
+  return states ^ (states >> 31)
+
+"""
+Outputs start to stop - 1 of the splitmix64 stream of each seed, one row per seed. The generator is counter-based:
+output k is computed directly from the seed and k, so any part of a stream can be drawn on its own.
+Output 0 of a stock's stream draws its quality and output k + 1 the k-th price change of its path.
+"""
+def seedStreamDraws(pathSeeds, start, stop):
+  return splitmix64(np.asarray(pathSeeds, dtype=np.uint64)[:, None] + seedStreamOffsets(start, stop))
+
+# The splitmix64 state offsets of outputs start to stop - 1 from the seed, cached since markets ask for the same ranges over and over
+@lru_cache(maxsize=64)
+def seedStreamOffsets(start, stop):
+  offsets = np.arange(start + 1, stop + 1, dtype=np.uint64) * SPLITMIX64_GAMMA
+  offsets.flags.writeable = False
+  return offsets
+
+# The qualities and the first historyLength price changes of the stocks with the given seeds, drawn with the weights of QUALITY_WEIGHTS and PRICE_CHANGE_WEIGHTS_*
+def stocksOfSeeds(pathSeeds, historyLength):
+  draws = seedStreamDraws(pathSeeds, 0, 1 + historyLength)
+  goodWeight = QUALITY_WEIGHTS[QUALITIES.index('good')] / sum(QUALITY_WEIGHTS)
+  qualities = (draws[:, 0] < goodWeight * 2.0 ** 64).astype(np.int8)
+  return qualities, priceChangesOfDraws(draws[:, 1:], qualities[:, None])
+
+"""
+Steps start to stop - 1 of the price paths with the given seeds and quality flags, as an int8 matrix with one row per path.
+The first WARM_UP_PERIODS steps are the price changes before the stock's test periods.
+"""
+def pricePathChanges(pathSeeds, qualities, start, stop):
+  return priceChangesOfDraws(seedStreamDraws(pathSeeds, 1 + start, 1 + stop), np.asarray(qualities)[:, None])
+
+# Step steps of the price paths with the given seeds and quality flags, element by element (the arrays broadcast)
+def pricePathSteps(pathSeeds, qualities, steps):
+  draws = splitmix64(np.asarray(pathSeeds, dtype=np.uint64) + (np.asarray(steps, dtype=np.uint64) + np.uint64(2)) * SPLITMIX64_GAMMA)
+  return priceChangesOfDraws(draws, qualities)
+
+# Inverse transform sampling: a price change's index is the number of cumulative weights its draw passes, with the weights
+# of the quality flags (which broadcast to the draws). The weights are counted one at a time, since a comparison with one more
+# dimension is much slower for a large universe.
+def priceChangesOfDraws(draws, qualities):
+  thresholds, priceChanges = priceChangeThresholds(tuple(PRICE_CHANGES), tuple(PRICE_CHANGE_WEIGHTS_GOOD), tuple(PRICE_CHANGE_WEIGHTS_BAD))
+  stockThresholds = thresholds[np.asarray(qualities)]
+  changeIndex = np.zeros(draws.shape, dtype=np.int8)
+  for column in range(stockThresholds.shape[-1]):
+    changeIndex += draws >= stockThresholds[..., column]
+  return priceChanges[changeIndex]
+
+"""
+The stop of the history slice that ends with the price change of lastPeriod, for a stock generated in periodGenerated:
+the warm-up price changes are followed by one price change per period, starting with periodGenerated.
+Works on numbers and on arrays.
+"""
+def historyStop(periodGenerated, lastPeriod):
+  return WARM_UP_PERIODS + 1 + lastPeriod - periodGenerated
+
+# Cumulative weights per quality flag, scaled to the 64-bit draws of pricePathChanges, without the last one (1) so rounding
+# can never push an index past the last price change. Cached on the weights, so small batches do not pay for rebuilding the tables.
+@lru_cache(maxsize=8)
+def priceChangeThresholds(priceChanges, weightsGood, weightsBad):
+  thresholds = np.empty((2, len(priceChanges) - 1), dtype=np.uint64)
+  thresholds[QUALITY_GOOD] = np.ldexp(np.cumsum(weightsGood) / sum(weightsGood), 64)[:-1]
+  thresholds[QUALITY_BAD] = np.ldexp(np.cumsum(weightsBad) / sum(weightsBad), 64)[:-1]
+  return thresholds, np.array(priceChanges, dtype=np.int8)
+
+"""
+The price index of Stock (see Stock.__buildPriceIndex) for every row of a price change history matrix at once:
+an int16 matrix whose first n + 1 columns are the cumulative price changes and last n + 1 the cumulative upticks.
+"""
+def priceIndexArrays(priceChangeHistories):
+  numStocks, historyLength = priceChangeHistories.shape
+  priceIndex = np.zeros((numStocks, 2 * (historyLength + 1)), dtype=np.int16)
+  np.cumsum(priceChangeHistories, axis=1, out=priceIndex[:, 1:historyLength + 1])
+  np.cumsum(priceChangeHistories > 0, axis=1, out=priceIndex[:, historyLength + 2:])
+  return priceIndex
+
+STOCK_NAME_LETTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+"""
+The display name of a stock ID: ID + 1 written in bijective base 26 with the letters A to Z, so 0 is A, 25 is Z,
+26 is AA and 702 is AAA. Every ID has a name of its own, and the first 26 are the single letters markets used to hand out.
+"""
+def stockName(stockId):
+  if (stockId < 0):
+    raise ValueError(f'stock IDs start at 0, got {stockId}')
+  letters = []
+  number = stockId + 1
+  while (number > 0):
+    number, digit = divmod(number - 1, len(STOCK_NAME_LETTERS))
+    letters.append(STOCK_NAME_LETTERS[digit])
+  return ''.join(reversed(letters))
 
+# The stock ID of a display name (see stockName)
+def stockIdOfName(name):
+  if (len(name) == 0):
+    raise ValueError('a stock name has at least one letter')
+  number = 0
+  for letter in name:
+    digit = STOCK_NAME_LETTERS.find(letter)
+    if (digit < 0):
+      raise ValueError(f'{name!r} is not a stock name')
+    number = number * len(STOCK_NAME_LETTERS) + digit + 1
+  return number - 1
+
+@registerJSONClass
 class Stock(object):
-  def __init__(self, name, periodGenerated, initialPrice = None, quality = None, priceChangeHistory = None, testing = False, periodSold = None):
-    self.name = name
+  # No per-instance __dict__: the history and its index are small typed arrays and quality is a byte flag
+  __slots__ = ('_name', 'initialPrice', 'qualityFlag', '_priceChangeHistory', 'periodGenerated', 'periodSold', 'testing', '_priceIndex', '_gainsPrevious', 'pathSeed')
+
+  # name is an integer stock ID, as handed out by a market (see Market.allocateStockIds), or a display name, as read from a file.
+  # pathSeed is the seed of the stock's price path (see pricePathChanges): a query past the end of the history draws
+  # the missing price changes from it. Without one, queries are limited to the history, as for a slice.
+  def __init__(self, name, periodGenerated, initialPrice = None, quality = None, priceChangeHistory = None, testing = False, periodSold = None, pathSeed = None):
+    if (pathSeed is not None and (quality is None or priceChangeHistory is None)):
+      raise ValueError(f'stock {name} has a path seed, but no quality or price change history')
+    self._name = name
     self.initialPrice = initialPrice
     self.quality = quality
+    self.pathSeed = pathSeed
     self.priceChangeHistory = priceChangeHistory
     self.periodGenerated = periodGenerated
     self.periodSold = periodSold
@@ -73,92 +277,178 @@ class Stock(object):
   implement copy and deepcopy on the Stock class to assign stocks from the market by value (as independent copies) 
   to investors during experiment periods.
   """
-  __slots__ = 'a', '__dict__'
   def __copy__(self):
-      return type(self)(self.name, self.periodGenerated, self.initialPrice, self.quality, self.priceChangeHistory, self.testing, self.periodSold)
+      return type(self)(self._name, self.periodGenerated, self.initialPrice, self.quality, self.priceChangeHistory, self.testing, self.periodSold, self.pathSeed)
   def __deepcopy__(self, memo): # memo is a dict of id's to copies
       id_self = id(self)        # memoization avoids unnecesary recursion
       _copy = memo.get(id_self)
       if _copy is None:
           _copy = type(self)(
-              deepcopy(self.name, memo), 
+              deepcopy(self._name, memo), 
               deepcopy(self.periodGenerated, memo),
               deepcopy(self.initialPrice, memo),
               deepcopy(self.quality, memo),
               deepcopy(self.priceChangeHistory, memo),
               deepcopy(self.testing, memo),
-              deepcopy(self.periodSold, memo))
+              deepcopy(self.periodSold, memo),
+              deepcopy(self.pathSeed, memo))
           memo[id_self] = _copy 
       return _copy
 
-  def __createPriceChangeHistory(self):
-    global QUALITIES, QUALITY_WEIGHTS, PRICE_CHANGE_WEIGHTS_GOOD, PRICE_CHANGE_WEIGHTS_BAD, PRICE_CHANGES
-    generatedPriceChangeHistory = []
-    
-    if self.quality == 'good':
-      weights = PRICE_CHANGE_WEIGHTS_GOOD
-    else: 
-      weights = PRICE_CHANGE_WEIGHTS_BAD
-
-    generatedPriceChangeHistory = choices(PRICE_CHANGES, weights, k=10)
-    return generatedPriceChangeHistory
-
+  # Draws a stock as a market does (see generateStockPaths): a random seed, and the quality and recorded history drawn from it
   def initializeRandom(self):
-    global QUALITIES, QUALITY_WEIGHTS, PRICE_CHANGES, PRICE_CHANGE_WEIGHTS_GOOD, PRICE_CHANGE_WEIGHTS_BAD
-    
     self.initialPrice = INITIAL_PRICE
-    randQualityList = choices(QUALITIES, QUALITY_WEIGHTS) # random choice with weightings.
-    self.quality = randQualityList[0]  # Get string from list
-    self.priceChangeHistory = self.__createPriceChangeHistory()
+    self.pathSeed = getrandbits(64)
+    qualities, priceChangeHistories = stocksOfSeeds([self.pathSeed], PRICE_CHANGE_HISTORY_LENGTH)
+    self.qualityFlag = int(qualities[0])
+    self.priceChangeHistory = priceChangeHistories[0].tolist()
 
+  # The display name, built from the stock ID when it is asked for (see stockName)
+  @property
   def name(self):
-    return self.name
+    if (type(self._name) is int):
+      return stockName(self._name)
+    return self._name
 
-  def initialPrice(self):
-    return self.initialPrice
+  # The stock ID of a stock generated by a market, None for a stock with a display name only
+  @property
+  def stockId(self):
+    return self._name if type(self._name) is int else None
 
-  def periodGenerated(self):
-    return self.periodGenerated
+  # quality is stored as a byte flag (QUALITY_GOOD / QUALITY_BAD) and exposed as 'good' / 'bad'
+  @property
+  def quality(self):
+    if (self.qualityFlag is None):
+      return None
+    return QUALITY_NAMES[self.qualityFlag]
 
-  def periodSold(self):
-    return self.periodSold
+  @quality.setter
+  def quality(self, quality):
+    self.qualityFlag = None if quality is None else QUALITY_FLAGS[quality]
 
-  def quality(self):
-    return self.quality
-  
+  @property
   def priceChangeHistory(self):
-    return self.priceChangeHistory
+    return self._priceChangeHistory
+
+  # Assigning a history (constructor, initializeRandom, loading from JSON) stores it as array('b') and rebuilds the price index.
+  # A list, an array or the bytes of an int8 matrix row are all accepted.
+  @priceChangeHistory.setter
+  def priceChangeHistory(self, priceChangeHistory):
+    self._priceChangeHistory = None if priceChangeHistory is None else array('b', priceChangeHistory)
+    self.__buildPriceIndex()
+
+  """
+  Prefix sums over the price change history, kept in one array('h') of 2 * (n + 1) entries: _priceIndex[k] is the sum
+  and _priceIndex[n + 1 + k] the number of price increases in the first k entries, so each period query is a
+  difference of two entries.
+  """
+  def __buildPriceIndex(self):
+    if (self._priceChangeHistory is None):
+      self._priceIndex = None
+      self._gainsPrevious = None
+      return
+    self._priceIndex = array('h', [0])
+    self._priceIndex.extend(accumulate(self._priceChangeHistory))
+    self._priceIndex.append(0)
+    self._priceIndex.extend(accumulate(int(priceChange > 0) for priceChange in self._priceChangeHistory))
+    self._gainsPrevious = sum(priceChange >= 0 for priceChange in self._priceChangeHistory[:WARM_UP_PERIODS])
+
+  # Extends the history of a stock with a path seed to at least length price changes (at least doubling it, so a
+  # long experiment extends each stock only a few times) and rebuilds the price index. Returns the new length.
+  def __drawPriceChanges(self, length):
+    historyLength = len(self._priceChangeHistory)
+    self._priceChangeHistory.frombytes(pricePathChanges([self.pathSeed], [self.qualityFlag], historyLength, max(length, 2 * historyLength))[0].tobytes())
+    self.__buildPriceIndex()
+    return len(self._priceChangeHistory)
 
-  def testing(self):
-    return self.testing
+  # Same result as sum(self.priceChangeHistory[start:stop]), including Python's slice clipping, once a seeded history is long enough
+  def __sumPriceChanges(self, start, stop):
+    historyLength = len(self._priceChangeHistory)
+    if (stop > historyLength and self.pathSeed is not None):
+      historyLength = self.__drawPriceChanges(stop)
+    start, stop, _ = slice(start, stop).indices(historyLength)
+    if (stop <= start):
+      return 0
+    return self._priceIndex[stop] - self._priceIndex[start]
+
+  # Same result as counting the increases in self.priceChangeHistory[:stop]
+  def __countUpticks(self, stop):
+    historyLength = len(self._priceChangeHistory)
+    if (stop > historyLength and self.pathSeed is not None):
+      historyLength = self.__drawPriceChanges(stop)
+    _, stop, _ = slice(0, stop).indices(historyLength)
+    return self._priceIndex[historyLength + 1 + stop]
 
   def priceForTestPeriod(self, periodNum):
-    # get rid of the first three entries in the priceChangeHistory--they occurred before test begins
-    priceChangeHistoryForTest = self.priceChangeHistory[3:]
+    # get rid of the warm-up entries in the priceChangeHistory--they occurred before test begins
+    if (WARM_UP_PERIODS + periodNum > len(self.priceChangeHistory) and self.pathSeed is not None):
+      self.__drawPriceChanges(WARM_UP_PERIODS + periodNum)
+    numTestPeriods = max(len(self.priceChangeHistory) - WARM_UP_PERIODS, 0)
     
-    if periodNum > len(priceChangeHistoryForTest):
+    if periodNum > numTestPeriods:
       print("ERROR: Asking for a test period that hasn't been created yet")
-      print(f'    Period: {periodNum}, max defined periods: {len(priceChangeHistoryForTest)}')
+      print(f'    Period: {periodNum}, max defined periods: {numTestPeriods}')
       raise
         
-    return self.initialPrice() + sum(priceChangeHistoryForTest[0:periodNum])
+    testStart, testStop, _ = slice(0, periodNum).indices(numTestPeriods)
+    return self.initialPrice + self.__sumPriceChanges(WARM_UP_PERIODS + testStart, WARM_UP_PERIODS + testStop)
 
   def gainsPrevious(self):
-    numberGainsPrevious = 0
-    for num in self.priceChangeHistory[:3]:   
-    # checking condition 
-      if num >= 0: 
-        numberGainsPrevious += 1
-    return numberGainsPrevious
+    return self._gainsPrevious
+
+  # Builds a generated stock from one row of its market's arrays, taking the row of priceIndexArrays instead of rebuilding the index
+  @classmethod
+  def fromArrays(cls, name, periodGenerated, qualityFlag, priceChangeHistory, priceIndex, gainsPrevious, pathSeed = None):
+    stock = cls.__new__(cls)
+    stock._name = name
+    stock.initialPrice = INITIAL_PRICE
+    stock.qualityFlag = qualityFlag
+    stock._priceChangeHistory = array('b', priceChangeHistory.tobytes())
+    stock._priceIndex = array('h', priceIndex.tobytes())
+    stock._gainsPrevious = gainsPrevious
+    stock.periodGenerated = periodGenerated
+    stock.periodSold = None
+    stock.testing = False
+    stock.pathSeed = pathSeed
+    return stock
 
   def totalPriceChangeInPeriod(self, period):
+    return self._totalPriceChangeInPeriod(period, self.periodSold)
+
+  # Shared by Stock and Position: the sold period comes from whoever holds the stock
+  def _totalPriceChangeInPeriod(self, period, periodSold):
     # Calculates the sum of price changes of the stock
     lastPeriod = period
-    if(self.periodSold != None):
-      lastPeriod = min(self.periodSold -1, period)
-    periodsToSum = 11 - self.periodGenerated - (7 - lastPeriod)
-    sumPreviousPriceChanges = sum(self.priceChangeHistory[3:periodsToSum])
-    return sumPreviousPriceChanges
+    if(periodSold != None):
+      lastPeriod = min(periodSold -1, period)
+    # historyStop(self.periodGenerated, lastPeriod), written out on this hot path
+    return self.__sumPriceChanges(WARM_UP_PERIODS, WARM_UP_PERIODS + 1 + lastPeriod - self.periodGenerated)
+
+  # Number of price increases from the start of the history (including the warm-up periods before the test) through lastPeriod
+  def numUpticksInPeriod(self, lastPeriod):
+    return self.__countUpticks(WARM_UP_PERIODS + 1 + lastPeriod - self.periodGenerated)
+
+  # The constructor arguments, used for the JSON representation instead of the derived index state
+  # A stock with a path seed is written with its seed and its recorded history, since the rest is drawn from the seed again
+  def toDict(self):
+    stockDict = {
+      "name": self.name,
+      "initialPrice": self.initialPrice,
+      "quality": self.quality,
+      "priceChangeHistory": None if self.priceChangeHistory is None else self.recordedPriceChangeHistory().tolist(),
+      "periodGenerated": self.periodGenerated,
+      "periodSold": self.periodSold,
+      "testing": self.testing
+    }
+    if (self.pathSeed is not None):
+      stockDict["pathSeed"] = self.pathSeed
+    return stockDict
+
+  # The history as written out: the recorded PRICE_CHANGE_HISTORY_LENGTH price changes of a stock with a path seed, the whole history otherwise
+  def recordedPriceChangeHistory(self):
+    if (self.pathSeed is not None):
+      return self.priceChangeHistory[:PRICE_CHANGE_HISTORY_LENGTH]
+    return self.priceChangeHistory
 
   def toJSONString(self):
     return json.dumps(self, default=convertObjectToDict, sort_keys=True)
@@ -168,12 +458,15 @@ class Stock(object):
     return json.loads(jsonString, object_hook=convertDictToObject)
 
   def description(self):    
+    self._description(self.periodSold)
+
+  def _description(self, periodSold):
     print(f'Stock: {self.name}')
     print(f'  quality:              {self.quality}')
     print(f'  initial price:        {self.initialPrice}')
-    print(f'  price change history: {self.priceChangeHistory}')
+    print(f'  price change history: {self.recordedPriceChangeHistory().tolist()}')
     print(f'  period generated:     {self.periodGenerated}')
-    print(f'  period sold:          {self.periodSold}')
+    print(f'  period sold:          {periodSold}')
 
   @classmethod
   def headerCSV(self):
@@ -181,9 +474,19 @@ class Stock(object):
     return csvHeader
 
   def descriptionCSV(self):
-    priceChangeHistoryString = ', '.join(map(str, self.priceChangeHistory))
-    descCSV = self.name + CSV_DELIMITER + self.quality + CSV_DELIMITER + str(self.initialPrice) + CSV_DELIMITER + priceChangeHistoryString + CSV_DELIMITER + str(self.periodGenerated) + CSV_DELIMITER + str(self.periodSold) + CSV_DELIMITER + str(self.gainsPrevious()) + CSV_DELIMITER + str(self.totalPriceChangeInPeriod(7))
-    return descCSV
+    return self._descriptionCSV(self.periodSold)
+
+  def _descriptionCSV(self, periodSold):
+    return CSV_DELIMITER.join(self._csvRow(periodSold))
+
+  # The fields of descriptionCSV, for a csv writer: the first PRICE_CHANGE_HISTORY_LENGTH price changes (as many as the result columns hold)
+  # and the total price change through lastPeriod, the last period of the experiment
+  def csvRow(self, lastPeriod = RECORDED_TEST_PERIODS):
+    return self._csvRow(self.periodSold, lastPeriod)
+
+  def _csvRow(self, periodSold, lastPeriod = RECORDED_TEST_PERIODS):
+    priceChangeHistoryString = ', '.join(map(str, self.priceChangeHistory[:PRICE_CHANGE_HISTORY_LENGTH]))
+    return [self.name, self.quality, str(self.initialPrice), priceChangeHistoryString, str(self.periodGenerated), str(periodSold), str(self.gainsPrevious()), str(self._totalPriceChangeInPeriod(lastPeriod, periodSold))]
 
     '''
     # Can be used when integrated with Market class
@@ -198,91 +501,264 @@ class Stock(object):
       print(f'  price for current period:  {self.priceForTestPeriod(self.marketClass.currentPeriod)}')
     '''
 
+"""
+An investor's holding of a stock. Market stocks are definitions shared by the market and every investor
+who buys them, so buying only creates this small record of the holding-specific state (period bought and sold).
+A Position answers the same questions as a Stock, so portfolios and sold stock lists can hold either.
+"""
+class Position(object):
+  __slots__ = ('stock', 'periodBought', 'periodSold')
+
+  def __init__(self, stock, periodBought, periodSold = None):
+    self.stock = stock
+    self.periodBought = periodBought
+    self.periodSold = periodSold
+
+  @property
+  def name(self):
+    return self.stock.name
+
+  @property
+  def quality(self):
+    return self.stock.quality
+
+  @property
+  def qualityFlag(self):
+    return self.stock.qualityFlag
+
+  @property
+  def initialPrice(self):
+    return self.stock.initialPrice
+
+  @property
+  def priceChangeHistory(self):
+    return self.stock.priceChangeHistory
+
+  @property
+  def periodGenerated(self):
+    return self.stock.periodGenerated
+
+  def priceForTestPeriod(self, periodNum):
+    return self.stock.priceForTestPeriod(periodNum)
+
+  def gainsPrevious(self):
+    return self.stock.gainsPrevious()
+
+  def totalPriceChangeInPeriod(self, period):
+    return self.stock._totalPriceChangeInPeriod(period, self.periodSold)
+
+  def numUpticksInPeriod(self, lastPeriod):
+    return self.stock.numUpticksInPeriod(lastPeriod)
+
+  def description(self):
+    self.stock._description(self.periodSold)
+
+  def descriptionCSV(self):
+    return self.stock._descriptionCSV(self.periodSold)
+
+  def csvRow(self, lastPeriod = RECORDED_TEST_PERIODS):
+    return self.stock._csvRow(self.periodSold, lastPeriod)
+
 
 # %%
 ## Market Class ##
-import json
-from collections import namedtuple
 
 TEST_READ_STOCKS_FROM_FILE = "ReadStocksFromFile"
 TEST_WRITE_STOCKS_TO_FILE = "WriteStocksToFile"
 
+"""
+The indices of the numStocks highest scores along the last axis (of all of them if there are fewer), highest first
+and ties in index order, as a stable sort of the negated scores gives them. -score * n + index is distinct for every
+index, so a partial selection of the numStocks smallest (np.argpartition, linear in n) and a sort of just those
+replace the sort of the whole row. The keys are int32 whenever they fit, which halves the memory the selection reads.
+"""
+def topScoreIndices(scores, numStocks):
+  numScores = scores.shape[-1]
+  scoreBound = int(np.abs(scores).max()) + 1 if scores.size else 1
+  keyType = np.int32 if scoreBound * numScores < 2 ** 31 else np.int64
+  keys = -scores.astype(keyType) * keyType(numScores) + np.arange(numScores, dtype = keyType)
+  numStocks = min(numStocks, numScores)
+  if (numStocks <= 0):
+    return np.zeros(keys.shape[:-1] + (0,), dtype = np.int64)
+  if (numStocks < numScores):
+    selected = np.argpartition(keys, numStocks - 1, axis = -1)[..., :numStocks]
+    keys = np.take_along_axis(keys, selected, axis = -1)
+  else:
+    selected = np.broadcast_to(np.arange(numScores), keys.shape)
+  return np.take_along_axis(selected, np.argsort(keys, axis = -1), axis = -1)
+
+# array form of one generated batch of stocks: int8 qualities, int8 price change history matrix, the period they were generated in,
+# the uint64 path seeds and the stock ID of the first stock (the batch's stocks have consecutive IDs)
+StockArrays = namedtuple('StockArrays', ['quality', 'priceChangeHistory', 'periodGenerated', 'pathSeed', 'firstStockId'])
+
 class Market(object):
-  STOCK_NAMES = ["A", "B","C","D","E","F","G","H","I","J","K","L","M","N","O","P","Q","R","S","T","U","V","W","X","W","Z"]
-  MAX_NUM_STOCKS = len(STOCK_NAMES)
   currentPeriod = 1
   outputTestStockFilename = 'TestStocks.json'
+  # compiled sidecars of the .json stock files read (a CompiledStockCache, set up with the Compiled Stock Files cell)
+  stockCache = None
 
-  def __init__(self, name, numStocks = 20, inputTestStockFilename = None, testMode = None):
+  # period sets currentPeriod before the stocks are generated, for a market that starts in a later period, and
+  # firstStockId the ID of its first stock, for a market continuing another one's IDs (see allocateStockIds).
+  # Every generated batch (also those of updateStocks) is written to snapshot, a MarketSnapshotWriter, if given,
+  # and replay, a MarketSnapshotReader, hands out the batches of a snapshot instead of drawing new ones.
+  def __init__(self, name, numStocks = 20, inputTestStockFilename = None, testMode = None, rng = None, period = None, snapshot = None, replay = None, firstStockId = 0):
     # print (f'testing is =====> {testMode}')
-    if (numStocks > self.MAX_NUM_STOCKS):
-      print(f"ERROR: No more than {len(self.MAX_NUM_STOCKS)} stocks can be created")
-      raise
+    if (numStocks < 0):
+      raise ValueError(f'a market cannot have {numStocks} stocks')
     self.name = name
+    # the ID of the next stock generated (see allocateStockIds)
+    self.nextStockId = firstStockId
     self.testMode = testMode
+    self.rng = rng if rng is not None else RNG
+    self.stockArrays = None
+    self.snapshot = snapshot
+    self.replay = replay
+    if (period is not None):
+      self.currentPeriod = period
     
     if (testMode == TEST_READ_STOCKS_FROM_FILE):
       self.initialStocks = self.readStocksJSONFromFile(inputTestStockFilename)
     else:
-      self.initialStocks = (self.__generateStocks(numStocks))
+      self.__generateStocks(numStocks)
     
       if (testMode == TEST_WRITE_STOCKS_TO_FILE):
         self.__writeStocksJSONToFile()
 
+  # Draw the whole batch as arrays; Stock objects are only built for the stocks that are read
   def __generateStocks(self, numStocks):
-    i = 0
-    stocks = []
-    while (i < numStocks):
-      newStock = Stock(self.STOCK_NAMES[i], self.currentPeriod)
-      newStock.initializeRandom()
-      stocks.append(newStock)
-      i = i+1
-    return stocks
-  
+    # stocks draw the rest of their paths from their seeds (replayed stocks without seeds keep the recorded histories)
+    if (self.replay is not None):
+      qualities, priceChangeHistories, pathSeeds = self.replay.nextBatch(self.name, self.currentPeriod, numStocks)
+    else:
+      qualities, priceChangeHistories, pathSeeds = generateStockPaths(numStocks, self.rng)
+    if (self.snapshot is not None):
+      self.snapshot.writeBatch(self.name, self.currentPeriod, qualities, priceChangeHistories, pathSeeds)
+    self.stockArrays = StockArrays(qualities, priceChangeHistories, self.currentPeriod, pathSeeds, self.allocateStockIds(numStocks))
+    self._initialStocks = None
+    self._stocksFromArrays = [None] * numStocks
+    self._priceIndex = None
+    self.__clearGainersCache()
+    return self.stockArrays
+
+  # The first of numStocks consecutive new stock IDs: IDs are never handed out twice, so the stocks of all the
+  # market's batches (see updateStocks) have different IDs, and names (see stockName)
+  def allocateStockIds(self, numStocks):
+    firstStockId = self.nextStockId
+    self.nextStockId += numStocks
+    return firstStockId
+
+  def numStocks(self):
+    if (self.stockArrays is not None):
+      return len(self.stockArrays.quality)
+    return len(self._initialStocks)
+
+  # The stock at index in initialStocks; a generated stock is built the first time it is asked for
+  def stockAt(self, index):
+    if (self.stockArrays is None):
+      return self._initialStocks[index]
+    stock = self._stocksFromArrays[index]
+    if (stock is None):
+      qualities, priceChangeHistories, periodGenerated, pathSeeds, firstStockId = self.stockArrays
+      if (self._priceIndex is None):
+        self._priceIndex = priceIndexArrays(priceChangeHistories)
+      stock = Stock.fromArrays(firstStockId + index, periodGenerated, int(qualities[index]), priceChangeHistories[index], self._priceIndex[index], int(self.gainerScores()[index]),
+                               None if pathSeeds is None else int(pathSeeds[index]))
+      self._stocksFromArrays[index] = stock
+    return stock
+
+  # numStocks stocks drawn like random.sample(initialStocks, numStocks), building only the drawn ones
+  def sampleStocks(self, numStocks):
+    return [self.stockAt(index) for index in random.sample(range(self.numStocks()), numStocks)]
+
   # Katrin: This is the public method that I use from outside the market class
   def updateStocks(self, numStocks):
-    self.initialStocks = self.__generateStocks(numStocks)
+    return self.__generateStocks(numStocks)
+
+  # The market's stocks as Stock objects, built from the generated arrays on first access
+  @property
+  def initialStocks(self):
+    if (self._initialStocks is None and self.stockArrays is not None):
+      self._initialStocks = [self.stockAt(index) for index in range(self.numStocks())]
+    return self._initialStocks
+
+  # Assigning stocks directly (e.g. read from a file) replaces the generated arrays
+  @initialStocks.setter
+  def initialStocks(self, stocks):
+    self._initialStocks = stocks
+    self.stockArrays = None
+    self.__clearGainersCache()
+
+  def __clearGainersCache(self):
+    self._gainerScores = None
+    self._topGainersCache = {}
+
+  # gainsPrevious of every stock in initialStocks as an int8 array, computed once per batch (from the arrays when the market generated them)
+  def gainerScores(self):
+    if (self._gainerScores is None):
+      if (self.stockArrays is not None):
+        self._gainerScores = (self.stockArrays.priceChangeHistory[:, :WARM_UP_PERIODS] >= 0).sum(axis=1, dtype=np.int8)
+      else:
+        self._gainerScores = np.array([stock.gainsPrevious() for stock in self.initialStocks], dtype=np.int8)
+    return self._gainerScores
+
+  # The warm-up price changes of every stock in initialStocks, as an int8 matrix (the candidates of a buy strategy, see Strategy)
+  def warmUpPriceChanges(self):
+    if (self.stockArrays is not None):
+      return self.stockArrays.priceChangeHistory[:, :WARM_UP_PERIODS]
+    return np.array([stock.priceChangeHistory[:WARM_UP_PERIODS] for stock in self.initialStocks], dtype=np.int8).reshape(-1, WARM_UP_PERIODS)
+
+  """
+  The numStocks stocks with the highest gainsPrevious, as bought by BUY_GAINERS.
+  Ties are broken by market order (the stock listed first in initialStocks wins); the stocks are selected by a
+  partial selection over the market and a sort of the numStocks selected (see topScoreIndices). Only the selected
+  stocks are built.
+  The selection is cached per period until the market's stocks change, so investors sharing a market
+  do not each redo it.
+  """
+  def topGainers(self, numStocks):
+    cacheKey = (self.currentPeriod, numStocks)
+    if (cacheKey not in self._topGainersCache):
+      topIndices = topScoreIndices(self.gainerScores(), numStocks)
+      self._topGainersCache[cacheKey] = tuple(self.stockAt(index) for index in topIndices.tolist())
+    return self._topGainersCache[cacheKey]
 
   def __writeStocksJSONToFile(self):
-    testFileName = self.testStockFilename
+    testFileName = self.outputTestStockFilename
     with open(testFileName, "w") as testStocksFile:
-      testStocksFile.write(self.__encodeStocksToJSONString())
-
-  def __encodeStocksToJSONString(self):
-    # write them out as array of json-encoded Stocks
-    encodedStocks = '['
-    i = 0
-    numStocks = len(self.initialStocks)
-    while i < numStocks:
-      encodedStocks = encodedStocks + self.initialStocks[i].toJSONString()
+      for encodedStock in self.__encodeStocksToJSON():
+        testStocksFile.write(encodedStock)
+
+  # write them out as array of json-encoded Stocks, one piece at a time
+  def __encodeStocksToJSON(self):
+    yield '['
+    numStocks = self.numStocks()
+    for i in range(numStocks):
+      yield self.stockAt(i).toJSONString()
       if (i < numStocks - 1):
-        encodedStocks = encodedStocks + ', \n'
-      i = i + 1
-    encodedStocks = encodedStocks + ']\n'    
-    return encodedStocks
+        yield ', \n'
+    yield ']\n'
 
+  # Reads the stocks of a .json file, or of an .ndjson / .jsonl file line by line (see iterJSONObjects)
+  @classmethod
   def readStocksJSONFromFile(self, inputTestStockFilename):
     if (inputTestStockFilename is None):
       print(f"ERROR: Must supply name of input file.")
       raise
         
-    stocks = []
-    with open(inputTestStockFilename, "r") as testStocksFile:
-      stockArray = json.load(testStocksFile)
-
-    for stockDict in stockArray:
-      # Matt: figure out why double quotes become single when reading in
-      # until then, replace them since JSON needs double quotes
-      dictString = str(stockDict)
-      dictString = dictString.replace("\'", "\"")
-
-      newStock = Stock.fromJSONString(dictString)
-      stocks.append(newStock)
-        
-    return stocks
+    return list(self.iterStocksJSONFromFile(inputTestStockFilename))
 
-  def initialStocks(self):
-    return self.initialStocks
+  # The stocks of a scenario file one at a time, for files too large to hold.
+  # .json files go through stockCache (see CompiledStockCache); set it to None to always parse the JSON.
+  @classmethod
+  def iterStocksJSONFromFile(self, inputTestStockFilename):
+    if (self.stockCache is not None and not inputTestStockFilename.endswith(NDJSON_EXTENSIONS)):
+      stocks = self.stockCache.readObjects(inputTestStockFilename)
+    else:
+      stocks = iterJSONObjects(inputTestStockFilename)
+    for stock in stocks:
+      if (not isinstance(stock, Stock)):
+        raise ValueError(f'{inputTestStockFilename} contains a {type(stock).__name__}, expected Stock objects')
+      yield stock
 
   # Print out each stock
   def description(self):
@@ -300,9 +776,393 @@ class Market(object):
 # Currently, the filename for the archived stocks is TestStocks.json, which is in the repo.
 
 # %%
-from enum import Enum
-import random
+## Market Snapshots ##
+
+SNAPSHOT_NDJSON = 'ndjson'  # one JSON object per batch and line
+SNAPSHOT_BINARY = 'npy'     # per batch, a JSON header and a stock matrix saved one after another with np.save
+SNAPSHOT_FORMATS = [SNAPSHOT_NDJSON, SNAPSHOT_BINARY]
+
+# one batch of stocks generated by a market in a period: int8 qualities, price change history matrix and the uint64 path seeds (None if unknown)
+MarketBatch = namedtuple('MarketBatch', ['market', 'period', 'quality', 'priceChangeHistory', 'pathSeed'], defaults = (None,))
+
+# The batches of a stock universe (as BatchEngine keeps it: the rows of one market after another) in the order markets generate them
+def universeBatches(marketNames, batchSizes, qualities, priceChangeHistories, pathSeeds = None):
+  start = 0
+  for marketName in marketNames:
+    for period, batchSize in enumerate(batchSizes, 1):
+      yield MarketBatch(marketName, period, qualities[start:start + batchSize], priceChangeHistories[start:start + batchSize],
+                        None if pathSeeds is None else pathSeeds[start:start + batchSize])
+      start += batchSize
+
+# The snapshot format of a file name: binary for .npy files, newline-delimited JSON otherwise
+def snapshotFormatOf(fileName):
+  return SNAPSHOT_BINARY if fileName.endswith('.npy') else SNAPSHOT_NDJSON
+
+"""
+Streams every batch of stocks that markets generate (the initial stocks and each updateStocks batch) to a snapshot
+file, as they are generated, so the exact markets behind a run can be archived and replayed (MarketSnapshotReader).
+NDJSON writes {"market", "period", "quality", "priceChangeHistory"} per line; the binary format writes each batch
+as two arrays with np.save: the header {"market", "period"} as JSON bytes, and an int8 matrix with the quality
+flag followed by the price change history in each row. When the path seeds of a batch are known they are written
+as well ("pathSeed" in NDJSON, a uint64 array after the matrix announced by "pathSeeds" in the binary header),
+so a replay can draw prices past the recorded histories.
+"""
+class MarketSnapshotWriter(object):
+  def __init__(self, fileName, snapshotFormat = None):
+    self.fileName = fileName
+    self.snapshotFormat = snapshotFormat or snapshotFormatOf(fileName)
+    if (self.snapshotFormat not in SNAPSHOT_FORMATS):
+      raise ValueError(f'{self.snapshotFormat} is not a valid snapshot format')
+    self.numBatches = 0
+    if (self.snapshotFormat == SNAPSHOT_BINARY):
+      self.snapshotFile = open(fileName, "wb")
+    else:
+      self.snapshotFile = open(fileName, "w")
+
+  def writeBatch(self, marketName, period, qualities, priceChangeHistories, pathSeeds = None):
+    if (self.snapshotFormat == SNAPSHOT_BINARY):
+      header = {"market": marketName, "period": int(period)}
+      if (pathSeeds is not None):
+        header["pathSeeds"] = True
+      np.save(self.snapshotFile, np.frombuffer(json.dumps(header).encode(), dtype = np.uint8))
+      np.save(self.snapshotFile, np.column_stack((qualities, priceChangeHistories)).astype(np.int8))
+      if (pathSeeds is not None):
+        np.save(self.snapshotFile, np.asarray(pathSeeds, dtype = np.uint64))
+    else:
+      record = {"market": marketName, "period": int(period),
+                "quality": [QUALITY_NAMES[flag] for flag in qualities.tolist()],
+                "priceChangeHistory": priceChangeHistories.tolist()}
+      if (pathSeeds is not None):
+        record["pathSeed"] = np.asarray(pathSeeds).tolist()
+      self.snapshotFile.write(json.dumps(record) + "\n")
+    self.numBatches += 1
+
+  # Writes the batches of a stock universe (see universeBatches)
+  def writeUniverse(self, marketNames, batchSizes, qualities, priceChangeHistories, pathSeeds = None):
+    for batch in universeBatches(marketNames, batchSizes, qualities, priceChangeHistories, pathSeeds):
+      self.writeBatch(*batch)
+
+  def close(self):
+    self.snapshotFile.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.close()
+
+"""
+Hands recorded batches of stocks (MarketBatch tuples, from source) to replaying markets. Iterating gives the
+batches; nextBatch hands the next batch to a market and checks that it is the one the market asks for, since
+a replay has to generate its markets in the order of the recorded run.
+"""
+class MarketBatchReplay(object):
+  def __init__(self, batches, source):
+    self.batches = iter(batches)
+    self.source = source
+
+  def __iter__(self):
+    return self.batches
+
+  def nextBatch(self, marketName, period, numStocks):
+    batch = next(self.batches, None)
+    if (batch is None):
+      raise ValueError(f'{self.source} has no batch left for market {marketName} in period {period}')
+    if (batch.market != marketName or batch.period != period or len(batch.quality) != numStocks):
+      raise ValueError(f'{self.source} has {len(batch.quality)} stocks of market {batch.market} in period {batch.period} next, '
+                       f'but {numStocks} stocks of market {marketName} in period {period} were asked for')
+    return batch.quality, batch.priceChangeHistory, batch.pathSeed
+
+  # The batches of a market's stock universe (see MarketSnapshotWriter.writeUniverse) as one set of arrays; the path seeds are None unless every batch has them
+  def readUniverse(self, marketNames, batchSizes):
+    batches = [self.nextBatch(marketName, period, batchSize) for marketName in marketNames for period, batchSize in enumerate(batchSizes, 1)]
+    pathSeeds = None if any(batch[2] is None for batch in batches) else np.concatenate([batch[2] for batch in batches])
+    return np.concatenate([batch[0] for batch in batches]), np.concatenate([batch[1] for batch in batches]), pathSeeds
+
+# Reads a snapshot written by MarketSnapshotWriter one batch at a time
+class MarketSnapshotReader(MarketBatchReplay):
+  def __init__(self, fileName, snapshotFormat = None):
+    self.fileName = fileName
+    self.snapshotFormat = snapshotFormat or snapshotFormatOf(fileName)
+    if (self.snapshotFormat not in SNAPSHOT_FORMATS):
+      raise ValueError(f'{self.snapshotFormat} is not a valid snapshot format')
+    if (self.snapshotFormat == SNAPSHOT_BINARY):
+      self.snapshotFile = open(fileName, "rb")
+    else:
+      self.snapshotFile = open(fileName, "r")
+    super().__init__(self.__readBatches(), fileName)
+
+  def __readBatches(self):
+    if (self.snapshotFormat == SNAPSHOT_BINARY):
+      while (self.snapshotFile.peek(1)):
+        header = json.loads(np.load(self.snapshotFile).tobytes())
+        stockMatrix = np.load(self.snapshotFile)
+        pathSeeds = np.load(self.snapshotFile) if header.get("pathSeeds") else None
+        yield MarketBatch(header["market"], header["period"], np.ascontiguousarray(stockMatrix[:, 0]), np.ascontiguousarray(stockMatrix[:, 1:]), pathSeeds)
+    else:
+      for line in self.snapshotFile:
+        if (line.strip()):
+          record = json.loads(line)
+          yield MarketBatch(record["market"], record["period"], np.array([QUALITY_FLAGS[quality] for quality in record["quality"]], dtype = np.int8),
+                            np.array(record["priceChangeHistory"], dtype = np.int8).reshape(len(record["quality"]), -1),
+                            np.array(record["pathSeed"], dtype = np.uint64) if "pathSeed" in record else None)
+
+  def close(self):
+    self.snapshotFile.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.close()
+
+# %%
+## Compiled Stock Files ##
+
+# A folder of this script's caches under the user's cache folder ($XDG_CACHE_HOME, or ~/.cache), not the working directory
+def user_cache_directory(name):
+  return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'Disposed2BOverconfident', name)
+
+STOCK_CACHE_DIRECTORY = user_cache_directory('stocks')
+STOCK_CACHE_MAX_BYTES = 64 << 20
+# part of every key, so a change of the sidecar layout never reads an old sidecar
+STOCK_CACHE_FORMAT_VERSION = b'stocks-2'
+
+# The record of one stock in a sidecar, for the longest name and price change history of the file
+@lru_cache(maxsize=16)
+def compiledStockType(nameLength, historyLength):
+  return np.dtype([('name', f'U{nameLength}'), ('periodGenerated', np.int64),
+                   ('initialPrice', np.int64), ('hasInitialPrice', np.bool_),
+                   ('quality', np.int8), ('historyLength', np.int16), ('priceChangeHistory', np.int8, (historyLength,)),
+                   ('periodSold', np.int64), ('hasPeriodSold', np.bool_), ('testing', np.bool_), ('pathSeed', np.uint64), ('hasPathSeed', np.bool_)])
+
+"""
+Caches the stocks of .json files as compiled binary sidecars, so that a file re-read by the tests or by a
+scenario replay skips the JSON parse. A sidecar is a one-line JSON header with the record layout
+(see compiledStockType) followed by the raw stock records, keyed by the hash of the file's content: editing a file changes its key, so a stale sidecar is never read and just ages out.
+The cache is capped at maxBytes; the least recently used sidecars (by modification time, which a hit
+refreshes) are evicted first. Files that do not only hold stocks, or whose stocks do not fit the layout, are
+read from JSON every time; a sidecar that cannot be read is compiled again, and one that cannot be written
+(a read-only or misplaced cache directory) is skipped, since the parsed objects are all the caller needs.
+"""
+class CompiledStockCache(object):
+  def __init__(self, directory = STOCK_CACHE_DIRECTORY, maxBytes = STOCK_CACHE_MAX_BYTES):
+    self.directory = directory
+    self.maxBytes = maxBytes
+    self.hits = 0
+    self.misses = 0
+
+  def sidecarPath(self, source):
+    return os.path.join(self.directory, hashlib.sha256(STOCK_CACHE_FORMAT_VERSION + source).hexdigest() + '.stocks')
+
+  # The objects of a .json file, as a list
+  def readObjects(self, fileName):
+    with open(fileName, "rb") as jsonFile:
+      source = jsonFile.read()
+    path = self.sidecarPath(source)
+    try:
+      stocks = self.__readSidecar(path)
+    except (OSError, ValueError, KeyError):
+      stocks = None
+    if (stocks is not None):
+      try:
+        os.utime(path)
+      except OSError:
+        pass
+      self.hits += 1
+      return stocks
+
+    self.misses += 1
+    objects = json.loads(source, object_hook=convertDictToObject)
+    if (isinstance(objects, list) and all(type(stock) is Stock for stock in objects)):
+      try:
+        stockTable = self.__compile(objects)
+      except (TypeError, ValueError, OverflowError):
+        stockTable = None
+      if (stockTable is not None):
+        try:
+          self.__writeSidecar(path, stockTable)
+          self.__evict(path)
+        except OSError:
+          pass
+    return objects
+
+  def __compile(self, stocks):
+    historyLength = max([len(stock.priceChangeHistory) for stock in stocks if stock.priceChangeHistory is not None], default = 0)
+    nameLength = max([len(stock.name) for stock in stocks], default = 1)
+    stockTable = np.zeros(len(stocks), dtype = compiledStockType(max(nameLength, 1), historyLength))
+    for i, stock in enumerate(stocks):
+      if (type(stock.name) is not str or type(stock.periodGenerated) is not int or type(stock.testing) is not bool):
+        raise TypeError(f'stock {stock.name} does not fit the compiled layout')
+      row = stockTable[i]
+      row['name'] = stock.name
+      row['periodGenerated'] = stock.periodGenerated
+      row['hasInitialPrice'] = stock.initialPrice is not None
+      row['initialPrice'] = stock.initialPrice or 0
+      row['quality'] = -1 if stock.qualityFlag is None else stock.qualityFlag
+      row['historyLength'] = -1 if stock.priceChangeHistory is None else len(stock.priceChangeHistory)
+      if (stock.priceChangeHistory is not None):
+        row['priceChangeHistory'][:len(stock.priceChangeHistory)] = stock.priceChangeHistory
+      row['hasPeriodSold'] = stock.periodSold is not None
+      row['periodSold'] = stock.periodSold or 0
+      row['testing'] = stock.testing
+      row['hasPathSeed'] = stock.pathSeed is not None
+      row['pathSeed'] = stock.pathSeed or 0
+    return stockTable
+
+  # np.load would parse the record layout with every read, which costs more than the JSON of a small file
+  def __readSidecar(self, path):
+    with open(path, "rb") as sidecarFile:
+      header = json.loads(sidecarFile.readline())
+      stockType = compiledStockType(header["nameLength"], header["historyLength"])
+      stockTable = np.frombuffer(sidecarFile.read(), dtype = stockType)
+    if (len(stockTable) != header["numStocks"]):
+      raise ValueError(f'{path} is truncated')
+    columns = {name: stockTable[name].tolist() for name in stockTable.dtype.names if name != 'priceChangeHistory'}
+    histories = stockTable['priceChangeHistory']
+    # the price index of every full-length history in one array call, as a market builds its stocks (see Market.stockAt)
+    priceIndex = priceIndexArrays(histories)
+    gainerScores = (histories[:, :WARM_UP_PERIODS] >= 0).sum(axis=1).tolist()
+    stocks = []
+    for i, (name, periodGenerated, initialPrice, hasInitialPrice, quality, historyLength, periodSold, hasPeriodSold, testing, pathSeed, hasPathSeed) in enumerate(zip(
+        columns['name'], columns['periodGenerated'], columns['initialPrice'], columns['hasInitialPrice'], columns['quality'],
+        columns['historyLength'], columns['periodSold'], columns['hasPeriodSold'], columns['testing'], columns['pathSeed'], columns['hasPathSeed'])):
+      if (historyLength == histories.shape[1] and quality >= 0):
+        stock = Stock.fromArrays(name, periodGenerated, quality, histories[i], priceIndex[i], gainerScores[i], pathSeed if hasPathSeed else None)
+        stock.initialPrice = initialPrice if hasInitialPrice else None
+        stock.periodSold = periodSold if hasPeriodSold else None
+        stock.testing = testing
+      else:
+        stock = Stock(name, periodGenerated, initialPrice if hasInitialPrice else None, None if quality < 0 else QUALITY_NAMES[quality],
+                      None if historyLength < 0 else histories[i, :historyLength].tobytes(), testing, periodSold if hasPeriodSold else None, pathSeed if hasPathSeed else None)
+      stocks.append(stock)
+    return stocks
+
+  # Written to a temporary file first, so a reader never sees half a sidecar
+  def __writeSidecar(self, path, stockTable):
+    os.makedirs(self.directory, exist_ok = True)
+    sidecarFile = tempfile.NamedTemporaryFile(dir = self.directory, suffix = '.tmp', delete = False)
+    try:
+      with sidecarFile:
+        header = {"nameLength": stockTable.dtype['name'].itemsize // 4, "historyLength": stockTable.dtype['priceChangeHistory'].shape[0], "numStocks": len(stockTable)}
+        sidecarFile.write(json.dumps(header).encode() + b"\n")
+        sidecarFile.write(stockTable.tobytes())
+      os.replace(sidecarFile.name, path)
+    except OSError:
+      # a full disk leaves no half-written temporary file behind
+      try:
+        os.remove(sidecarFile.name)
+      except OSError:
+        pass
+      raise
+
+  # Removes the least recently used sidecars until the cache fits maxBytes, keeping the one just written
+  def __evict(self, keepPath):
+    with os.scandir(self.directory) as entries:
+      sidecars = sorted(((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries if entry.name.endswith('.stocks')))
+    totalBytes = sum(size for modified, size, path in sidecars)
+    for modified, size, path in sidecars:
+      if (totalBytes <= self.maxBytes):
+        break
+      if (path != keepPath):
+        os.remove(path)
+        totalBytes -= size
+
+Market.stockCache = CompiledStockCache()
 
+# %%
+"""
+Buy and sell strategies, registered by name (see registerBuyStrategy and registerSellStrategy). A strategy picks
+from arrays over a batch of investors, so the batch engine runs it on all its investors at once and the object
+engine on one investor at a time (a batch of one):
+- a buy strategy, pick(warmUpPriceChanges, numStocks, keys), gets the warm-up price changes of the candidate stocks
+  (investors x candidates x WARM_UP_PERIODS, all of a stock's history there is when it is bought) and returns the
+  indices of the numStocks different candidates each investor buys (investors x numStocks)
+- a sell strategy, pick(priceChanges, keys), gets the totalPriceChangeInPeriod of each holding for the period of
+  the sale (investors x holdings) and returns the index of the holding each investor sells (investors)
+keys(numKeys) draws numKeys iid uniform random numbers per investor (investors x numKeys), for strategies that
+pick at random; each engine draws them from its own random source.
+objectPick is an optional pick for the object engine, with the same distribution, that works on the Market and
+Portfolio directly, so it need not build arrays over the whole market for every buy or over the holdings for every
+sale: (market, numStocks) -> stocks for a buy strategy and (portfolio, period) -> holding for a sell strategy.
+The built-in strategies have one, which reaches the market's cached top gainers, its sampling of only the
+drawn stocks and the portfolio's gainer and loser partitions.
+version is part of the result cache key of a run with the strategy (see ResultCache): increase it with any change
+to what the strategy picks, so cached results of the old strategy are not handed out.
+"""
+Strategy = namedtuple('Strategy', ['name', 'pick', 'objectPick', 'version'], defaults = (None, 1))
+
+BUY_STRATEGIES = {}
+SELL_STRATEGIES = {}
+
+# Decorator registering a function as the pick of the buy strategy name
+def registerBuyStrategy(name, objectPick = None, version = 1):
+  def register(pick):
+    BUY_STRATEGIES[name] = Strategy(name, pick, objectPick, version)
+    return pick
+  return register
+
+# Decorator registering a function as the pick of the sell strategy name
+def registerSellStrategy(name, objectPick = None, version = 1):
+  def register(pick):
+    SELL_STRATEGIES[name] = Strategy(name, pick, objectPick, version)
+    return pick
+  return register
+
+# Per row, a uniform pick among the candidates (a boolean matrix), or among all columns of a row without any, with one key per row:
+# the key picks the position among the row's candidates, and the running count of the candidates finds its column
+def pickAmong(candidates, keys):
+  candidates = np.where(candidates.any(axis=1, keepdims=True), candidates, True)
+  chosen = (keys(1)[:, 0] * candidates.sum(axis=1)).astype(np.int64)
+  return np.argmax(np.cumsum(candidates, axis=1) > chosen[:, None], axis=1)
+
+# A buy picks numStocks different candidates, so there have to be that many: raises random.sample's error otherwise
+def checkSampleSize(numCandidates, numStocks):
+  if (not 0 <= numStocks <= numCandidates):
+    raise ValueError(f"Sample larger than population or is negative: {numStocks} stocks from {numCandidates}")
+
+# numKeys iid uniform keys for one investor (a batch of one) from the random module, which the object engine's investors draw from
+def randomKeys(numKeys):
+  return np.fromiter((random.random() for _ in range(numKeys)), dtype = np.float64, count = numKeys).reshape(1, numKeys)
+
+# like random.sample: a partial Fisher-Yates shuffle of each row's candidates, numStocks steps of one key each
+@registerBuyStrategy('RANDOM', objectPick = lambda market, numStocks: market.sampleStocks(numStocks))
+def buyRandom(warmUpPriceChanges, numStocks, keys):
+  numInvestors, numCandidates = warmUpPriceChanges.shape[:2]
+  draws = keys(numStocks)
+  order = np.tile(np.arange(numCandidates), (numInvestors, 1))
+  investors = np.arange(numInvestors)
+  for step in range(numStocks):
+    swap = step + (draws[:, step] * (numCandidates - step)).astype(np.int64)
+    order[investors, step], order[investors, swap] = order[investors, swap], order[investors, step]
+  return order[:, :numStocks]
+
+# stocks with most up ticks, i.e., price increases (gainsPrevious), ties in market order (see topScoreIndices)
+@registerBuyStrategy('BUY_GAINERS', objectPick = lambda market, numStocks: market.topGainers(numStocks))
+def buyGainers(warmUpPriceChanges, numStocks, keys):
+  return topScoreIndices((warmUpPriceChanges >= 0).sum(axis=2), numStocks)
+
+# The portfolio keeps its gainers and losers for the current period, so one of them is chosen randomly without filtering
+def choiceOrRandomHolding(portfolio, candidates):
+  if (len(candidates) > 0):
+    return candidates.choice()
+  return portfolio.randomHolding()
+
+@registerSellStrategy('RANDOM', objectPick = lambda portfolio, period: portfolio.randomHolding())
+def sellRandom(priceChanges, keys):
+  return (keys(1)[:, 0] * priceChanges.shape[1]).astype(np.int64)
+
+# stocks with current price > starting price, any stock if there is none
+@registerSellStrategy('SELL_GAINERS', objectPick = lambda portfolio, period: choiceOrRandomHolding(portfolio, portfolio.gainers(period)))
+def sellGainers(priceChanges, keys):
+  return pickAmong(priceChanges > 0, keys)
+
+# stocks with current price < starting price, any stock if there is none
+@registerSellStrategy('SELL_LOSERS', objectPick = lambda portfolio, period: choiceOrRandomHolding(portfolio, portfolio.losers(period)))
+def sellLosers(priceChanges, keys):
+  return pickAmong(priceChanges < 0, keys)
+
+# The built-in strategies under their names before the registries, for code that names them this way; strategies are looked up by name
 class BuyStrategy(Enum):
   RANDOM = 1
   BUY_GAINERS = 2 # stocks with most up ticks, i.e., price increases
@@ -312,6 +1172,206 @@ class SellStrategy(Enum):
   SELL_GAINERS = 2 # stocks with current price > starting price
   SELL_LOSERS  = 3 # stocks with current price < starting price
 
+"""
+A set that supports O(1) add, remove and uniform random choice: items are kept in a list and each item's
+index in a dict, and removing an item moves the last item into its slot.
+"""
+class IndexedSet(object):
+  __slots__ = ('items', '_indices')
+
+  def __init__(self, items = ()):
+    self.items = []
+    self._indices = {}
+    for item in items:
+      self.add(item)
+
+  def __len__(self):
+    return len(self.items)
+
+  def __contains__(self, item):
+    return item in self._indices
+
+  def __iter__(self):
+    return iter(self.items)
+
+  def add(self, item):
+    if (item not in self._indices):
+      self._indices[item] = len(self.items)
+      self.items.append(item)
+
+  def remove(self, item):
+    index = self._indices.pop(item)
+    lastItem = self.items.pop()
+    if (index < len(self.items)):
+      self.items[index] = lastItem
+      self._indices[lastItem] = index
+
+  def choice(self):
+    return random.choice(self.items)
+
+"""
+An investor's holdings (Positions, or Stocks read from a test file) in the order they were bought.
+Besides the holdings, the portfolio keeps them partitioned into gainers, losers and flat stocks by their
+totalPriceChangeInPeriod for one period. The partition is built on the first query for a period and then
+kept up to date as holdings are appended and removed, so the sell strategies pick from it in O(1).
+For the result metrics it also keeps running counts of good stocks and, for the partition period,
+the total price change and upticks of the holdings.
+"""
+class Portfolio(object):
+  def __init__(self, holdings = ()):
+    self._holdings = {}           # dict as an insertion-ordered set
+    self._allHoldings = IndexedSet()
+    self.numGood = 0
+    self.numGoodInitial = 0       # good stocks generated in period 1
+    self._partitionPeriod = None
+    self._periodValues = {}       # holding -> (totalPriceChangeInPeriod, numUpticksInPeriod) for self._partitionPeriod
+    self._totalPriceChange = 0
+    self._totalUpticks = 0
+    self._gainers = IndexedSet()
+    self._losers = IndexedSet()
+    self._flat = IndexedSet()
+    for holding in holdings:
+      self.append(holding)
+
+  def __iter__(self):
+    return iter(self._holdings)
+
+  def __len__(self):
+    return len(self._holdings)
+
+  def __contains__(self, holding):
+    return holding in self._holdings
+
+  def __getitem__(self, index):
+    return list(self._holdings)[index]
+
+  def copy(self):
+    return list(self._holdings)
+
+  def append(self, holding):
+    if (holding in self._holdings):
+      return
+    self._holdings[holding] = None
+    self._allHoldings.add(holding)
+    self.__countQuality(holding, 1)
+    if (self._partitionPeriod is not None):
+      self.__classify(holding)
+
+  def remove(self, holding):
+    del self._holdings[holding]
+    self._allHoldings.remove(holding)
+    self.__countQuality(holding, -1)
+    if (self._partitionPeriod is not None):
+      priceChange, upticks = self._periodValues.pop(holding)
+      self._totalPriceChange -= priceChange
+      self._totalUpticks -= upticks
+      self.__partitionOf(priceChange).remove(holding)
+
+  def randomHolding(self):
+    return self._allHoldings.choice()
+
+  def gainers(self, period):
+    self.__partitionForPeriod(period)
+    return self._gainers
+
+  def losers(self, period):
+    self.__partitionForPeriod(period)
+    return self._losers
+
+  def flat(self, period):
+    self.__partitionForPeriod(period)
+    return self._flat
+
+  # sum of totalPriceChangeInPeriod(period) over the holdings
+  def totalPriceChange(self, period):
+    self.__partitionForPeriod(period)
+    return self._totalPriceChange
+
+  # sum of numUpticksInPeriod(period) over the holdings
+  def totalUpticks(self, period):
+    self.__partitionForPeriod(period)
+    return self._totalUpticks
+
+  def __countQuality(self, holding, count):
+    if (holding.quality == 'good'):
+      self.numGood += count
+      if (holding.periodGenerated == 1):
+        self.numGoodInitial += count
+
+  def __partitionOf(self, priceChange):
+    if (priceChange > 0):
+      return self._gainers
+    elif (priceChange < 0):
+      return self._losers
+    return self._flat
+
+  def __classify(self, holding):
+    priceChange = holding.totalPriceChangeInPeriod(self._partitionPeriod)
+    upticks = holding.numUpticksInPeriod(self._partitionPeriod)
+    self._periodValues[holding] = (priceChange, upticks)
+    self._totalPriceChange += priceChange
+    self._totalUpticks += upticks
+    self.__partitionOf(priceChange).add(holding)
+
+  # price changes move every period, so advancing the period repartitions the holdings once
+  def __partitionForPeriod(self, period):
+    if (period == self._partitionPeriod):
+      return
+    self._partitionPeriod = period
+    self._periodValues = {}
+    self._totalPriceChange = 0
+    self._totalUpticks = 0
+    self._gainers = IndexedSet()
+    self._losers = IndexedSet()
+    self._flat = IndexedSet()
+    for holding in self._holdings:
+      self.__classify(holding)
+
+# realized / (realized + paper), the PGR or PLR of counts (numbers or arrays); nan where nothing was held
+def proportionRealized(realized, paper):
+  with np.errstate(invalid = 'ignore', divide = 'ignore'):
+    return np.float64(realized) / (np.float64(realized) + paper)
+
+"""
+Running totals over an investor's sold stocks, updated once per sale. A sold stock's contribution to the
+result metrics is fixed when it is sold (it is evaluated at periodSold - 1), so none of these need rescanning.
+The disposition effect counts (Odean's realized and paper gains and losses) are taken at every sell decision
+(see recordSellDecision), so they start at 0 for sold stocks assigned from a test file.
+"""
+class InvestorMetrics(object):
+  __slots__ = ('numGoodSold', 'numGoodInitialSold', 'numGainersSold', 'earningsSold', 'upticksSold', 'realizedGains', 'paperGains', 'realizedLosses', 'paperLosses')
+
+  def __init__(self, soldStocks = ()):
+    self.numGoodSold = 0
+    self.numGoodInitialSold = 0
+    self.numGainersSold = 0
+    self.earningsSold = 0
+    self.upticksSold = 0
+    self.realizedGains = 0
+    self.paperGains = 0
+    self.realizedLosses = 0
+    self.paperLosses = 0
+    for soldStock in soldStocks:
+      self.recordSale(soldStock)
+
+  # A sale from numGainers gains and numLosers losses held (by totalPriceChangeInPeriod of the period of the sale)
+  def recordSellDecision(self, numGainers, numLosers, soldGainer, soldLoser):
+    self.realizedGains += soldGainer
+    self.paperGains += numGainers - soldGainer
+    self.realizedLosses += soldLoser
+    self.paperLosses += numLosers - soldLoser
+
+  def recordSale(self, soldStock):
+    if (soldStock.quality == 'good'):
+      self.numGoodSold += 1
+      if (soldStock.periodGenerated == 1):
+        self.numGoodInitialSold += 1
+    earnings = soldStock.totalPriceChangeInPeriod(soldStock.periodSold - 1)
+    if (earnings > 0):
+      self.numGainersSold += 1
+    self.earningsSold += earnings
+    self.upticksSold += soldStock.numUpticksInPeriod(soldStock.periodSold - 1)
+
 class Investor:
   def __init__(self, name, market, buyStrategy, sellStrategy):
     self.name = name
@@ -321,12 +1381,12 @@ class Investor:
     self.soldStocks = []
 
 
-    if (buyStrategy in BuyStrategy.__members__):
+    if (buyStrategy in BUY_STRATEGIES):
       self.buyStrategy  = buyStrategy
     else:
       print(f'{buyStrategy} is not a valid buying strategy')
 
-    if (sellStrategy in SellStrategy.__members__):
+    if (sellStrategy in SELL_STRATEGIES):
       self.sellStrategy  = sellStrategy
     else:
       print(f'{sellStrategy} is not a valid selling strategy')
@@ -337,14 +1397,42 @@ class Investor:
   def market(self):
     return self.market
 
+  # Assigning a list of holdings (e.g. read from a test file) wraps it in a Portfolio
+  @property
   def portfolio(self):
-    return self.portfolio
+    return self._portfolio
+
+  @portfolio.setter
+  def portfolio(self, holdings):
+    self._portfolio = holdings if isinstance(holdings, Portfolio) else Portfolio(holdings)
 
+  # Assigning the sold stocks (e.g. read from a test file) recomputes the sold stock metrics
+  @property
   def soldStocks(self):
-    return self.soldStocks
+    return self._soldStocks
+
+  @soldStocks.setter
+  def soldStocks(self, soldStocks):
+    self._soldStocks = list(soldStocks)
+    self.metrics = InvestorMetrics(self._soldStocks)
 
   def addStockToPortfolio(self, stock):
-    self.portfolio.append(stock)
+    self.portfolio.append(Position(stock, self.market.currentPeriod))
+
+  # Buying records a Position on the market's shared stock; the stock itself is never copied or modified
+  def __buyStocks(self, stocks):
+    for stock in stocks:
+      self.addStockToPortfolio(stock)
+
+  # Buys numStocks of the market's stocks picked by the buy strategy (see Strategy), as a batch of one investor unless it has an objectPick
+  def __buyWithStrategy(self, numStocks):
+    strategy = BUY_STRATEGIES[self.buyStrategy]
+    checkSampleSize(self.market.numStocks(), numStocks)
+    if (strategy.objectPick is not None):
+      self.__buyStocks(strategy.objectPick(self.market, numStocks))
+      return
+    picks = strategy.pick(self.market.warmUpPriceChanges()[None], numStocks, randomKeys)
+    self.__buyStocks([self.market.stockAt(index) for index in picks[0].tolist()])
     
   def createInitialPortfolioWithNumStocks(self, numStocks, testing = False, inputTestStockFilename = None):
     # need to test numStocks is within bounds
@@ -352,133 +1440,131 @@ class Investor:
     if (testing == True):
       self.portfolio = self.market.readStocksJSONFromFile(inputTestStockFilename)
     else:
-      if (self.buyStrategy is BuyStrategy.RANDOM.name):
-        self.portfolio = random.sample(self.market.initialStocks, numStocks)
-      elif (self.buyStrategy is BuyStrategy.BUY_GAINERS.name):
-          # Katrin: I changed the buying strategy in order to avoid dups. I use your dictionary approach.
-          stockGainersMarketDict = {}
-          i = 0
-          while (i < (len(self.market.initialStocks))):
-              stockToDict = deepcopy(self.market.initialStocks[i])
-              stockGainersMarketDict[stockToDict] = stockToDict.gainsPrevious()
-              i = i+1
-          
-          self.portfolio = sorted(stockGainersMarketDict, reverse=True, key=stockGainersMarketDict.__getitem__)[:numStocks]              
-      # Matt: add conditions and code for other stradegies here
-      # Katrin: I added the buying gainers strategy. We do not need a buying losers strategy.
+      self.portfolio = []
+      # strategies are registered with registerBuyStrategy, see Strategy
+      if (self.buyStrategy in BUY_STRATEGIES):
+        self.__buyWithStrategy(numStocks)
       else: 
           print ("Invalid strategy")
 
 
 # Buying stock following the initial period (buy one stock)
   def createPeriodPortfolioWithNumStocks(self, numStocks):
-    if (self.buyStrategy is BuyStrategy.RANDOM.name):
-      tempPortfolio = random.sample(self.market.initialStocks, numStocks)
-      for thisStock in tempPortfolio:
-        self.portfolio.append(thisStock)
-    elif (self.buyStrategy is BuyStrategy.BUY_GAINERS.name):
-        stockGainersMarketDict = {}
-        i = 0
-        while (i < (len(self.market.initialStocks))):
-            stockToDict = deepcopy(self.market.initialStocks[i])
-            stockGainersMarketDict[stockToDict] = stockToDict.gainsPrevious()
-            i = i+1
-        
-        tempPortfolio = sorted(stockGainersMarketDict, reverse=True, key=stockGainersMarketDict.__getitem__)[:numStocks]
-        for thisStock in tempPortfolio:
-          self.portfolio.append(thisStock)
-
+    if (self.buyStrategy in BUY_STRATEGIES):
+      self.__buyWithStrategy(numStocks)
     else: 
         print ("Invalid buying strategy")
 
 # Selling strategies
 # Remove stock from investor portfolio, add the selling period as info, and append it to the "sold stocks" list in order to keep track of the sold stocks
   def sellStocks(self, numStocks):
-    if (self.sellStrategy is SellStrategy.RANDOM.name):
-      randomStockFromPortfolio = random.choice(self.portfolio)
-      randomStockFromPortfolio.periodSold = self.market.currentPeriod
-      self.portfolio.remove(randomStockFromPortfolio)
-      self.soldStocks.append(randomStockFromPortfolio)
-
-# I create a copy of the portfolio with only the gainers or only the losers and then choose one stock randomly
-    elif (self.sellStrategy is SellStrategy.SELL_GAINERS.name):
-      gainersPortfolioDict = self.portfolio.copy()
-      for currentStock in self.portfolio:
-        if currentStock.totalPriceChangeInPeriod(self.market.currentPeriod) <= 0:
-          gainersPortfolioDict.remove(currentStock)
-      if len(gainersPortfolioDict) > 0:
-        pickGainerStockFromPortfolio = random.choice(gainersPortfolioDict)
-        pickGainerStockFromPortfolio.periodSold = self.market.currentPeriod
-        self.portfolio.remove(pickGainerStockFromPortfolio)
-        self.soldStocks.append(pickGainerStockFromPortfolio)
-      else:
-        randomStockFromPortfolio = random.choice(self.portfolio)
-        randomStockFromPortfolio.periodSold = self.market.currentPeriod
-        self.portfolio.remove(randomStockFromPortfolio)
-        self.soldStocks.append(randomStockFromPortfolio)
-
-    elif (self.sellStrategy is SellStrategy.SELL_LOSERS.name):
-      losersPortfolioDict = self.portfolio.copy()
-      for currentStock in self.portfolio:
-        if currentStock.totalPriceChangeInPeriod(self.market.currentPeriod) >= 0:
-          losersPortfolioDict.remove(currentStock)
-      if len(losersPortfolioDict) > 0:
-        pickLoserStockFromPortfolio = random.choice(losersPortfolioDict)
-        pickLoserStockFromPortfolio.periodSold = self.market.currentPeriod
-        self.portfolio.remove(pickLoserStockFromPortfolio)
-        self.soldStocks.append(pickLoserStockFromPortfolio)
-      else:
-        randomStockFromPortfolio = random.choice(self.portfolio)
-        randomStockFromPortfolio.periodSold = self.market.currentPeriod
-        self.portfolio.remove(randomStockFromPortfolio)
-        self.soldStocks.append(randomStockFromPortfolio)
-    
-    else:
+    currentPeriod = self.market.currentPeriod
+    strategy = SELL_STRATEGIES.get(self.sellStrategy)
+    if (strategy is None):
       print ("Invalid selling strategy")
+      return
 
-  def buyStrategy(self):
+    # the strategy picks from the holdings' price changes as a batch of one investor, unless it has an objectPick
+    if (strategy.objectPick is not None):
+      stockToSell = strategy.objectPick(self.portfolio, currentPeriod)
+    else:
+      holdings = self.portfolio.copy()
+      priceChanges = np.array([[holding.totalPriceChangeInPeriod(currentPeriod) for holding in holdings]])
+      stockToSell = holdings[int(strategy.pick(priceChanges, randomKeys)[0])]
+
+    # gains and losses held when the sale is decided, as the sell strategies see them
+    gainers = self.portfolio.gainers(currentPeriod)
+    losers = self.portfolio.losers(currentPeriod)
+    self.metrics.recordSellDecision(len(gainers), len(losers), stockToSell in gainers, stockToSell in losers)
+    self.portfolio.remove(stockToSell)
+    stockToSell.periodSold = currentPeriod
+    self.soldStocks.append(stockToSell)
+    self.metrics.recordSale(stockToSell)
+
+  def buyStrategy(self):
     return self.buyStrategy
 
   def sellStrategy(self):
     return self.sellStrategy
 
+  # The result metrics read the running counters of the sold stocks (self.metrics) and of the portfolio
   def numGoodStocksSold(self):
-    numGoodStock = sum(soldStock.quality == 'good' for soldStock in self.soldStocks)
-    return numGoodStock
+    return self.metrics.numGoodSold
 
   def numGoodStocksInitial(self):
-    numGoodStockSoldFromPeriod1 = sum((soldStock.quality == 'good' and soldStock.periodGenerated == 1) for soldStock in self.soldStocks)
-    numGoodStocksInPortfolioFromPeriod1 = sum((stock.quality == 'good' and stock.periodGenerated == 1) for stock in self.portfolio)
-    numGoodStocksInitial = numGoodStockSoldFromPeriod1 + numGoodStocksInPortfolioFromPeriod1
-    return numGoodStocksInitial
+    return self.metrics.numGoodInitialSold + self.portfolio.numGoodInitial
 
   def numGoodStocksEnd(self):
-    numGoodStocksInPortfolio = sum((stock.quality == 'good') for stock in self.portfolio)
-    return numGoodStocksInPortfolio
+    return self.portfolio.numGood
 
   def numGoodStocksPicked(self):
     numGoodStocksPicked = self.numGoodStocksEnd() + self.numGoodStocksSold()
     return numGoodStocksPicked
 
   def numGainersSold(self):
-    numGainersSold = sum(soldStock.totalPriceChangeInPeriod(soldStock.periodSold - 1) > 0 for soldStock in self.soldStocks)
-    return numGainersSold
+    return self.metrics.numGainersSold
 
   def numGainersInPortfolio(self):
-    numGainersInPortfolio = sum(stock.totalPriceChangeInPeriod(self.market.currentPeriod) > 0 for stock in self.portfolio)
-    return numGainersInPortfolio
+    return len(self.portfolio.gainers(self.market.currentPeriod))
 
   def totalEarnings(self):
-    earningsFromSold = sum(soldStock.totalPriceChangeInPeriod(soldStock.periodSold - 1) for soldStock in self.soldStocks)
-    earningsInPortfolio = sum(stock.totalPriceChangeInPeriod(self.market.currentPeriod) for stock in self.portfolio)
-    totalEarnings = earningsFromSold + earningsInPortfolio
-    return totalEarnings
+    return self.metrics.earningsSold + self.portfolio.totalPriceChange(self.market.currentPeriod)
 
   def totalUpticks(self):
-    upticsInSold = sum(sum(priceChange > 0 for priceChange in stock.priceChangeHistory[:(11 - stock.periodGenerated - (7 - stock.periodSold + 1))]) for stock in self.soldStocks)
-    upticsInPortfolio = sum(sum(priceChange > 0 for priceChange in stock.priceChangeHistory[:(11 - stock.periodGenerated - (7 - self.market.currentPeriod))]) for stock in self.portfolio)
-    totalUpticks = upticsInSold + upticsInPortfolio
-    return totalUpticks   
+    return self.metrics.upticksSold + self.portfolio.totalUpticks(self.market.currentPeriod)
+
+  def realizedGains(self):
+    return self.metrics.realizedGains
+
+  def paperGains(self):
+    return self.metrics.paperGains
+
+  def realizedLosses(self):
+    return self.metrics.realizedLosses
+
+  def paperLosses(self):
+    return self.metrics.paperLosses
+
+  # proportion of gains realized: realized gains / (realized + paper gains), nan without any gain held at a sale
+  def pgr(self):
+    return proportionRealized(self.realizedGains(), self.paperGains())
+
+  # proportion of losses realized
+  def plr(self):
+    return proportionRealized(self.realizedLosses(), self.paperLosses())
+
+  # PGR - PLR, positive for an investor who realizes gains more readily than losses
+  def dispositionEffect(self):
+    return self.pgr() - self.plr()
+
+  """
+  The result metrics computed by scanning portfolio and soldStocks, the way they were computed before the
+  running counters. Only used to check the counters.
+  """
+  def scanMetrics(self):
+    currentPeriod = self.market.currentPeriod
+    numGoodStocksSold = sum(soldStock.quality == 'good' for soldStock in self.soldStocks)
+    numGoodStocksEnd = sum((stock.quality == 'good') for stock in self.portfolio)
+    return {
+      "numGoodStocksInitial": sum((stock.quality == 'good' and stock.periodGenerated == 1) for stock in list(self.soldStocks) + list(self.portfolio)),
+      "numGoodStocksSold": numGoodStocksSold,
+      "numGoodStocksEnd": numGoodStocksEnd,
+      "numGoodStocksPicked": numGoodStocksEnd + numGoodStocksSold,
+      "numGainersSold": sum(soldStock.totalPriceChangeInPeriod(soldStock.periodSold - 1) > 0 for soldStock in self.soldStocks),
+      "numGainersInPortfolio": sum(stock.totalPriceChangeInPeriod(currentPeriod) > 0 for stock in self.portfolio),
+      "totalEarnings": sum(soldStock.totalPriceChangeInPeriod(soldStock.periodSold - 1) for soldStock in self.soldStocks) + sum(stock.totalPriceChangeInPeriod(currentPeriod) for stock in self.portfolio),
+      "totalUpticks": sum(stock.numUpticksInPeriod(stock.periodSold - 1) for stock in self.soldStocks) + sum(stock.numUpticksInPeriod(currentPeriod) for stock in self.portfolio)
+    }
+
+  # Raises an AssertionError naming every metric whose counter disagrees with a full scan
+  def checkMetricsConsistency(self):
+    mismatches = {}
+    for metricName, scannedValue in self.scanMetrics().items():
+      countedValue = getattr(self, metricName)()
+      if (countedValue != scannedValue):
+        mismatches[metricName] = (countedValue, scannedValue)
+    if (len(mismatches) > 0):
+      raise AssertionError(f'{self.name}: metric counters differ from a full scan (counter, scan): {mismatches}')
     
   def description(self):    
     print(f'Investor: {self.name}')
@@ -488,7 +1574,7 @@ class Investor:
     if (len(self.portfolio) == 0):
       print("    No stocks in portfolio")
     else:
-      for stock in self.portfolio[:]:
+      for stock in self.portfolio:
         stock.description()
     
     if (len(self.soldStocks) == 0):
@@ -499,7 +1585,7 @@ class Investor:
 
   @classmethod
   def headerCSV(self):
-    csvHeader = "investorName" + CSV_DELIMITER + "marketName" + CSV_DELIMITER + "buyStrategy" + CSV_DELIMITER + "sellStrategy" + CSV_DELIMITER + "numGoodStocksInitial" + CSV_DELIMITER + "numGoodStocksSold" + CSV_DELIMITER + "numGoodStocksEnd" + CSV_DELIMITER + "numGoodStocksPicked" + CSV_DELIMITER + "numGainersSold" + CSV_DELIMITER + "numGainersInPortfolio" + CSV_DELIMITER + "totalEarnings" + CSV_DELIMITER + "totalUpticks"
+    csvHeader = "investorName" + CSV_DELIMITER + "marketName" + CSV_DELIMITER + "buyStrategy" + CSV_DELIMITER + "sellStrategy" + CSV_DELIMITER + "numGoodStocksInitial" + CSV_DELIMITER + "numGoodStocksSold" + CSV_DELIMITER + "numGoodStocksEnd" + CSV_DELIMITER + "numGoodStocksPicked" + CSV_DELIMITER + "numGainersSold" + CSV_DELIMITER + "numGainersInPortfolio" + CSV_DELIMITER + "totalEarnings" + CSV_DELIMITER + "totalUpticks" + CSV_DELIMITER + "realizedGains" + CSV_DELIMITER + "paperGains" + CSV_DELIMITER + "realizedLosses" + CSV_DELIMITER + "paperLosses"
     return csvHeader
 
   @classmethod
@@ -507,31 +1593,1770 @@ class Investor:
     return Investor.headerCSV() + CSV_DELIMITER + Stock.headerCSV()
 
   def descriptionCSV(self):
-    descCSVString = self.name + CSV_DELIMITER + self.market.name + CSV_DELIMITER + self.buyStrategy + CSV_DELIMITER + self.sellStrategy + CSV_DELIMITER + str(self.numGoodStocksInitial()) + CSV_DELIMITER + str(self.numGoodStocksSold()) + CSV_DELIMITER + str(self.numGoodStocksEnd()) + CSV_DELIMITER + str(self.numGoodStocksPicked()) + CSV_DELIMITER + str(self.numGainersSold()) + CSV_DELIMITER + str(self.numGainersInPortfolio()) + CSV_DELIMITER + str(self.totalEarnings()) + CSV_DELIMITER + str(self.totalUpticks())
-    return descCSVString
+    return CSV_DELIMITER.join(self.csvRow())
     
   def descriptionCSVAllStocks(self):
-    CSVresult = ""
-    investorDescriptionCSV = self.descriptionCSV()
+    return "".join(CSV_DELIMITER.join(stockRow) + "\n" for stockRow in self.csvRowsAllStocks())
+
+  # The fields of descriptionCSV, for a csv writer
+  def csvRow(self):
+    return [self.name, self.market.name, self.buyStrategy, self.sellStrategy, str(self.numGoodStocksInitial()), str(self.numGoodStocksSold()), str(self.numGoodStocksEnd()),
+            str(self.numGoodStocksPicked()), str(self.numGainersSold()), str(self.numGainersInPortfolio()), str(self.totalEarnings()), str(self.totalUpticks()),
+            str(self.realizedGains()), str(self.paperGains()), str(self.realizedLosses()), str(self.paperLosses())]
+
+  # The rows of descriptionCSVAllStocks as lists of fields: the investor's fields followed by one stock's, portfolio first
+  def csvRowsAllStocks(self):
+    investorRow = self.csvRow()
+    lastPeriod = self.market.currentPeriod
     for currentStock in self.portfolio:
-      stockCSV = investorDescriptionCSV + CSV_DELIMITER + currentStock.descriptionCSV() + "\n"
-      CSVresult = CSVresult + stockCSV
+      yield investorRow + currentStock.csvRow(lastPeriod)
     for currentStock in self.soldStocks:
-      stockCSV = investorDescriptionCSV + CSV_DELIMITER + currentStock.descriptionCSV() + "\n"
-      CSVresult = CSVresult + stockCSV
+      yield investorRow + currentStock.csvRow(lastPeriod)
+
+# %%
+## Batch Engine ##
+
+"""
+Simulates all investors of an experiment at once with array operations instead of Investor objects.
+Every stock the experiment generates is a row of one set of stock arrays (the universe): the initial market
+followed by each period's new stocks, once for a shared market or once per investor for individual markets.
+Holdings are an (investor x slot) matrix of universe rows, and each period's sell and buy is a masked
+operation across all investors. The rules are the object engine's (see simulate_investors) and the CSV
+columns are those of Investor.headerCSV / headerCSVAllStocks. The random numbers are drawn differently,
+so the two engines agree in distribution, not run by run. firstInvestor offsets the investor and market names
+(investor<firstInvestor> is the first one) when the engine runs one shard of a larger experiment.
+snapshot and replay write and read the universe as the markets' batches (see Market), in the order the object
+engine generates them, so either engine can replay the other's markets.
+The universe keeps the recorded price changes and path seed of each stock. The engine keeps a running total price
+change and upticks count per holding, adding the price change of each period, so only the prices of the stocks held
+are looked up and later ones are drawn from their seeds: memory does not grow with the number of periods.
+"""
+class BatchEngine(object):
+  def __init__(self, useSharedMarket, buyStrategy, sellStrategy, numInvestors, numPeriods, portfolioSize, newStocksPerPeriod, rng = None, marketNameBase = "market", firstInvestor = 0, snapshot = None, replay = None):
+    if (portfolioSize < 1 or portfolioSize > numPeriods):
+      raise ValueError(f'portfolioSize must be between 1 and the initial market size ({numPeriods}), got {portfolioSize}')
+    if (newStocksPerPeriod < 1):
+      raise ValueError(f'newStocksPerPeriod must be at least 1, got {newStocksPerPeriod}')
+    self.useSharedMarket = useSharedMarket
+    self.buyStrategy = buyStrategy
+    self.sellStrategy = sellStrategy
+    self.numInvestors = numInvestors
+    self.numPeriods = numPeriods
+    self.portfolioSize = portfolioSize
+    self.newStocksPerPeriod = newStocksPerPeriod
+    self.rng = rng if rng is not None else RNG
+    self.marketNameBase = marketNameBase
+    self.firstInvestor = firstInvestor
+    self.snapshot = snapshot
+    self.replay = replay
+    # the initial market has numPeriods stocks, as in market_experiment, and each later period adds newStocksPerPeriod
+    self.marketSize = numPeriods + newStocksPerPeriod * (numPeriods - 1)
+
+  def run(self):
+    numInvestors = self.numInvestors
+    numPeriods = self.numPeriods
+    numNewStocks = self.newStocksPerPeriod
+    numMarkets = 1 if self.useSharedMarket else numInvestors
+    rng = self.rng
+
+    # the stock universe, one block of marketSize rows per market
+    marketNames = [self.marketName(self.firstInvestor + market) for market in range(numMarkets)]
+    batchSizes = [numPeriods] + [numNewStocks] * (numPeriods - 1)
+    if (self.replay is not None):
+      self.quality, self.priceChangeHistory, self.pathSeed = self.replay.readUniverse(marketNames, batchSizes)
+    else:
+      self.quality, self.priceChangeHistory, self.pathSeed = generateStockPaths(numMarkets * self.marketSize, rng)
+    if (self.snapshot is not None):
+      self.snapshot.writeUniverse(marketNames, batchSizes, self.quality, self.priceChangeHistory, self.pathSeed)
+    periodGeneratedInMarket = np.concatenate((np.ones(numPeriods), np.repeat(np.arange(2, numPeriods + 1), numNewStocks)))
+    self.periodGenerated = np.tile(periodGeneratedInMarket, numMarkets).astype(np.int32)
+    # a market hands out stock IDs in the order of its batches (see Market.allocateStockIds), which is the order of its rows
+    self.stockId = np.tile(np.arange(self.marketSize, dtype=np.int64), numMarkets)
+
+    # the warm-up price changes, as in Stock
+    warmUp = self.priceChangeHistory[:, :WARM_UP_PERIODS]
+    self.gainsPrevious = (warmUp >= 0).sum(axis=1)
+    self.warmUpUpticks = (warmUp > 0).sum(axis=1)
+
+    # first universe row of each investor's market
+    marketStart = np.zeros(numInvestors, dtype=np.int64) if self.useSharedMarket else np.arange(numInvestors, dtype=np.int64) * self.marketSize
+    investors = np.arange(numInvestors)
+
+    # period 1: buy portfolioSize stocks from the initial market
+    initialStocks = marketStart[:, None] + np.arange(numPeriods)
+    picks = self.__pickStocksToBuy(initialStocks, self.portfolioSize)
+    self.holdings = np.take_along_axis(initialStocks, picks, axis=1)
+    # Stock.totalPriceChangeInPeriod and numUpticksInPeriod of the holdings through the current period
+    periodPriceChanges = self.__priceChangesInPeriod(self.holdings, 1)
+    self.heldPriceChange = periodPriceChanges
+    self.heldUpticks = self.warmUpUpticks[self.holdings] + (periodPriceChanges > 0)
+
+    # each later period: sell one stock, then buy one of the period's new stocks into the freed slot
+    self.soldStocks = np.empty((numInvestors, numPeriods - 1), dtype=np.int64)
+    self.periodSold = np.tile(np.arange(2, numPeriods + 1, dtype=np.int32), (numInvestors, 1))
+    # the totals of the sold stocks, through the period before they were sold
+    self.soldPriceChange = np.empty((numInvestors, numPeriods - 1), dtype=np.int64)
+    self.soldUpticks = np.empty((numInvestors, numPeriods - 1), dtype=np.int64)
+    # disposition effect counts of the sell decisions (see InvestorMetrics.recordSellDecision)
+    self.dispositionCounts = {countName: np.zeros(numInvestors, dtype=np.int64) for countName in ("realizedGains", "paperGains", "realizedLosses", "paperLosses")}
+    for period in range(2, numPeriods + 1):
+      periodPriceChanges = self.__priceChangesInPeriod(self.holdings, period)
+      self.heldPriceChange += periodPriceChanges
+      self.heldUpticks += periodPriceChanges > 0
+      priceChanges = self.heldPriceChange
+      slots = self.__pickSellSlots(priceChanges)
+      self.soldStocks[:, period - 2] = self.holdings[investors, slots]
+      soldPriceChange = priceChanges[investors, slots]
+      self.soldPriceChange[:, period - 2] = soldPriceChange - periodPriceChanges[investors, slots]
+      self.soldUpticks[:, period - 2] = self.heldUpticks[investors, slots] - (periodPriceChanges[investors, slots] > 0)
+      self.dispositionCounts["realizedGains"] += soldPriceChange > 0
+      self.dispositionCounts["paperGains"] += (priceChanges > 0).sum(axis=1) - (soldPriceChange > 0)
+      self.dispositionCounts["realizedLosses"] += soldPriceChange < 0
+      self.dispositionCounts["paperLosses"] += (priceChanges < 0).sum(axis=1) - (soldPriceChange < 0)
+
+      newStocks = (marketStart + numPeriods + (period - 2) * numNewStocks)[:, None] + np.arange(numNewStocks)
+      picks = self.__pickStocksToBuy(newStocks, 1)[:, 0]
+      boughtStocks = newStocks[investors, picks]
+      self.holdings[investors, slots] = boughtStocks
+      boughtPriceChanges = self.__priceChangesInPeriod(boughtStocks, period)
+      self.heldPriceChange[investors, slots] = boughtPriceChanges
+      self.heldUpticks[investors, slots] = self.warmUpUpticks[boughtStocks] + (boughtPriceChanges > 0)
+
+    self.__computeMetrics()
+    return self
+
+  # The buy strategy's picks (see Strategy) among candidates, a matrix of universe rows with one row per investor
+  def __pickStocksToBuy(self, candidates, numStocks):
+    checkSampleSize(candidates.shape[1], numStocks)
+    return BUY_STRATEGIES[self.buyStrategy].pick(self.priceChangeHistory[candidates, :WARM_UP_PERIODS], numStocks, lambda numKeys: self.rng.random((len(candidates), numKeys)))
+
+  # The sell strategy's pick (see Strategy) of each investor's holdings, by their price changes through the current period
+  def __pickSellSlots(self, priceChanges):
+    return SELL_STRATEGIES[self.sellStrategy].pick(priceChanges, lambda numKeys: self.rng.random((len(priceChanges), numKeys)))
+
+  """
+  The price change in period of each of an array of universe rows, as an int64 array: read from the recorded history
+  when it holds the period and drawn from the stock's path seed otherwise. A stock replayed without a seed has no
+  price changes past its history, which is how Stock clips its queries.
+  """
+  def __priceChangesInPeriod(self, stocks, period):
+    steps = historyStop(self.periodGenerated[stocks].astype(np.int64), period) - 1
+    historyLength = self.priceChangeHistory.shape[1]
+    priceChanges = self.priceChangeHistory[stocks, np.minimum(steps, historyLength - 1)].astype(np.int64)
+    drawn = steps >= historyLength
+    if (drawn.any()):
+      if (self.pathSeed is None):
+        priceChanges[drawn] = 0
+      else:
+        priceChanges[drawn] = pricePathSteps(self.pathSeed[stocks[drawn]], self.quality[stocks[drawn]], steps[drawn])
+    return priceChanges
+
+  # The Investor.headerCSV metrics for every investor at the end of the run, as int arrays keyed by column name
+  def __computeMetrics(self):
+    goodHeld = self.quality[self.holdings] == QUALITY_GOOD
+    goodSold = self.quality[self.soldStocks] == QUALITY_GOOD
+    heldPriceChange = self.heldPriceChange
+    soldPriceChange = self.soldPriceChange
+    numGoodStocksSold = goodSold.sum(axis=1)
+    numGoodStocksEnd = goodHeld.sum(axis=1)
+    self.metrics = {
+      "numGoodStocksInitial": (goodHeld & (self.periodGenerated[self.holdings] == 1)).sum(axis=1) + (goodSold & (self.periodGenerated[self.soldStocks] == 1)).sum(axis=1),
+      "numGoodStocksSold": numGoodStocksSold,
+      "numGoodStocksEnd": numGoodStocksEnd,
+      "numGoodStocksPicked": numGoodStocksEnd + numGoodStocksSold,
+      "numGainersSold": (soldPriceChange > 0).sum(axis=1),
+      "numGainersInPortfolio": (heldPriceChange > 0).sum(axis=1),
+      "totalEarnings": soldPriceChange.sum(axis=1) + heldPriceChange.sum(axis=1),
+      "totalUpticks": self.soldUpticks.sum(axis=1) + self.heldUpticks.sum(axis=1),
+      **self.dispositionCounts
+    }
+
+  def marketName(self, investorIndex):
+    if (self.useSharedMarket):
+      return self.marketNameBase + '_global'
+    return self.marketNameBase + '_' + str(investorIndex)
+
+  # One Investor.descriptionCSV row per investor
+  def descriptionsCSV(self):
+    for investorRow, stockRows in self.csvRows():
+      yield CSV_DELIMITER.join(investorRow)
+
+  # One Investor.descriptionCSVAllStocks block per investor: its portfolio's stocks, then its sold stocks
+  def descriptionsCSVAllStocks(self):
+    for investorRow, stockRows in self.csvRows():
+      yield "".join(CSV_DELIMITER.join(stockRow) + "\n" for stockRow in stockRows)
+
+  # Per investor, the fields of Investor.csvRow and the rows of Investor.csvRowsAllStocks
+  def csvRows(self):
+    metricColumns = [self.metrics[metricName].tolist() for metricName in Investor.headerCSV().split(CSV_DELIMITER)[4:]]
+    # Investor.csvRowsAllStocks reports the total price change of the stocks through the last period
+    heldPriceChange = self.heldPriceChange.tolist()
+    soldPriceChange = self.soldPriceChange.tolist()
+    holdings = self.holdings.tolist()
+    soldStocks = self.soldStocks.tolist()
+    periodSold = self.periodSold.tolist()
+    for row, metricValues in enumerate(zip(*metricColumns)):
+      investorIndex = self.firstInvestor + row
+      investorRow = ["investor" + str(investorIndex), self.marketName(investorIndex), self.buyStrategy, self.sellStrategy] + [str(value) for value in metricValues]
+      stockRows = []
+      for stock, priceChange in zip(holdings[row], heldPriceChange[row]):
+        stockRows.append(investorRow + self.__stockCSVRow(stock, None, priceChange))
+      for stock, stockPeriodSold, priceChange in zip(soldStocks[row], periodSold[row], soldPriceChange[row]):
+        stockRows.append(investorRow + self.__stockCSVRow(stock, stockPeriodSold, priceChange))
+      yield investorRow, stockRows
+
+  # Per investor, the arrays of the result columns (see resultColumns): investors, then their stocks in csvRows order
+  def resultColumns(self):
+    numInvestors = self.numInvestors
+    investorNumbers = np.arange(self.firstInvestor, self.firstInvestor + numInvestors, dtype = np.int32)
+    investors = {'investorName': investorNumbers,
+                 'marketName': np.full(numInvestors, -1, dtype = np.int32) if self.useSharedMarket else investorNumbers,
+                 'buyStrategy': np.full(numInvestors, list(BUY_STRATEGIES).index(self.buyStrategy), dtype = np.int8),
+                 'sellStrategy': np.full(numInvestors, list(SELL_STRATEGIES).index(self.sellStrategy), dtype = np.int8)}
+    for metricName in Investor.headerCSV().split(CSV_DELIMITER)[4:]:
+      investors[metricName] = self.metrics[metricName].astype(np.int64)
+
+    # every investor's portfolio slots followed by its sold stocks, as in csvRows
+    stocks = np.concatenate((self.holdings, self.soldStocks), axis = 1)
+    periodSold = np.concatenate((np.full(self.holdings.shape, -1), self.periodSold), axis = 1).ravel()
+    totalPriceChange = np.concatenate((self.heldPriceChange, self.soldPriceChange), axis = 1).ravel()
+    stocks = stocks.ravel()
+    return {'investors': investors,
+            'stocks': {'investorRow': np.repeat(np.arange(numInvestors, dtype = np.int64), self.holdings.shape[1] + self.soldStocks.shape[1]),
+                       'stockName': self.stockId[stocks],
+                       'stockQuality': self.quality[stocks],
+                       'stockInitialPrice': np.full(len(stocks), INITIAL_PRICE, dtype = np.int16),
+                       'stockPriceChangeHistory': self.priceChangeHistory[stocks, :PRICE_CHANGE_HISTORY_LENGTH],
+                       'stockPeriodGenerated': self.periodGenerated[stocks],
+                       'stockPeriodSold': periodSold.astype(np.int32),
+                       'stockGainsPrevious': self.gainsPrevious[stocks].astype(np.int8),
+                       'stockTotalPriceChange': totalPriceChange.astype(np.int32)}}
+
+  # Stock.csvRow for one universe row
+  def __stockCSVRow(self, stock, periodSold, totalPriceChange):
+    priceChangeHistoryString = ', '.join(map(str, self.priceChangeHistory[stock, :PRICE_CHANGE_HISTORY_LENGTH].tolist()))
+    return [stockName(int(self.stockId[stock])), QUALITY_NAMES[self.quality[stock]], str(INITIAL_PRICE), priceChangeHistoryString,
+            str(self.periodGenerated[stock]), str(periodSold), str(self.gainsPrevious[stock]), str(totalPriceChange)]
+
+
+# %%
+# Simulation Experiment
+
+ENGINE_OBJECT = 'object'  # Investor and Market objects (simulate_investors)
+ENGINE_BATCH = 'batch'    # all investors as arrays (BatchEngine)
+ENGINES = [ENGINE_OBJECT, ENGINE_BATCH]
+
+OUTPUT_CSV = 'csv'          # investors and stocks CSV files (ResultWriter)
+OUTPUT_COLUMNS = 'columns'  # columnar store of NumPy arrays (ColumnarResultWriter)
+OUTPUT_FORMATS = [OUTPUT_CSV, OUTPUT_COLUMNS]
+
+"""
+Runs an experiment with Investor and Market objects and yields each investor at the end of the last period.
+Investors are simulated one after another through all periods, so an investor can be written out and dropped
+before the next one starts. For a shared market, the market of every period is generated up front (one Market
+per period with that period's new stocks) and each investor trades on the market of the period it is in.
+Markets draw from rng (the module's generator by default); investors pick stocks with the random module.
+The investors are named investor<firstInvestor> onwards, so a shard of a larger experiment keeps its names.
+snapshot and replay are handed to every market (see Market).
+"""
+def iter_investors(useSharedMarket, buyStrategy, sellStrategy, numInvestors, numPeriods, portfolioSize, newStocksPerPeriod, rng = None, firstInvestor = 0, snapshot = None, replay = None):
+  
+  marketNameBase = "market"
+  NUM_INVESTORS = numInvestors
+  NUM_PERIODS = numPeriods
+  PORTFOLIO_SIZE = portfolioSize
+  NEW_STOCKS_PER_PERIOD = newStocksPerPeriod
+  BUY_STRATEGY = buyStrategy
+  SELL_STRATEGY = sellStrategy
+
+  # if all investors are supposed to share a market, create only one global market (one Market per period, continuing the stock IDs of the previous one)
+  if(useSharedMarket == True):
+    globalMarkets = [Market(marketNameBase + '_global', NUM_PERIODS, rng = rng, snapshot = snapshot, replay = replay)]
+    for period in range(2, NUM_PERIODS + 1):
+      globalMarkets.append(Market(marketNameBase + '_global', NEW_STOCKS_PER_PERIOD, rng = rng, period = period, snapshot = snapshot, replay = replay, firstStockId = globalMarkets[-1].nextStockId))
+  
+  # Generate each investor and initial portfolio
+  for i in range(firstInvestor, firstInvestor + NUM_INVESTORS):
+    # if investors get individual market, create one for each investor, otherwise assign global market
+    if(useSharedMarket == False):
+      investorMarket = Market(marketNameBase + '_' + str(i), NUM_PERIODS, rng = rng, snapshot = snapshot, replay = replay)
+      currentInvestor = Investor("investor" + str(i), investorMarket, BUY_STRATEGY, SELL_STRATEGY)
+    else:
+      currentInvestor = Investor("investor" + str(i), globalMarkets[0], BUY_STRATEGY, SELL_STRATEGY)
+    
+    currentInvestor.createInitialPortfolioWithNumStocks(PORTFOLIO_SIZE)
+
+    # Revise portfolio each period
+    for CURRENT_PERIOD in range(2, NUM_PERIODS + 1):
+      # set market period to next period and generate new stocks (the global market's periods already exist)
+      if(useSharedMarket == True):
+        currentInvestor.market = globalMarkets[CURRENT_PERIOD - 1]
+      else:
+        currentInvestor.market.currentPeriod = CURRENT_PERIOD
+        currentInvestor.market.updateStocks(NEW_STOCKS_PER_PERIOD)
+      # perform buy / sell operations
+      currentInvestor.sellStocks(1)
+      currentInvestor.createPeriodPortfolioWithNumStocks(1)
+
+    # print the investor into verbose output (uncomment to see in terminal)
+    # currentInvestor.description()
+    yield currentInvestor
+
+# Runs an experiment with Investor and Market objects (see iter_investors) and returns all investors
+def simulate_investors(useSharedMarket, buyStrategy, sellStrategy, numInvestors, numPeriods, portfolioSize, newStocksPerPeriod, rng = None, firstInvestor = 0, snapshot = None, replay = None):
+  return list(iter_investors(useSharedMarket, buyStrategy, sellStrategy, numInvestors, numPeriods, portfolioSize, newStocksPerPeriod, rng, firstInvestor, snapshot, replay))
+
+"""
+Runs one experiment and yields, per investor, the fields of its row in the investor summary file and its rows in
+the file with complete stock output (Investor.csvRow and csvRowsAllStocks). The object engine yields each investor
+when it has finished, so the investors are never all in memory.
+rng drives the markets (and the whole batch engine); the object engine's investors draw from the random module.
+"""
+def experiment_rows(useSharedMarket, buyStrategy, sellStrategy, numInvestors, numPeriods, portfolioSize, newStocksPerPeriod, engine = ENGINE_OBJECT, rng = None, firstInvestor = 0, snapshot = None, replay = None):
+  if (engine == ENGINE_BATCH):
+    batchEngine = BatchEngine(useSharedMarket, buyStrategy, sellStrategy, numInvestors, numPeriods, portfolioSize, newStocksPerPeriod, rng = rng, firstInvestor = firstInvestor, snapshot = snapshot, replay = replay).run()
+    return batchEngine.csvRows()
+  marketInvestors = iter_investors(useSharedMarket, buyStrategy, sellStrategy, numInvestors, numPeriods, portfolioSize, newStocksPerPeriod, rng = rng, firstInvestor = firstInvestor, snapshot = snapshot, replay = replay)
+  return ((currentInvestor.csvRow(), list(currentInvestor.csvRowsAllStocks())) for currentInvestor in marketInvestors)
+
+# The results of one experiment as experiment_rows (CSV) or experiment_columns (columnar store) produce them
+def experiment_results(outputFormat = OUTPUT_CSV, **experimentArguments):
+  if (outputFormat == OUTPUT_COLUMNS):
+    return experiment_columns(**experimentArguments)
+  return experiment_rows(**experimentArguments)
+
+"""
+The disposition effect of a whole experiment: Odean's PGR and PLR of the realized and paper gains and losses
+of all its investors pooled. count passes an experiment's results (rows or column chunks) through while adding
+up their counts, so a run is measured while it is written instead of by a second pass over the result files.
+"""
+class DispositionEffect(object):
+  COUNTS = ['realizedGains', 'paperGains', 'realizedLosses', 'paperLosses']
+
+  def __init__(self):
+    self.numInvestors = 0
+    self.counts = dict.fromkeys(self.COUNTS, 0)
+
+  def count(self, results):
+    columns = [Investor.headerCSV().split(CSV_DELIMITER).index(countName) for countName in self.COUNTS]
+    for result in results:
+      if (isinstance(result, dict)):
+        investors = result['investors']
+        self.numInvestors += len(investors[self.COUNTS[0]])
+        for countName in self.COUNTS:
+          self.counts[countName] += int(investors[countName].sum(dtype = np.int64))
+      else:
+        investorRow = result[0]
+        self.numInvestors += 1
+        for countName, column in zip(self.COUNTS, columns):
+          self.counts[countName] += int(investorRow[column])
+      yield result
+
+  # Counts the investors of written results: the investors file of a CSV run, or a columnar store
+  def countResultFiles(self, results):
+    if (isinstance(results, str)):
+      manifest, tables = read_result_columns(results)
+      collections.deque(self.count([tables]), maxlen = 0)
+    else:
+      with open(results[0], newline = "") as investorFile:
+        investorRows = csv.reader(investorFile, delimiter = CSV_DELIMITER)
+        next(investorRows)
+        collections.deque(self.count((investorRow, ()) for investorRow in investorRows), maxlen = 0)
+
+  def pgr(self):
+    return float(proportionRealized(self.counts['realizedGains'], self.counts['paperGains']))
+
+  def plr(self):
+    return float(proportionRealized(self.counts['realizedLosses'], self.counts['paperLosses']))
+
+  def difference(self):
+    return self.pgr() - self.plr()
+
+# Checks strategies and engine, prints the problem and returns False if one is not valid
+def valid_experiment_settings(buyStrategy, sellStrategy, engine):
+  if (buyStrategy not in BUY_STRATEGIES):
+    print(f'{buyStrategy} is not a valid buying strategy')
+    return False
+  
+  if (sellStrategy not in SELL_STRATEGIES):
+    print(f'{sellStrategy} is not a valid selling strategy')
+    return False
+
+  if (engine not in ENGINES):
+    print(f'{engine} is not a valid engine')
+    return False
+  return True
+
+# results/<yymmdd_HHMM>_<experimentId>, the start of the paths of an experiment's result files (the results folder is created)
+def result_path_prefix(experimentId):
+  currentTimeString = datetime.datetime.now().strftime("%y%m%d_%H%M")
+  scriptDir = os.path.join(os.path.abspath(''), "results")
+  os.makedirs(scriptDir, exist_ok=True)
+  return os.path.join(scriptDir, currentTimeString + "_" + experimentId)
+
+"""
+Streams the results of an experiment into the investor summary file and the file with complete stock output
+(in the results folder) through csv writers on buffered files. Each investor is written when it is handed over,
+so nothing is kept once it is written. Every investor's stock rows are followed by an empty row.
+"""
+class ResultWriter(object):
+  BUFFER_SIZE = 1 << 20
+
+  def __init__(self, experimentId, headerInvestors, headerStocks):
+    # create file names and correct path
+    pathPrefix = result_path_prefix(experimentId)
+    self.pathInvestors = pathPrefix + "_investors.csv"
+    self.pathStocks = pathPrefix + "_stocks.csv"
+
+    # write to file (create if not found, overwrite otherwise)
+    self.investorFile = open(self.pathInvestors, "w", newline = "", buffering = self.BUFFER_SIZE)
+    try:
+      self.stockFile = open(self.pathStocks, "w", newline = "", buffering = self.BUFFER_SIZE)
+    except:
+      self.investorFile.close()
+      raise
+    self.investorWriter = csv.writer(self.investorFile, delimiter = CSV_DELIMITER, lineterminator = "\n")
+    self.stockWriter = csv.writer(self.stockFile, delimiter = CSV_DELIMITER, lineterminator = "\n")
+    self.investorWriter.writerow(headerInvestors.split(CSV_DELIMITER))
+    self.stockWriter.writerow(headerStocks.split(CSV_DELIMITER))
+
+  def writeInvestor(self, investorRow, stockRows):
+    self.investorWriter.writerow(investorRow)
+    self.stockWriter.writerows(stockRows)
+    self.stockWriter.writerow([])
+
+  def writeInvestors(self, results):
+    for investorRow, stockRows in results:
+      self.writeInvestor(investorRow, stockRows)
+
+  def close(self):
+    try:
+      self.investorFile.close()
+    finally:
+      self.stockFile.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.close()
+
+"""
+A ResultWriter that writes on a background thread, so the simulation carries on while rows are formatted and
+flushed. Investors are handed over in batches of BATCH_SIZE through a queue of at most queueSize batches; when
+the queue is full, writeInvestor waits for the thread (backpressure), so memory stays bounded.
+close (also on the way out of a with block that raised) writes everything handed over and closes both files.
+An error on the writer thread is raised again in the caller's thread by the next writeInvestor or by close.
+"""
+class BackgroundResultWriter(ResultWriter):
+  BATCH_SIZE = 256
+
+  def __init__(self, experimentId, headerInvestors, headerStocks, queueSize = 16):
+    ResultWriter.__init__(self, experimentId, headerInvestors, headerStocks)
+    self.queue = queue.Queue(maxsize = queueSize)
+    self.batch = []
+    self.error = None
+    self.thread = threading.Thread(target = self.__writeBatches, name = "ResultWriter", daemon = True)
+    self.thread.start()
+
+  def __writeBatches(self):
+    while True:
+      batch = self.queue.get()
+      if (batch is None):
+        return
+      if (self.error is None):
+        try:
+          for investorRow, stockRows in batch:
+            ResultWriter.writeInvestor(self, investorRow, stockRows)
+        except BaseException as error:
+          # keep taking batches after an error, so the caller never waits on a full queue
+          self.error = error
+
+  def writeInvestor(self, investorRow, stockRows):
+    if (self.error is not None):
+      raise self.error
+    self.batch.append((investorRow, stockRows))
+    if (len(self.batch) >= self.BATCH_SIZE):
+      self.queue.put(self.batch)
+      self.batch = []
+
+  def close(self):
+    try:
+      if (self.thread.is_alive()):
+        if (len(self.batch) > 0):
+          self.queue.put(self.batch)
+          self.batch = []
+        self.queue.put(None)
+        self.thread.join()
+    finally:
+      ResultWriter.close(self)
+    if (self.error is not None):
+      raise self.error
+
+  def __exit__(self, excType, excValue, traceback):
+    try:
+      self.close()
+    except Exception:
+      # an error of the run itself is the one to report
+      if (excType is None):
+        raise
+
+"""
+Writes (investor row, stock rows) pairs as they come and returns the paths of both files.
+By default the rows are written by a BackgroundResultWriter while the simulation produces the next ones.
+"""
+def write_experiment_results(experimentId, headerInvestors, headerStocks, results, background = True):
+  resultWriterClass = BackgroundResultWriter if background else ResultWriter
+  with resultWriterClass(experimentId, headerInvestors, headerStocks) as resultWriter:
+    resultWriter.writeInvestors(results)
+  return resultWriter.pathInvestors, resultWriter.pathStocks
+
+# investors per shard when individual markets are split across processes
+INVESTORS_PER_SHARD = 5000
+
+ExperimentShard = namedtuple('ExperimentShard', ['settings', 'firstInvestor', 'seedSequence', 'engine', 'outputFormat'])
+
+# The spawn key branches of a seed sequence: the stream of its markets, the stream of the random module, and its
+# children (shards, sweep runs and replications), so that no child is ever the same sequence as one of the streams
+MARKET_STREAM, RANDOM_STREAM, CHILD_BRANCH = 0, 1, 2
+
+def seed_branch(seedSequence, *branch):
+  return np.random.SeedSequence(seedSequence.entropy, spawn_key = seedSequence.spawn_key + branch, pool_size = seedSequence.pool_size)
+
+# The children start to start + count - 1 of seedSequence, those seedSequence.spawn(3)[CHILD_BRANCH].spawn would hand out, derived without spawning
+def child_seed_sequences(seedSequence, count, start = 0):
+  return [seed_branch(seedSequence, CHILD_BRANCH, child) for child in range(start, start + count)]
+
+"""
+Splits an individual-market experiment into shards of consecutive investors, each with its own child of the seed.
+The shards depend only on numInvestors and shardSize, never on the number of workers, so a seeded experiment
+gives the same rows however it is scheduled.
+"""
+def experiment_shards(settings, seed = None, engine = ENGINE_OBJECT, shardSize = INVESTORS_PER_SHARD, outputFormat = OUTPUT_CSV):
+  if (shardSize < 1):
+    raise ValueError(f'shardSize must be at least 1, got {shardSize}')
+  seedSequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+  firstInvestors = range(0, settings['numInvestors'], shardSize)
+  seedSequences = child_seed_sequences(seedSequence, len(firstInvestors))
+  return [ExperimentShard(dict(settings, numInvestors = min(shardSize, settings['numInvestors'] - firstInvestor)), firstInvestor, shardSeedSequence, engine, outputFormat)
+          for firstInvestor, shardSeedSequence in zip(firstInvestors, seedSequences)]
+
+"""
+Runs the investors of one seed sequence and returns their results (see experiment_results) as a list, so they
+can be sent back from a worker; a worker encodes columnar results itself. replay hands out the markets instead
+(see Market), as for the shards of a shared market.
+The markets and the random module (the object engine's investors draw from it) get separate streams derived
+from the seed sequence, built from its spawn key so that running it twice repeats it.
+"""
+def seeded_experiment_results(settings, seedSequence, engine, firstInvestor = 0, outputFormat = OUTPUT_CSV, replay = None):
+  rng, randomSeed = seeded_streams(seedSequence)
+  return list(with_random_seed(randomSeed, experiment_results(outputFormat, engine = engine, rng = rng, firstInvestor = firstInvestor, replay = replay, **settings)))
+
+# A generator for the markets on one stream of seedSequence, and a seed for the random module from another
+def seeded_streams(seedSequence):
+  marketSeed, investorSeed = seed_branch(seedSequence, MARKET_STREAM), seed_branch(seedSequence, RANDOM_STREAM)
+  return np.random.default_rng(marketSeed), int(investorSeed.generate_state(1, np.uint64)[0])
+
+_END = object()
+
+"""
+Iterates results with the random module seeded with randomSeed while each item is produced, and with the
+caller's random state put back in between, so seeding a run in-process leaves the caller's random module alone.
+"""
+def with_random_seed(randomSeed, results):
+  results = iter(results)
+  randomState = random.Random(randomSeed).getstate()
+  while True:
+    callerState = random.getstate()
+    random.setstate(randomState)
+    try:
+      item = next(results, _END)
+    finally:
+      randomState = random.getstate()
+      random.setstate(callerState)
+    if (item is _END):
+      return
+    yield item
+
+def run_experiment_shard(shard):
+  return seeded_experiment_results(shard.settings, shard.seedSequence, shard.engine, shard.firstInvestor, shard.outputFormat)
+
+"""
+Runs an experiment in this process (from rng, writing snapshot or replaying replay) in blocks of shardSize
+investors one after another on rng, so the batch engine holds one block of investors at a time instead of the
+whole population, and checks maxMemory before each block (see check_memory). A shared market is drawn (or read
+from replay) once, written to snapshot, and replayed to every block. A run of up to shardSize investors draws
+from rng as one batch engine does; the object engine runs one investor at a time anyway and is run in one go.
+"""
+def experiment_blocks(outputFormat, settings, engine, shardSize, rng = None, snapshot = None, replay = None, maxMemory = None):
+  if (engine != ENGINE_BATCH):
+    check_memory(maxMemory)
+    yield from experiment_results(outputFormat, engine = engine, rng = rng, snapshot = snapshot, replay = replay, **settings)
+    return
+  numInvestors = settings['numInvestors']
+  universe = None
+  if (settings['useSharedMarket']):
+    universe = MarketUniverse(['market_global'], [settings['numPeriods']] + [settings['newStocksPerPeriod']] * (settings['numPeriods'] - 1), rng, replay)
+    if (snapshot is not None):
+      snapshot.writeUniverse(universe.marketNames, universe.batchSizes, universe.quality, universe.priceChangeHistory, universe.pathSeed)
+    snapshot = None
+  for firstInvestor in range(0, numInvestors, shardSize):
+    check_memory(maxMemory)
+    yield from experiment_results(outputFormat, engine = engine, rng = rng, firstInvestor = firstInvestor, snapshot = snapshot,
+                                  replay = universe.replay() if universe is not None else replay,
+                                  **dict(settings, numInvestors = min(shardSize, numInvestors - firstInvestor)))
+
+# The resident memory of this process and its worker processes in bytes, from /proc (None where there is no /proc)
+def resident_memory():
+  if (not os.path.exists('/proc/self/statm')):
+    return None
+  residentPages = 0
+  for pid in ['self'] + [child.pid for child in multiprocessing.active_children()]:
+    try:
+      with open(f'/proc/{pid}/statm') as statm:
+        residentPages += int(statm.read().split()[1])
+    except FileNotFoundError:
+      # a worker that has just exited
+      pass
+  return residentPages * os.sysconf('SC_PAGE_SIZE')
+
+# Whether the resident memory of the run is above maxMemory bytes (never without a limit, or without /proc)
+def memory_above(maxMemory):
+  return maxMemory is not None and (resident_memory() or 0) > maxMemory
+
+# Raises MemoryError when the resident memory of the run is above maxMemory bytes
+def check_memory(maxMemory):
+  if (memory_above(maxMemory)):
+    raise MemoryError(f'the run takes {resident_memory()} bytes of resident memory, more than maxMemory ({maxMemory} bytes)')
+
+# map(function, *iterables) in this process, checking maxMemory before each call (see check_memory)
+def memory_checked_map(function, *iterables, maxMemory = None):
+  for arguments in zip(*iterables):
+    check_memory(maxMemory)
+    yield function(*arguments)
+
+"""
+pool.map(function, *iterables) with at most maxPending tasks submitted ahead of the result being consumed, so
+the results of finished tasks do not pile up while the caller is still writing earlier ones (pool.map submits
+every task at once). With a maxMemory in bytes, no task is submitted while resident_memory() is above it: the
+tasks in flight are waited for (and their results handed over) first, and if the run is still above maxMemory
+with none left, MemoryError is raised (see check_memory). The memory is checked before each task is submitted,
+so maxMemory has to leave room for the tasks in flight.
+Yields the results in order; tasks not submitted yet are dropped when the caller stops early.
+"""
+def bounded_pool_map(pool, function, *iterables, maxPending, maxMemory = None):
+  pending = collections.deque()
+  try:
+    for arguments in zip(*iterables):
+      while (pending and (len(pending) >= maxPending or memory_above(maxMemory))):
+        yield pending.popleft().result()
+      check_memory(maxMemory)
+      pending.append(pool.submit(function, *arguments))
+    while (pending):
+      yield pending.popleft().result()
+  finally:
+    for future in pending:
+      future.cancel()
+
+"""
+How market_experiment runs an experiment, apart from the experiment's settings: the engine, the random numbers (rng,
+or the seed of the shards), the workers, the investors per shard (shardSize, INVESTORS_PER_SHARD if None) and the
+memory limit, the output format, a market snapshot to write or replay, the result cache and a DispositionEffect.
+"""
+RunOptions = namedtuple('RunOptions', ['engine', 'rng', 'seed', 'workers', 'outputFormat', 'snapshotFileName', 'replayFileName',
+                                       'useCache', 'dispositionEffect', 'shardSize', 'maxMemory'],
+                        defaults = (ENGINE_OBJECT, None, None, None, OUTPUT_CSV, None, None, True, None, None, None))
+
+"""
+Generate the market
+options, a RunOptions, says how the experiment is run; its fields can also be given as keywords, which replace
+those of options.
+Investors are simulated in shards of shardSize investors (INVESTORS_PER_SHARD by default) on a process pool of
+workers processes (every core by default) and the rows are merged in investor order while they are written. Each
+shard is seeded from seed, so the results only depend on seed (and shardSize).
+A shard is simulated through all periods, handed back, written and dropped, so memory is bounded by the shards
+in flight: at most two per worker (see bounded_pool_map). Runs in this process (workers 1, rng, snapshotFileName
+or replayFileName) go through shards of shardSize investors one after another as well (see experiment_blocks).
+maxMemory caps the resident memory of the run in bytes: no shard is started while the run is above it, and
+MemoryError is raised when it stays above it (see bounded_pool_map); the files written so far are left as they are. A shared market (useSharedMarket True) is drawn once, from seed, and published
+in shared memory (see publish_shared_market), where the workers map it instead of being sent a copy. Passing rng
+instead runs every investor in this process from that generator.
+A seeded run is looked up in RESULT_CACHE (see ResultCache) first, and a cached run's result files are copied
+instead of simulating it again; useCache False always simulates (and leaves the cache alone).
+dispositionEffect, a DispositionEffect, is given the counts of every investor of the run (see DispositionEffect).
+outputFormat 'columns' writes a columnar store (see ColumnarResultWriter) instead of the two CSV files and
+returns the store's folder.
+snapshotFileName archives every market batch of the run (NDJSON, or binary for a .npy file name) and
+replayFileName runs the experiment on the markets of such a snapshot; both run every investor in this process.
+"""
+def market_experiment(experimentId = 'no_experiment_id_set', useSharedMarket = True, buyStrategy = 'BUY_GAINERS', sellStrategy = 'SELL_GAINERS', numInvestors = 20, numPeriods = 7, portfolioSize = 5, newStocksPerPeriod = 4, options = None, **runOptions):
+
+  unknownOptions = sorted(set(runOptions) - set(RunOptions._fields))
+  if (unknownOptions):
+    print(f'{unknownOptions} are not run options (see RunOptions)')
+    return
+  options = (options or RunOptions())._replace(**runOptions)
+  engine, rng, seed, workers, outputFormat, snapshotFileName, replayFileName, useCache, dispositionEffect, shardSize, maxMemory = options
+
+  # validate buy and sell strategies
+  if (not valid_experiment_settings(buyStrategy, sellStrategy, engine)):
+    return
+
+  if (outputFormat not in OUTPUT_FORMATS):
+    print(f'{outputFormat} is not a valid output format')
+    return
+
+  if (shardSize is None):
+    shardSize = INVESTORS_PER_SHARD
+  if (shardSize < 1):
+    print(f'shardSize must be at least 1, got {shardSize}')
+    return
+
+  settings = dict(useSharedMarket = useSharedMarket, buyStrategy = buyStrategy, sellStrategy = sellStrategy, numInvestors = numInvestors,
+                  numPeriods = numPeriods, portfolioSize = portfolioSize, newStocksPerPeriod = newStocksPerPeriod)
+
+  seedSequence = None if seed is None else (seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed))
+  cacheKey = None
+  if (useCache and RESULT_CACHE is not None and seedSequence is not None and rng is None and snapshotFileName is None and replayFileName is None):
+    runDescription = dict(settings, engine = engine, outputFormat = outputFormat, shardSize = shardSize,
+                          strategyVersions = {'buy': BUY_STRATEGIES[buyStrategy].version, 'sell': SELL_STRATEGIES[sellStrategy].version},
+                          modelParameters = model_parameters(),
+                          seed = {'entropy': seedSequence.entropy, 'spawnKey': list(seedSequence.spawn_key)})
+    cacheKey = RESULT_CACHE.key(runDescription)
+    cachedResults = RESULT_CACHE.fetch(cacheKey, experimentId)
+    if (cachedResults is not None):
+      if (dispositionEffect is not None):
+        dispositionEffect.countResultFiles(cachedResults)
+      return cachedResults
+
+  def writeResults(results):
+    if (dispositionEffect is not None):
+      results = dispositionEffect.count(results)
+    if (outputFormat == OUTPUT_COLUMNS):
+      return write_result_columns(experimentId, results, dict(settings, engine = engine))
+    return write_experiment_results(experimentId, Investor.headerCSV(), Investor.headerCSVAllStocks(), results)
+
+  def runExperiment(rng):
+    if (rng is not None or snapshotFileName is not None or replayFileName is not None):
+      with contextlib.ExitStack() as snapshotFiles:
+        snapshot = snapshotFiles.enter_context(MarketSnapshotWriter(snapshotFileName)) if snapshotFileName is not None else None
+        replay = snapshotFiles.enter_context(MarketSnapshotReader(replayFileName)) if replayFileName is not None else None
+        return writeResults(experiment_blocks(outputFormat, settings, engine, shardSize, rng, snapshot, replay, maxMemory))
+
+    # the shared market comes from the market stream of the seed, the shards from its children
+    shardSeedSequence = seedSequence if seedSequence is not None else np.random.SeedSequence()
+    marketRng = seeded_streams(shardSeedSequence)[0] if useSharedMarket else None
+    shards = experiment_shards(settings, shardSeedSequence, engine, shardSize, outputFormat)
+    numWorkers = min(workers or os.cpu_count() or 1, len(shards))
+    with contextlib.ExitStack() as sharedMarket:
+      if (useSharedMarket):
+        store = sharedMarket.enter_context(publish_shared_market(settings, marketRng))
+        runShards = lambda mapShards: mapShards(run_shared_market_shard, shards, itertools.repeat(store.layout))
+      else:
+        runShards = lambda mapShards: mapShards(run_experiment_shard, shards)
+      if (numWorkers <= 1):
+        return writeResults(itertools.chain.from_iterable(runShards(lambda function, *iterables: memory_checked_map(function, *iterables, maxMemory = maxMemory))))
+      with ProcessPoolExecutor(max_workers = numWorkers) as pool:
+        # the shards come back in investor order, and they are written while later shards are still running
+        poolMap = lambda function, *iterables: bounded_pool_map(pool, function, *iterables, maxPending = 2 * numWorkers, maxMemory = maxMemory)
+        return writeResults(itertools.chain.from_iterable(runShards(poolMap)))
+
+  results = runExperiment(rng)
+  if (cacheKey is not None):
+    RESULT_CACHE.store(cacheKey, runDescription, results)
+  return results
+
+
+# %%
+# Columnar Results
+
+"""
+The columns of a columnar result store: one fixed-width NumPy array per field of Investor.headerCSV (investors
+table) and of Stock.headerCSV (stocks table, plus the row of the stock's investor in the investors table).
+Names like investor12 / market_12 are stored as their number (market_global as -1), stock names as their stock ID
+(see stockName), strategies and quality as small integer codes into the list kept in the manifest, and a stock that
+was not sold has period sold -1.
+"""
+ResultColumn = namedtuple('ResultColumn', ['name', 'dtype', 'shape', 'attributes'])
+
+COLUMNS_MANIFEST = 'manifest.json'
+COLUMNS_FORMAT_VERSION = 3
+
+def resultColumns():
+  strategyCodes = {'buyStrategy': list(BUY_STRATEGIES), 'sellStrategy': list(SELL_STRATEGIES)}
+  investorColumns = [ResultColumn('investorName', 'int32', (), {'prefix': 'investor'}),
+                     ResultColumn('marketName', 'int32', (), {'prefix': 'market_', 'numbers': {'global': -1}}),
+                     ResultColumn('buyStrategy', 'int8', (), {'codes': strategyCodes['buyStrategy']}),
+                     ResultColumn('sellStrategy', 'int8', (), {'codes': strategyCodes['sellStrategy']})]
+  investorColumns += [ResultColumn(metricName, 'int64', (), {}) for metricName in Investor.headerCSV().split(CSV_DELIMITER)[4:]]
+  stockColumns = [ResultColumn('investorRow', 'int64', (), {}),
+                  ResultColumn('stockName', 'int64', (), {'stockIds': True}),
+                  ResultColumn('stockQuality', 'int8', (), {'codes': [QUALITY_NAMES[flag] for flag in sorted(QUALITY_NAMES)]}),
+                  ResultColumn('stockInitialPrice', 'int16', (), {}),
+                  ResultColumn('stockPriceChangeHistory', 'int8', (PRICE_CHANGE_HISTORY_LENGTH,), {'separator': ', '}),
+                  ResultColumn('stockPeriodGenerated', 'int32', (), {}),
+                  ResultColumn('stockPeriodSold', 'int32', (), {'numbers': {'None': -1}}),
+                  ResultColumn('stockGainsPrevious', 'int8', (), {}),
+                  ResultColumn('stockTotalPriceChange', 'int32', (), {})]
+  return {'investors': investorColumns, 'stocks': stockColumns}
+
+# A function turning a CSV field of the column into the value stored
+def columnEncoder(column):
+  attributes = column.attributes
+  if ('codes' in attributes):
+    return {code: index for index, code in enumerate(attributes['codes'])}.__getitem__
+  if (attributes.get('stockIds')):
+    return stockIdOfName
+  if ('separator' in attributes):
+    separator = attributes['separator']
+    return lambda field: [int(value) for value in field.split(separator)]
+  prefix = attributes.get('prefix', '')
+  numbers = attributes.get('numbers', {})
+  def encode(field):
+    field = field[len(prefix):]
+    return numbers[field] if field in numbers else int(field)
+  return encode
+
+# investors whose rows are encoded into one set of column arrays at a time
+COLUMN_CHUNK_INVESTORS = 1 << 14
+
+"""
+Encodes (investor row, stock rows) pairs into the arrays of the result columns, chunkSize investors at a time.
+Yields per chunk a dict table name -> column name -> array; investorRow counts from the chunk's first investor.
+"""
+def rows_to_result_columns(results, chunkSize = COLUMN_CHUNK_INVESTORS):
+  columns = resultColumns()
+  encoders = {tableName: [columnEncoder(column) for column in tableColumns] for tableName, tableColumns in columns.items()}
+  def toArrays(pending):
+    return {tableName: {column.name: np.asarray(values, dtype = column.dtype).reshape((-1,) + column.shape) for column, values in zip(tableColumns, pending[tableName])}
+            for tableName, tableColumns in columns.items()}
+  def newPending():
+    return {tableName: [[] for column in tableColumns] for tableName, tableColumns in columns.items()}
+
+  pending = newPending()
+  numInvestors = 0
+  for investorRow, stockRows in results:
+    for values, encode, field in zip(pending['investors'], encoders['investors'], investorRow):
+      values.append(encode(field))
+    numInvestorFields = len(investorRow)
+    for stockRow in stockRows:
+      pending['stocks'][0].append(numInvestors)
+      for values, encode, field in zip(pending['stocks'][1:], encoders['stocks'][1:], stockRow[numInvestorFields:]):
+        values.append(encode(field))
+    numInvestors += 1
+    if (numInvestors == chunkSize):
+      yield toArrays(pending)
+      pending = newPending()
+      numInvestors = 0
+  if (numInvestors > 0):
+    yield toArrays(pending)
+
+"""
+Runs one experiment and yields its results as column arrays (see rows_to_result_columns), the batch engine
+straight from its arrays and the object engine a chunk of investors at a time.
+"""
+def experiment_columns(useSharedMarket, buyStrategy, sellStrategy, numInvestors, numPeriods, portfolioSize, newStocksPerPeriod, engine = ENGINE_OBJECT, rng = None, firstInvestor = 0, snapshot = None, replay = None):
+  if (engine == ENGINE_BATCH):
+    yield BatchEngine(useSharedMarket, buyStrategy, sellStrategy, numInvestors, numPeriods, portfolioSize, newStocksPerPeriod, rng = rng, firstInvestor = firstInvestor, snapshot = snapshot, replay = replay).run().resultColumns()
+  else:
+    yield from rows_to_result_columns(experiment_rows(useSharedMarket, buyStrategy, sellStrategy, numInvestors, numPeriods, portfolioSize, newStocksPerPeriod, engine, rng, firstInvestor, snapshot, replay))
+
+"""
+Writes an experiment's results as a columnar store: a folder in results with one raw binary file per column
+(<table>.<column>.bin, C order, the dtype given in the manifest) and a JSON manifest of the tables, their row
+counts, columns and codes. Column arrays are appended to the files as they are handed over, so memory stays
+bounded by one chunk; (investor row, stock rows) pairs are encoded into chunks first.
+"""
+class ColumnarResultWriter(object):
+
+  def __init__(self, experimentId, settings = None):
+    self.storePath = result_path_prefix(experimentId) + "_columns"
+    os.makedirs(self.storePath, exist_ok=True)
+    self.experimentId = experimentId
+    self.settings = settings or {}
+    self.columns = resultColumns()
+    self.numRows = {tableName: 0 for tableName in self.columns}
+    self.files = {}
+    try:
+      for tableName, columns in self.columns.items():
+        for column in columns:
+          self.files[(tableName, column.name)] = open(os.path.join(self.storePath, self.columnFileName(tableName, column)), "wb")
+    except:
+      self.__closeFiles()
+      raise
+
+  @classmethod
+  def columnFileName(self, tableName, column):
+    return tableName + "." + column.name + ".bin"
+
+  # Appends one chunk of column arrays; its investorRow column counts from the chunk's first investor
+  def writeColumns(self, tables):
+    firstInvestorRow = self.numRows['investors']
+    for tableName, columns in self.columns.items():
+      for column in columns:
+        values = np.asarray(tables[tableName][column.name], dtype = column.dtype)
+        if (column.name == 'investorRow'):
+          values = values + firstInvestorRow
+        values.tofile(self.files[(tableName, column.name)])
+      self.numRows[tableName] += len(tables[tableName][columns[0].name])
+
+  def writeInvestors(self, results):
+    for tables in rows_to_result_columns(results):
+      self.writeColumns(tables)
+
+  def manifest(self):
+    tables = {}
+    for tableName, columns in self.columns.items():
+      tables[tableName] = {'numRows': self.numRows[tableName],
+                           'columns': [{'name': column.name, 'file': self.columnFileName(tableName, column), 'dtype': column.dtype,
+                                        'shape': list(column.shape), **column.attributes} for column in columns]}
+    return {'format': 'Disposed2BOverconfident columns', 'version': COLUMNS_FORMAT_VERSION, 'experimentId': self.experimentId,
+            'settings': self.settings, 'tables': tables}
+
+  def __closeFiles(self):
+    for columnFile in self.files.values():
+      columnFile.close()
+
+  # The manifest is written last, so a store without one was not completed
+  def close(self):
+    self.__closeFiles()
+    with open(os.path.join(self.storePath, COLUMNS_MANIFEST), "w") as manifestFile:
+      json.dump(self.manifest(), manifestFile, indent = 2)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    if (excType is None):
+      self.close()
+    else:
+      self.__closeFiles()
+
+# Writes chunks of column arrays as they come into a columnar store and returns the store's folder
+def write_result_columns(experimentId, columnChunks, settings = None):
+  with ColumnarResultWriter(experimentId, settings) as resultWriter:
+    for tables in columnChunks:
+      resultWriter.writeColumns(tables)
+  return resultWriter.storePath
+
+"""
+Opens a columnar store written by market_experiment(..., outputFormat = 'columns') without reading it: every
+column is a read-only np.memmap on its file. Returns the manifest and, per table, a dict of column name -> array;
+a column with codes holds indices into manifest['tables'][table]['columns'][i]['codes'] and a column with stockIds
+holds stock IDs (see stockName).
+"""
+def read_result_columns(storePath):
+  with open(os.path.join(storePath, COLUMNS_MANIFEST)) as manifestFile:
+    manifest = json.load(manifestFile)
+  if (manifest.get('version') != COLUMNS_FORMAT_VERSION):
+    raise ValueError(f'{storePath} has columnar store version {manifest.get("version")}, expected {COLUMNS_FORMAT_VERSION}')
+  tables = {}
+  for tableName, table in manifest['tables'].items():
+    columns = {}
+    for column in table['columns']:
+      shape = (table['numRows'],) + tuple(column['shape'])
+      if (table['numRows'] == 0):
+        # an empty file cannot be mapped
+        columns[column['name']] = np.empty(shape, dtype = column['dtype'])
+      else:
+        columns[column['name']] = np.memmap(os.path.join(storePath, column['file']), dtype = column['dtype'], mode = 'r', shape = shape)
+    tables[tableName] = columns
+  return manifest, tables
+
+
+# %%
+# Result Cache
+
+RESULT_CACHE_DIRECTORY = user_cache_directory('results')
+RESULT_CACHE_MAX_BYTES = 1 << 30
+RESULT_CACHE_ENTRY = 'entry.json'
+# Part of every result cache key: increase it with any change that alters the results of a seeded experiment
+ENGINE_VERSION = 10
+
+# The Stock class constants that decide the results of a seeded experiment, as part of its result cache key
+def model_parameters():
+  return {'qualityWeights': QUALITY_WEIGHTS, 'priceChanges': PRICE_CHANGES, 'priceChangeWeightsGood': PRICE_CHANGE_WEIGHTS_GOOD,
+          'priceChangeWeightsBad': PRICE_CHANGE_WEIGHTS_BAD, 'initialPrice': INITIAL_PRICE,
+          'priceChangeHistoryLength': PRICE_CHANGE_HISTORY_LENGTH, 'warmUpPeriods': WARM_UP_PERIODS}
+
+"""
+Keeps the result files of seeded experiments in an on-disk cache, keyed by the hash of everything that decides
+their content (settings, engine, seed, output format, shard size, the strategies' versions, the model parameters of
+model_parameters and ENGINE_VERSION). market_experiment copies
+a cached run's files to new result paths instead of simulating it again.
+Every entry is a folder with the two CSV files or the columnar store, and entry.json describing the run.
+Entries are moved into place complete, and an entry without entry.json is ignored. The modification time of
+entry.json, refreshed by every hit, orders the entries for eviction: once the cache is over maxBytes the least
+recently used ones are removed. Results larger than maxBytes on their own are not stored. hits, misses and evictions count the lookups and removals of this cache object.
+"""
+class ResultCache(object):
+  def __init__(self, directory = RESULT_CACHE_DIRECTORY, maxBytes = RESULT_CACHE_MAX_BYTES):
+    self.directory = directory
+    self.maxBytes = maxBytes
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def key(self, runDescription):
+    description = json.dumps(dict(runDescription, engineVersion = ENGINE_VERSION), sort_keys = True, default = int)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+  def entryPath(self, key):
+    return os.path.join(self.directory, key)
+
+  # Copies the results of a cached run to new result paths of experimentId and returns them like market_experiment, or None
+  def fetch(self, key, experimentId):
+    entryPath = self.entryPath(key)
+    try:
+      with open(os.path.join(entryPath, RESULT_CACHE_ENTRY)) as entryFile:
+        runDescription = json.load(entryFile)
+    except (OSError, ValueError):
+      self.misses += 1
+      return None
+
+    pathPrefix = result_path_prefix(experimentId)
+    storePath, pathInvestors, pathStocks = pathPrefix + "_columns", pathPrefix + "_investors.csv", pathPrefix + "_stocks.csv"
+    try:
+      if (runDescription['outputFormat'] == OUTPUT_COLUMNS):
+        shutil.copytree(os.path.join(entryPath, 'columns'), storePath, dirs_exist_ok = True)
+        with open(os.path.join(storePath, COLUMNS_MANIFEST)) as manifestFile:
+          manifest = json.load(manifestFile)
+        manifest['experimentId'] = experimentId
+        with open(os.path.join(storePath, COLUMNS_MANIFEST), "w") as manifestFile:
+          json.dump(manifest, manifestFile, indent = 2)
+        results = storePath
+      else:
+        shutil.copyfile(os.path.join(entryPath, 'investors.csv'), pathInvestors)
+        shutil.copyfile(os.path.join(entryPath, 'stocks.csv'), pathStocks)
+        results = pathInvestors, pathStocks
+    except (OSError, ValueError):
+      # an entry missing some of its files (evicted by another process while it was read, or damaged) is a miss, and is removed
+      shutil.rmtree(storePath, ignore_errors = True)
+      for path in (pathInvestors, pathStocks):
+        if (os.path.exists(path)):
+          os.remove(path)
+      shutil.rmtree(entryPath, ignore_errors = True)
+      self.misses += 1
+      return None
+    try:
+      os.utime(os.path.join(entryPath, RESULT_CACHE_ENTRY))
+    except OSError:
+      pass
+    self.hits += 1
+    return results
+
+  # Adds the results market_experiment returned for a run, built in a temporary folder and moved into place.
+  # The results are already written, so a cache that cannot take them (a read-only folder, a full disk) is reported and skipped.
+  def store(self, key, runDescription, results):
+    try:
+      paths = [results] if runDescription['outputFormat'] == OUTPUT_COLUMNS else results
+      if (sum(map(self.__size, paths)) > self.maxBytes):
+        return
+      self.__store(key, runDescription, results)
+    except OSError as error:
+      print(f'The results were not added to the result cache {self.directory}: {error}', file = sys.stderr)
+
+  def __store(self, key, runDescription, results):
+    os.makedirs(self.directory, exist_ok = True)
+    temporaryPath = tempfile.mkdtemp(dir = self.directory, suffix = '.tmp')
+    try:
+      if (runDescription['outputFormat'] == OUTPUT_COLUMNS):
+        shutil.copytree(results, os.path.join(temporaryPath, 'columns'))
+      else:
+        shutil.copyfile(results[0], os.path.join(temporaryPath, 'investors.csv'))
+        shutil.copyfile(results[1], os.path.join(temporaryPath, 'stocks.csv'))
+      with open(os.path.join(temporaryPath, RESULT_CACHE_ENTRY), "w") as entryFile:
+        json.dump(runDescription, entryFile, indent = 2, sort_keys = True, default = int)
+      shutil.rmtree(self.entryPath(key), ignore_errors = True)
+      os.replace(temporaryPath, self.entryPath(key))
+    except:
+      shutil.rmtree(temporaryPath, ignore_errors = True)
+      raise
+    self.__evict(self.entryPath(key))
+
+  # size in bytes of a file, or of all files in a folder
+  @staticmethod
+  def __size(path):
+    if (os.path.isfile(path)):
+      return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(folder, fileName)) for folder, _, fileNames in os.walk(path) for fileName in fileNames)
+
+  # (last used, size in bytes, path) of every entry
+  def __entries(self):
+    entries = []
+    if (not os.path.isdir(self.directory)):
+      return entries
+    with os.scandir(self.directory) as directoryEntries:
+      for entry in directoryEntries:
+        if (not entry.is_dir() or entry.name.endswith('.tmp')):
+          continue
+        size = self.__size(entry.path)
+        try:
+          lastUsed = os.path.getmtime(os.path.join(entry.path, RESULT_CACHE_ENTRY))
+        except OSError:
+          lastUsed = 0
+        entries.append((lastUsed, size, entry.path))
+    return entries
+
+  # Removes the least recently used entries until the cache fits maxBytes, keeping the one just stored
+  def __evict(self, keepPath):
+    entries = sorted(self.__entries())
+    totalBytes = sum(size for lastUsed, size, path in entries)
+    for lastUsed, size, path in entries:
+      if (totalBytes <= self.maxBytes):
+        break
+      if (path != keepPath):
+        shutil.rmtree(path, ignore_errors = True)
+        totalBytes -= size
+        self.evictions += 1
+
+  def stats(self):
+    entries = self.__entries()
+    return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+            'entries': len(entries), 'bytes': sum(size for lastUsed, size, path in entries)}
+
+  def clear(self):
+    shutil.rmtree(self.directory, ignore_errors = True)
+
+# the cache market_experiment uses; None turns caching off
+RESULT_CACHE = ResultCache()
+
+# %%
+# Strategy Comparison
+
+# the four strategy pairs of the study
+STRATEGY_PAIRS = [('BUY_GAINERS', 'SELL_GAINERS'), ('BUY_GAINERS', 'SELL_LOSERS'), ('RANDOM', 'SELL_GAINERS'), ('RANDOM', 'SELL_LOSERS')]
+
+"""
+The stock universe of an experiment (or of a shard of one), drawn once (or read from source, a replay): the batches
+every market generates, batchSizes stocks in each period (see BatchEngine.run). replay() hands the same batches to
+any number of runs.
+"""
+class MarketUniverse(object):
+  def __init__(self, marketNames, batchSizes, rng = None, source = None):
+    self.marketNames = list(marketNames)
+    self.batchSizes = list(batchSizes)
+    if (source is not None):
+      self.quality, self.priceChangeHistory, self.pathSeed = source.readUniverse(self.marketNames, self.batchSizes)
+    else:
+      self.quality, self.priceChangeHistory, self.pathSeed = generateStockPaths(len(self.marketNames) * sum(self.batchSizes), rng)
 
+  def replay(self):
+    return MarketUniverseReplay(self)
+
+# A replay of a MarketUniverse; a batch engine reading the whole universe gets its arrays without a check per batch
+class MarketUniverseReplay(MarketBatchReplay):
+  def __init__(self, universe):
+    super().__init__(universeBatches(universe.marketNames, universe.batchSizes, universe.quality, universe.priceChangeHistory, universe.pathSeed), 'the common market draw')
+    self.universe = universe
+    self.started = False
+
+  def nextBatch(self, marketName, period, numStocks):
+    self.started = True
+    return super().nextBatch(marketName, period, numStocks)
+
+  def readUniverse(self, marketNames, batchSizes):
+    if (not self.started and list(marketNames) == self.universe.marketNames and list(batchSizes) == self.universe.batchSizes):
+      self.started = True
+      self.batches = iter(())
+      return self.universe.quality, self.universe.priceChangeHistory, self.universe.pathSeed
+    return super().readUniverse(marketNames, batchSizes)
+
+"""
+Runs every strategy pair on the same markets (common random numbers): the universe of the investors
+firstInvestor onwards is drawn once from the market stream of seedSequence, and each pair replays it with the
+same investor stream (see seeded_streams), so the pairs only differ by their strategies.
+Yields the results of each pair (see experiment_results) in the order of strategyPairs; each pair draws from
+its own random state (see with_random_seed).
+"""
+def iter_common_market_results(settings, strategyPairs, seedSequence, engine, firstInvestor = 0, outputFormat = OUTPUT_CSV):
+  marketSeed, investorSeed = seed_branch(seedSequence, MARKET_STREAM), seed_branch(seedSequence, RANDOM_STREAM)
+  randomSeed = int(investorSeed.generate_state(1, np.uint64)[0])
+  marketNames = ['market_global'] if settings['useSharedMarket'] else ['market_' + str(i) for i in range(firstInvestor, firstInvestor + settings['numInvestors'])]
+  universe = MarketUniverse(marketNames, [settings['numPeriods']] + [settings['newStocksPerPeriod']] * (settings['numPeriods'] - 1), np.random.default_rng(marketSeed))
+  for buyStrategy, sellStrategy in strategyPairs:
+    yield with_random_seed(randomSeed, experiment_results(outputFormat, engine = engine, rng = np.random.default_rng(investorSeed), firstInvestor = firstInvestor, replay = universe.replay(),
+                                                          **dict(settings, buyStrategy = buyStrategy, sellStrategy = sellStrategy)))
+
+CommonMarketShard = namedtuple('CommonMarketShard', ['settings', 'strategyPairs', 'firstInvestor', 'seedSequence', 'engine', 'outputFormat'])
+
+def iter_common_market_shard(shard):
+  return iter_common_market_results(shard.settings, shard.strategyPairs, shard.seedSequence, shard.engine, shard.firstInvestor, shard.outputFormat)
+
+# The results of every pair of a shard as lists, to be sent back from a worker
+def run_common_market_shard(shard):
+  return [list(results) for results in iter_common_market_shard(shard)]
+
+"""
+Compares strategy pairs (STRATEGY_PAIRS by default) on common random numbers: every market, and every period's
+new stocks, is generated once and traded on by the investors of each pair, instead of one market_experiment per
+pair drawing its own markets. That saves the generation of all but one set of markets and removes the market
+noise from the differences between the pairs. Individual markets are run in shards of INVESTORS_PER_SHARD
+investors on workers processes like market_experiment, with the same bound on the shards in flight and the same
+maxMemory (see bounded_pool_map), and the results only depend on seed.
+Each pair is written like a market_experiment with the id <experimentId>_<buyStrategy>_<sellStrategy>;
+returns a dict of (buyStrategy, sellStrategy) -> the paths of its CSV files (or its columnar store).
+"""
+def compare_strategies(experimentId = 'no_experiment_id_set', useSharedMarket = True, strategyPairs = None, numInvestors = 20, numPeriods = 7, portfolioSize = 5, newStocksPerPeriod = 4, engine = ENGINE_OBJECT, seed = None, workers = None, outputFormat = OUTPUT_CSV, maxMemory = None):
+  strategyPairs = [tuple(strategyPair) for strategyPair in (strategyPairs or STRATEGY_PAIRS)]
+  for buyStrategy, sellStrategy in strategyPairs:
+    if (not valid_experiment_settings(buyStrategy, sellStrategy, engine)):
+      return
+  if (len(set(strategyPairs)) < len(strategyPairs)):
+    print(f'{strategyPairs} contains a strategy pair more than once')
+    return
+  if (outputFormat not in OUTPUT_FORMATS):
+    print(f'{outputFormat} is not a valid output format')
+    return
+
+  settings = dict(useSharedMarket = useSharedMarket, numInvestors = numInvestors, numPeriods = numPeriods, portfolioSize = portfolioSize, newStocksPerPeriod = newStocksPerPeriod)
+  shardSize = numInvestors if useSharedMarket else INVESTORS_PER_SHARD
+  shards = [CommonMarketShard(experimentShard.settings, strategyPairs, experimentShard.firstInvestor, experimentShard.seedSequence, engine, outputFormat)
+            for experimentShard in experiment_shards(settings, seed, engine, max(shardSize, 1), outputFormat)]
+
+  with contextlib.ExitStack() as resultWriters:
+    writers = []
+    for buyStrategy, sellStrategy in strategyPairs:
+      pairId = experimentId + "_" + buyStrategy + "_" + sellStrategy
+      if (outputFormat == OUTPUT_COLUMNS):
+        writers.append(resultWriters.enter_context(ColumnarResultWriter(pairId, dict(settings, buyStrategy = buyStrategy, sellStrategy = sellStrategy, engine = engine))))
+      else:
+        writers.append(resultWriters.enter_context(BackgroundResultWriter(pairId, Investor.headerCSV(), Investor.headerCSVAllStocks())))
+
+    def writeShards(shardResults):
+      for pairResults in shardResults:
+        for writer, results in zip(writers, pairResults):
+          if (outputFormat == OUTPUT_COLUMNS):
+            for tables in results:
+              writer.writeColumns(tables)
+          else:
+            writer.writeInvestors(results)
+
+    numWorkers = min(workers or os.cpu_count() or 1, len(shards))
+    if (numWorkers <= 1):
+      # in this process every pair's results are written while they are simulated
+      writeShards(memory_checked_map(iter_common_market_shard, shards, maxMemory = maxMemory))
+    else:
+      with ProcessPoolExecutor(max_workers = numWorkers) as pool:
+        writeShards(bounded_pool_map(pool, run_common_market_shard, shards, maxPending = 2 * numWorkers, maxMemory = maxMemory))
+
+  if (outputFormat == OUTPUT_COLUMNS):
+    return {strategyPair: writer.storePath for strategyPair, writer in zip(strategyPairs, writers)}
+  return {strategyPair: (writer.pathInvestors, writer.pathStocks) for strategyPair, writer in zip(strategyPairs, writers)}
+
+# %%
+# Shared Market Store
+
+# what a worker needs to attach to a SharedMarketStore: the name of its shared memory block and the shape of its universe
+SharedMarketLayout = namedtuple('SharedMarketLayout', ['sharedMemoryName', 'marketNames', 'batchSizes', 'historyLength'])
+
+"""
+A MarketUniverse kept in one multiprocessing.shared_memory block, so worker processes trading on the same market
+map it instead of each being sent a pickled copy. The process that creates the store fills it as a Market's
+snapshot: writeBatch copies each batch into its place in the block as the market generates it (the initial stocks
+and each updateStocks batch). A worker attaches with attach(store.layout) and reads the block through NumPy views,
+without copying it; replay() hands the batches to Markets and batch engines like MarketUniverse.replay.
+The creator unlinks the block on close, an attached store only unmaps it.
+"""
+class SharedMarketStore(MarketUniverse):
+  def __init__(self, marketNames, batchSizes, historyLength = PRICE_CHANGE_HISTORY_LENGTH, sharedMemoryName = None):
+    self.marketNames = list(marketNames)
+    self.batchSizes = list(batchSizes)
+    self.historyLength = historyLength
+    self.batchStarts = np.concatenate(([0], np.cumsum(self.batchSizes)[:-1])).tolist()
+    numStocks = len(self.marketNames) * sum(self.batchSizes)
+    self.owner = sharedMemoryName is None
+    if (self.owner):
+      # a block cannot be empty
+      self.sharedMemory = shared_memory.SharedMemory(create = True, size = max(numStocks * (8 + historyLength + 1), 1))
+    else:
+      self.sharedMemory = shared_memory.SharedMemory(name = sharedMemoryName)
+    # the path seeds first, so they are aligned
+    buffer = self.sharedMemory.buf
+    self.pathSeed = np.ndarray((numStocks,), dtype = np.uint64, buffer = buffer)
+    self.priceChangeHistory = np.ndarray((numStocks, historyLength), dtype = np.int8, buffer = buffer, offset = 8 * numStocks)
+    self.quality = np.ndarray((numStocks,), dtype = np.int8, buffer = buffer, offset = (8 + historyLength) * numStocks)
+
+  @classmethod
+  def attach(self, layout):
+    return self(layout.marketNames, layout.batchSizes, layout.historyLength, layout.sharedMemoryName)
+
+  @property
+  def layout(self):
+    return SharedMarketLayout(self.sharedMemory.name, self.marketNames, self.batchSizes, self.historyLength)
+
+  # Copies a batch generated by market marketName in period into its place in the block (see MarketSnapshotWriter.writeBatch)
+  def writeBatch(self, marketName, period, qualities, priceChangeHistories, pathSeeds = None):
+    if (marketName not in self.marketNames or not 1 <= period <= len(self.batchSizes) or len(qualities) != self.batchSizes[period - 1]):
+      raise ValueError(f'a store of the markets {self.marketNames} with batches of {self.batchSizes} stocks has no place for '
+                       f'{len(qualities)} stocks of market {marketName} in period {period}')
+    if (pathSeeds is None):
+      raise ValueError(f'the stocks of market {marketName} in period {period} have no path seeds')
+    start = self.marketNames.index(marketName) * sum(self.batchSizes) + self.batchStarts[period - 1]
+    stop = start + len(qualities)
+    self.quality[start:stop] = qualities
+    self.priceChangeHistory[start:stop] = priceChangeHistories[:, :self.historyLength]
+    self.pathSeed[start:stop] = pathSeeds
+
+  # Drops the views and unmaps the block (unlinking it in the process that created it); views handed out must be gone by then
+  def close(self):
+    self.quality = self.priceChangeHistory = self.pathSeed = None
+    self.sharedMemory.close()
+    if (self.owner):
+      self.sharedMemory.unlink()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+    return False
+
+"""
+Publishes the market of a shared-market experiment in a new SharedMarketStore, generated from rng like
+iter_investors generates it: one Market, which writes its initial stocks and then each period's updateStocks batch
+into the store in place. The caller closes the store.
+"""
+def publish_shared_market(settings, rng = None, marketNameBase = "market"):
+  numPeriods = settings['numPeriods']
+  marketName = marketNameBase + '_global'
+  store = SharedMarketStore([marketName], [numPeriods] + [settings['newStocksPerPeriod']] * (numPeriods - 1))
+  try:
+    market = Market(marketName, numPeriods, rng = rng, snapshot = store)
+    for period in range(2, numPeriods + 1):
+      market.currentPeriod = period
+      market.updateStocks(settings['newStocksPerPeriod'])
+  except BaseException:
+    store.close()
+    raise
+  return store
+
+# Runs one shard of a shared-market experiment (see experiment_shards) on the market of the store with the given layout, attaching to it for the run
+def run_shared_market_shard(shard, layout):
+  store = SharedMarketStore.attach(layout)
+  try:
+    return seeded_experiment_results(shard.settings, shard.seedSequence, shard.engine, shard.firstInvestor, shard.outputFormat, replay = store.replay())
+  finally:
+    store.close()
+
+# %%
+# Replications
+
+# metrics of Investor.headerCSV that replications estimate
+REPLICATION_METRICS = Investor.headerCSV().split(CSV_DELIMITER)[4:]
+
+# The regularized incomplete beta function I_x(a, b), from its continued fraction (modified Lentz's method)
+def regularizedBeta(x, a, b):
+  if (x <= 0 or x >= 1):
+    return float(x >= 1)
+  # the fraction converges quickly below (a + 1) / (a + b + 2), and I_x(a, b) = 1 - I_(1-x)(b, a) covers the rest
+  if (x > (a + 1) / (a + b + 2)):
+    return 1 - regularizedBeta(1 - x, b, a)
+  front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log1p(-x)) / a
+  tiny = 1e-300
+  c, d = 1.0, 1 - (a + b) * x / (a + 1)
+  d = 1 / (d if abs(d) > tiny else tiny)
+  fraction = d
+  for m in range(1, 1000):
+    for numerator in (m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)), -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1))):
+      d = 1 + numerator * d
+      d = 1 / (d if abs(d) > tiny else tiny)
+      c = 1 + numerator / c
+      c = c if abs(c) > tiny else tiny
+      fraction *= c * d
+    if (abs(c * d - 1) < 1e-15):
+      break
+  return front * fraction
+
+"""
+The quantile of Student's t distribution with degreesOfFreedom degrees of freedom at probability (above 0.5),
+found by bisection on its upper tail P(T > t) = I_(v/(v+t^2))(v/2, 1/2) / 2. Cached, since replications ask
+for the same quantile after every one of them.
+"""
+@lru_cache(maxsize = None)
+def studentTQuantile(probability, degreesOfFreedom):
+  if (not 0.5 <= probability < 1 or degreesOfFreedom < 1):
+    raise ValueError(f'need 0.5 <= probability < 1 and degreesOfFreedom >= 1, got {probability} and {degreesOfFreedom}')
+  upperTail = lambda t: regularizedBeta(degreesOfFreedom / (degreesOfFreedom + t * t), degreesOfFreedom / 2, 0.5) / 2
+  low, high = 0.0, 1.0
+  while (upperTail(high) > 1 - probability):
+    low, high = high, 2 * high
+  for _ in range(200):
+    middle = (low + high) / 2
+    if (middle in (low, high)):
+      break
+    if (upperTail(middle) > 1 - probability):
+      low = middle
+    else:
+      high = middle
+  return (low + high) / 2
+
+"""
+Running mean and variance of a vector of values, one vector at a time (Welford's algorithm), so replications
+can be summarized without keeping them. The confidence intervals use Student's t distribution with count - 1
+degrees of freedom, which the few replications of a quick run need (the normal quantile makes them too narrow).
+"""
+class OnlineStatistics(object):
+  def __init__(self, names):
+    self.names = list(names)
+    self.count = 0
+    self.mean = np.zeros(len(self.names))
+    self.sumSquares = np.zeros(len(self.names))
+
+  def add(self, values):
+    values = np.asarray(values, dtype = float)
+    self.count += 1
+    delta = values - self.mean
+    self.mean += delta / self.count
+    self.sumSquares += delta * (values - self.mean)
+
+  def variance(self):
+    if (self.count < 2):
+      return np.full(len(self.names), np.nan)
+    return self.sumSquares / (self.count - 1)
+
+  def standardError(self):
+    return np.sqrt(self.variance() / max(self.count, 1))
+
+  # Half the width of the confidence interval of every mean (not a number before the second value)
+  def halfWidth(self, confidence = 0.95):
+    if (self.count < 2):
+      return np.full(len(self.names), np.nan)
+    return studentTQuantile((1 + confidence) / 2, self.count - 1) * self.standardError()
+
+ReplicationSummary = namedtuple('ReplicationSummary', ['metric', 'mean', 'standardDeviation', 'halfWidth', 'low', 'high'])
+ReplicationReport = namedtuple('ReplicationReport', ['numReplications', 'converged', 'confidence', 'seedEntropy', 'summaries'])
+
+"""
+Runs one replication of an experiment from seedSequence without writing its results and returns the mean of
+every metric over its investors. The batch engine's metric arrays are used directly; the object engine's
+investor rows are read as they are handed over, so its stock rows are never built.
+"""
+def replication_metrics(settings, seedSequence, engine, metrics = REPLICATION_METRICS):
+  rng, randomSeed = seeded_streams(seedSequence)
+  if (engine == ENGINE_BATCH):
+    batchEngine = BatchEngine(rng = rng, **settings).run()
+    return np.array([batchEngine.metrics[metric].mean() for metric in metrics])
+  columns = [REPLICATION_METRICS.index(metric) + 4 for metric in metrics]
+  sums = np.zeros(len(metrics))
+  for currentInvestor in with_random_seed(randomSeed, iter_investors(rng = rng, **settings)):
+    investorRow = currentInvestor.csvRow()
+    sums += [int(investorRow[column]) for column in columns]
+  return sums / settings['numInvestors']
+
+def run_replication(replication):
+  return replication_metrics(*replication)
+
+"""
+Replicates an experiment until the means of its metrics are known well enough: every replication is one
+experiment of numInvestors investors from its own child of seed, and its investor means are added to online
+statistics. After minReplications, the run stops as soon as the confidence interval of every metric in
+targetMetrics (all metrics by default) is at most halfWidth wide on either side, or relativeHalfWidth times
+the metric's mean; without a target, or if the target is not reached, it stops after maxReplications.
+Replications are run in rounds of workers processes and added in order, so the result only depends on seed.
+Returns a ReplicationReport with a ReplicationSummary per metric.
+"""
+def replicate_experiment(useSharedMarket = True, buyStrategy = 'BUY_GAINERS', sellStrategy = 'SELL_GAINERS', numInvestors = 20, numPeriods = 7, portfolioSize = 5, newStocksPerPeriod = 4, engine = ENGINE_OBJECT, seed = None,
+                         metrics = None, targetMetrics = None, halfWidth = None, relativeHalfWidth = None, confidence = 0.95, minReplications = 10, maxReplications = 1000, workers = 1):
+  if (not valid_experiment_settings(buyStrategy, sellStrategy, engine)):
+    return
+  metrics = list(metrics or REPLICATION_METRICS)
+  targetMetrics = list(targetMetrics or metrics)
+  unknownMetrics = set(metrics + targetMetrics) - set(REPLICATION_METRICS)
+  if (unknownMetrics):
+    raise ValueError(f'unknown metrics: {sorted(unknownMetrics)}')
+  if (not set(targetMetrics) <= set(metrics)):
+    raise ValueError(f'targetMetrics {targetMetrics} are not all among metrics {metrics}')
+  if (minReplications < 2 or maxReplications < minReplications):
+    raise ValueError(f'need 2 <= minReplications <= maxReplications, got {minReplications} and {maxReplications}')
+
+  settings = dict(useSharedMarket = useSharedMarket, buyStrategy = buyStrategy, sellStrategy = sellStrategy, numInvestors = numInvestors,
+                  numPeriods = numPeriods, portfolioSize = portfolioSize, newStocksPerPeriod = newStocksPerPeriod)
+  seedSequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+  targets = np.array([metrics.index(metric) for metric in targetMetrics])
+  statistics = OnlineStatistics(metrics)
+
+  def converged():
+    if (statistics.count < minReplications or (halfWidth is None and relativeHalfWidth is None)):
+      return False
+    width = statistics.halfWidth(confidence)[targets]
+    reached = np.zeros(len(targets), dtype = bool)
+    if (halfWidth is not None):
+      reached |= width <= halfWidth
+    if (relativeHalfWidth is not None):
+      reached |= width <= relativeHalfWidth * np.abs(statistics.mean[targets])
+    return bool(reached.all())
+
+  with contextlib.ExitStack() as stack:
+    pool = stack.enter_context(ProcessPoolExecutor(max_workers = workers)) if workers > 1 else None
+    spawned = 0
+    while (statistics.count < maxReplications and not converged()):
+      roundSize = min(workers, maxReplications - statistics.count)
+      replications = [(settings, childSeed, engine, metrics) for childSeed in child_seed_sequences(seedSequence, roundSize, spawned)]
+      spawned += roundSize
+      for values in (pool.map(run_replication, replications) if pool is not None else map(run_replication, replications)):
+        statistics.add(values)
+        if (converged()):
+          break
+
+  mean, standardDeviation, width = statistics.mean.tolist(), np.sqrt(statistics.variance()).tolist(), statistics.halfWidth(confidence).tolist()
+  summaries = {metric: ReplicationSummary(metric, mean[i], standardDeviation[i], width[i], mean[i] - width[i], mean[i] + width[i]) for i, metric in enumerate(metrics)}
+  return ReplicationReport(statistics.count, converged(), confidence, seedSequence.entropy, summaries)
+
+# %%
+# Parameter Sweep
+
+# grid parameters in the order of the market_experiment arguments, with the defaults used when the grid leaves one out
+SWEEP_PARAMETERS = ['useSharedMarket', 'buyStrategy', 'sellStrategy', 'numInvestors', 'numPeriods', 'portfolioSize', 'newStocksPerPeriod']
+SWEEP_DEFAULTS = {'useSharedMarket': True, 'buyStrategy': 'BUY_GAINERS', 'sellStrategy': 'SELL_GAINERS', 'numInvestors': 20, 'numPeriods': 7, 'portfolioSize': 5, 'newStocksPerPeriod': 4}
+
+# columns put in front of every row of the merged sweep files
+def sweepHeaderCSV():
+  return CSV_DELIMITER.join(['run', 'replication'] + SWEEP_PARAMETERS)
+
+SweepRun = namedtuple('SweepRun', ['run', 'replication', 'settings', 'seedSequence', 'engine'])
+
+"""
+Expands a grid (parameter name -> list of values, or a single value) into one SweepRun per combination and replication.
+Every run gets its own child of the sweep's SeedSequence, numbered in run order, so a run draws the same numbers
+whichever worker executes it and however many workers there are.
+"""
+def sweep_runs(grid, replications = 1, seed = None, engine = ENGINE_OBJECT):
+  unknownParameters = set(grid) - set(SWEEP_PARAMETERS)
+  if (unknownParameters):
+    raise ValueError(f'unknown sweep parameters: {sorted(unknownParameters)}')
+  if (replications < 1):
+    raise ValueError(f'replications must be at least 1, got {replications}')
+  values = []
+  for parameter in SWEEP_PARAMETERS:
+    value = grid.get(parameter, SWEEP_DEFAULTS[parameter])
+    values.append(list(value) if isinstance(value, (list, tuple)) else [value])
+  combinations = list(itertools.product(*values))
+  seedSequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+  seedSequences = child_seed_sequences(seedSequence, len(combinations) * replications)
+  runs = []
+  for combination in combinations:
+    for replication in range(replications):
+      runs.append(SweepRun(len(runs), replication, dict(zip(SWEEP_PARAMETERS, combination)), seedSequences[len(runs)], engine))
+  return runs
+
+# Runs one sweep run (in a worker process) and returns its rows with the run columns in front
+def run_sweep_run(sweepRun):
+  settings = sweepRun.settings
+  runColumns = [str(sweepRun.run), str(sweepRun.replication)] + [str(settings[parameter]) for parameter in SWEEP_PARAMETERS]
+  return [(runColumns + investorRow, [runColumns + stockRow for stockRow in stockRows])
+          for investorRow, stockRows in seeded_experiment_results(settings, sweepRun.seedSequence, sweepRun.engine)]
+
+"""
+Runs every combination of the grid (times replications) on a process pool and merges the results into one
+investors file and one stocks file, in run order, with at most two runs per worker in flight (see bounded_pool_map)
+so finished runs do not pile up while earlier ones are written. workers defaults to every core; workers = 1 runs
+in this process. Returns the paths of both files and the sweep's seed as a SeedSequence, with its entropy and
+spawn key (pass it as seed to reproduce the sweep).
+Note: worker processes need to import this module's functions, so on platforms that spawn instead of fork,
+run sweeps from the command line rather than from a notebook.
+"""
+def market_sweep(sweepId = 'no_sweep_id_set', grid = None, replications = 1, seed = None, engine = ENGINE_OBJECT, workers = None):
+  seedSequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+  runs = sweep_runs(grid or {}, replications, seedSequence, engine)
+  for sweepRun in runs:
+    if (not valid_experiment_settings(sweepRun.settings['buyStrategy'], sweepRun.settings['sellStrategy'], engine)):
+      return
+  
+  if (workers is None):
+    workers = os.cpu_count() or 1
+  headerInvestors = sweepHeaderCSV() + CSV_DELIMITER + Investor.headerCSV()
+  headerStocks = sweepHeaderCSV() + CSV_DELIMITER + Investor.headerCSVAllStocks()
+  if (workers == 1):
+    paths = write_experiment_results(sweepId, headerInvestors, headerStocks, itertools.chain.from_iterable(map(run_sweep_run, runs)))
+  else:
+    with ProcessPoolExecutor(max_workers = workers) as pool:
+      # the runs come back in run order, which is what makes the merged files independent of the worker count
+      paths = write_experiment_results(sweepId, headerInvestors, headerStocks, itertools.chain.from_iterable(bounded_pool_map(pool, run_sweep_run, runs, maxPending = 2 * workers)))
+  return paths[0], paths[1], np.random.SeedSequence(seedSequence.entropy, spawn_key = seedSequence.spawn_key, pool_size = seedSequence.pool_size)
+
+# Command line: python Disposed2BOverconfident.py sweep --buyStrategy BUY_GAINERS RANDOM --replications 10 ...
+def parse_sweep_arguments(argv):
+  if (len(argv) == 0 or argv[0] != 'sweep'):
+    return None
+  parser = argparse.ArgumentParser(prog = 'Disposed2BOverconfident.py sweep', description = 'Run a parameter sweep of market experiments.')
+  parser.add_argument('--sweepId', default = 'sweep')
+  parser.add_argument('--useSharedMarket', nargs = '+', choices = ['True', 'False'])
+  parser.add_argument('--buyStrategy', nargs = '+', choices = list(BUY_STRATEGIES))
+  parser.add_argument('--sellStrategy', nargs = '+', choices = list(SELL_STRATEGIES))
+  for parameter in ['numInvestors', 'numPeriods', 'portfolioSize', 'newStocksPerPeriod']:
+    parser.add_argument('--' + parameter, nargs = '+', type = int)
+  parser.add_argument('--replications', type = int, default = 1)
+  parser.add_argument('--seed', type = int)
+  parser.add_argument('--engine', choices = ENGINES, default = ENGINE_OBJECT)
+  parser.add_argument('--workers', type = int)
+  return parser.parse_args(argv[1:])
+
+def sweep_from_arguments(arguments):
+  grid = {parameter: getattr(arguments, parameter) for parameter in SWEEP_PARAMETERS if getattr(arguments, parameter) is not None}
+  if ('useSharedMarket' in grid):
+    grid['useSharedMarket'] = [value == 'True' for value in grid['useSharedMarket']]
+  return market_sweep(arguments.sweepId, grid, arguments.replications, arguments.seed, arguments.engine, arguments.workers)
+
+# the unit tests and the experiments at the bottom are skipped when the script is started as a sweep
+SWEEP_ARGUMENTS = parse_sweep_arguments(sys.argv[1:]) if __name__ == '__main__' else None
 
-    return CSVresult
 
 # %% [markdown]
 # ## To verify the Buy Gainers strategy
 # I created the testStocks_BuyGainers.json file that has only five gainers: stocks with names: A,G,H,J,O
 
 # %%
-import unittest
+# the unit tests fill caches in a temporary folder, not the user's
+def setUpModule():
+  global testCacheDirectory, RESULT_CACHE
+  testCacheDirectory = tempfile.TemporaryDirectory()
+  Market.stockCache = CompiledStockCache(os.path.join(testCacheDirectory.name, 'stocks'))
+  RESULT_CACHE = ResultCache(os.path.join(testCacheDirectory.name, 'results'))
+
+def tearDownModule():
+  global RESULT_CACHE
+  Market.stockCache = CompiledStockCache()
+  RESULT_CACHE = ResultCache()
+  testCacheDirectory.cleanup()
+
 MARKET_NAME = 'marketUnitTest'
 NUM_STOCKS = 20
 
+class TestStockClass(unittest.TestCase):
+
+  def test_stock_price_index(self):
+    market = Market(MARKET_NAME + ".priceIndex", NUM_STOCKS, "testSoldStocks_Calculations.json", testMode = "ReadStocksFromFile")
+    for stock in market.initialStocks:
+      history = stock.priceChangeHistory
+      self.assertEqual(stock.gainsPrevious(), sum(change >= 0 for change in history[:3]))
+      for period in range(stock.periodGenerated, 8):
+        self.assertEqual(stock.totalPriceChangeInPeriod(period), sum(history[3:min(stock.periodSold - 1, period) + 4 - stock.periodGenerated]))
+        self.assertEqual(stock.numUpticksInPeriod(period), sum(change > 0 for change in history[:period + 4 - stock.periodGenerated]))
+
+    # assigning a new history rebuilds the index
+    stock = Stock("A", 1, INITIAL_PRICE, 'good', [1, 1, 1, 5, 5, -3, -1, 1, 1, 1])
+    self.assertEqual(stock.priceForTestPeriod(3), INITIAL_PRICE + 7)
+    stock.priceChangeHistory = [-1, -1, -1, -3, -3, -3, -3, -3, -3, -3]
+    self.assertEqual(stock.gainsPrevious(), 0)
+    self.assertEqual(stock.totalPriceChangeInPeriod(2), -6)
+    self.assertEqual(stock.priceForTestPeriod(3), INITIAL_PRICE - 9)
+
+  def test_stock_price_path_seed(self):
+    # the counter-based paths can be drawn in pieces, and follow the price change weights
+    pathSeeds = np.array([0, 1, 2**64 - 1], dtype = np.uint64)
+    qualities = np.array([QUALITY_GOOD, QUALITY_BAD, QUALITY_GOOD], dtype = np.int8)
+    paths = pricePathChanges(pathSeeds, qualities, 0, 40)
+    self.assertEqual(paths.tolist(), np.concatenate((pricePathChanges(pathSeeds, qualities, 0, 7), pricePathChanges(pathSeeds, qualities, 7, 40)), axis = 1).tolist())
+    for qualityFlag, weights in ((QUALITY_GOOD, PRICE_CHANGE_WEIGHTS_GOOD), (QUALITY_BAD, PRICE_CHANGE_WEIGHTS_BAD)):
+      changes = pricePathChanges(np.arange(200, dtype = np.uint64), np.full(200, qualityFlag), 0, 100)
+      frequencies = [(changes == priceChange).mean() for priceChange in PRICE_CHANGES]
+      self.assertTrue(np.allclose(frequencies, weights, atol = 0.02), f'{frequencies} != {weights}')
+    qualities, _ = stocksOfSeeds(np.arange(20000, dtype = np.uint64), 0)
+    self.assertAlmostEqual(qualities.mean(), QUALITY_WEIGHTS[QUALITIES.index('good')] / sum(QUALITY_WEIGHTS), delta = 0.02)
+
+    # a generated stock draws the periods past its recorded history from its seed, also after a JSON round trip
+    market = Market(MARKET_NAME + ".pathSeed", NUM_STOCKS, rng = np.random.default_rng(2))
+    for stock in (market.stockAt(0), Stock.fromJSONString(market.stockAt(1).toJSONString())):
+      path = pricePathChanges([stock.pathSeed], [stock.qualityFlag], 0, historyStop(1, 60))[0].tolist()
+      self.assertEqual(list(stock.priceChangeHistory), path[:PRICE_CHANGE_HISTORY_LENGTH])
+      self.assertEqual(int(stocksOfSeeds([stock.pathSeed], 0)[0][0]), stock.qualityFlag)
+      self.assertEqual(stock.gainsPrevious(), sum(change >= 0 for change in path[:WARM_UP_PERIODS]))
+      for period in (60, 7, 30):
+        self.assertEqual(stock.totalPriceChangeInPeriod(period), sum(path[WARM_UP_PERIODS:historyStop(1, period)]))
+        self.assertEqual(stock.numUpticksInPeriod(period), sum(change > 0 for change in path[:historyStop(1, period)]))
+      self.assertEqual(stock.priceForTestPeriod(45), INITIAL_PRICE + sum(path[WARM_UP_PERIODS:WARM_UP_PERIODS + 45]))
+      self.assertEqual(len(stock.toDict()["priceChangeHistory"]), PRICE_CHANGE_HISTORY_LENGTH)
+      self.assertEqual(len(stock.csvRow()[3].split(', ')), PRICE_CHANGE_HISTORY_LENGTH)
+
+    # an experiment longer than the recorded histories
+    for investor in simulate_investors(False, 'RANDOM', 'SELL_LOSERS', 2, 20, 5, 4, rng = np.random.default_rng(3)):
+      stockRows = list(investor.csvRowsAllStocks())
+      self.assertEqual(investor.totalEarnings(), sum(int(stockRow[-1]) for stockRow in stockRows))
+      for holding in investor.portfolio:
+        path = pricePathChanges([holding.stock.pathSeed], [holding.stock.qualityFlag], 0, historyStop(holding.periodGenerated, 20))[0]
+        self.assertEqual(holding.totalPriceChangeInPeriod(20), path[WARM_UP_PERIODS:].sum())
+
+  def test_stock_compact_representation(self):
+    stock = Stock("A", 2, INITIAL_PRICE, 'good', [-1, 1, 1, 1, -3, 5, 1, 5, 1, -3], periodSold = 5)
+    self.assertFalse(hasattr(stock, '__dict__'))
+    self.assertEqual(stock.qualityFlag, QUALITY_GOOD)
+    self.assertEqual(stock.priceChangeHistory.typecode, 'b')
+
+    # JSON and CSV output are unchanged by the compact representation
+    copiedStock = Stock.fromJSONString(stock.toJSONString())
+    self.assertEqual(copiedStock.toDict(), stock.toDict())
+    self.assertEqual(stock.descriptionCSV(), "A;good;10;-1, 1, 1, 1, -3, 5, 1, 5, 1, -3;2;5;2;3")
+
+  def test_stock_json_loading(self):
+    stocks = Market.readStocksJSONFromFile("testStocks_17Stocks.json")
+    self.assertEqual(len(stocks), 17)
+    self.assertTrue(all(isinstance(stock, Stock) for stock in stocks))
+    # the module the file was written from differs between the script and the notebook, so it is left out
+    withoutModule = lambda objectDict: {key: value for key, value in objectDict.items() if key != "__module__"}
+    with open("testStocks_17Stocks.json") as stockFile:
+      self.assertEqual([withoutModule(convertObjectToDict(stock)) for stock in stocks], [withoutModule(dict(stockDict, periodSold = None, testing = False)) for stockDict in json.load(stockFile)])
+
+    # streamed from newline-delimited JSON, whatever module wrote it
+    ndjsonFileName = "testStocks_17Stocks_copy.ndjson"
+    try:
+      writeNDJSONObjects(stocks, ndjsonFileName)
+      streamedStocks = Market.iterStocksJSONFromFile(ndjsonFileName)
+      self.assertEqual(next(streamedStocks).toDict(), stocks[0].toDict())
+      self.assertEqual([stock.toDict() for stock in streamedStocks], [stock.toDict() for stock in stocks[1:]])
+      with open(ndjsonFileName, "w") as ndjsonFile:
+        ndjsonFile.write('{"__class__": "Stock", "__module__": "scenarios", "name": "A", "periodGenerated": 2, "quality": "good", "priceChangeHistory": [1, 1, 1, 1, 1, 1, 1, 1, 1, 1]}\n\n')
+        ndjsonFile.write('{"__class__": "Market", "__module__": "__main__", "name": "M"}\n')
+      streamedStocks = Market.iterStocksJSONFromFile(ndjsonFileName)
+      self.assertEqual(next(streamedStocks).periodGenerated, 2)
+      with self.assertRaises(ValueError):
+        next(streamedStocks)
+    finally:
+      os.remove(ndjsonFileName)
+
+  def test_compiled_stock_cache(self):
+    with tempfile.TemporaryDirectory() as temporaryDirectory:
+      stockCache = CompiledStockCache(os.path.join(temporaryDirectory, 'stocks'))
+      copyFileName = os.path.join(temporaryDirectory, 'testStocks_cached.json')
+      for fileName in ("testStocks_17Stocks.json", "testSoldStocks_Calculations.json"):
+        stocks = list(iterJSONObjects(fileName))
+        for expectedHits in (0, 1):
+          cachedStocks = stockCache.readObjects(fileName)
+          self.assertEqual(stockCache.hits, expectedHits)
+          self.assertEqual([stock.toDict() for stock in cachedStocks], [stock.toDict() for stock in stocks])
+          self.assertEqual([[stock.totalPriceChangeInPeriod(period) for period in range(1, 8)] for stock in cachedStocks],
+                           [[stock.totalPriceChangeInPeriod(period) for period in range(1, 8)] for stock in stocks])
+          self.assertEqual([stock.gainsPrevious() for stock in cachedStocks], [stock.gainsPrevious() for stock in stocks])
+        stockCache.hits = stockCache.misses = 0
+
+      # an edited file is compiled again, and so is a damaged sidecar
+      shutil.copy("testStocks_17Stocks.json", copyFileName)
+      self.assertEqual(len(stockCache.readObjects(copyFileName)), 17)
+      self.assertEqual(stockCache.hits, 1)
+      with open(copyFileName, "a") as copyFile:
+        copyFile.write("\n")
+      stockCache.readObjects(copyFileName)
+      self.assertEqual(stockCache.misses, 1)
+      with open(copyFileName, "rb") as copyFile:
+        sidecarPath = stockCache.sidecarPath(copyFile.read())
+      with open(sidecarPath, "r+b") as sidecarFile:
+        sidecarFile.truncate(100)
+      self.assertEqual(len(stockCache.readObjects(copyFileName)), 17)
+      self.assertEqual(stockCache.misses, 2)
+
+      # over the size cap, the least recently used sidecars go first
+      sidecarSize = os.path.getsize(sidecarPath)
+      stockCache.maxBytes = sidecarSize
+      stockCache.readObjects("testStocks_17Stocks.json")
+      stockCache.readObjects("testStocks_BuyGainers.json")
+      with open("testStocks_BuyGainers.json", "rb") as buyGainersFile:
+        self.assertEqual(os.listdir(stockCache.directory), [os.path.basename(stockCache.sidecarPath(buyGainersFile.read()))])
+
+      # a cache that cannot be written (here a file stands where its directory should be) still hands out the stocks
+      with open(os.path.join(temporaryDirectory, 'file'), 'w'):
+        pass
+      self.assertEqual(len(CompiledStockCache(os.path.join(temporaryDirectory, 'file')).readObjects("testStocks_17Stocks.json")), 17)
+
 class TestMarketClass(unittest.TestCase):
 # Katrin: I added information "periodGenerated" to the json files
     
@@ -547,7 +3372,94 @@ class TestMarketClass(unittest.TestCase):
     self.assertEqual(self.market.name, marketName)
     self.assertEqual(self.market.testMode, "ReadStocksFromFile")
     self.assertEqual(len(self.market.initialStocks), 17)
-    
+
+  def test_market_stock_arrays(self):
+    marketName = MARKET_NAME + ".arrays"
+    self.market = Market(marketName, NUM_STOCKS, rng = np.random.default_rng(1))
+    qualities, priceChangeHistories, periodGenerated, pathSeeds, firstStockId = self.market.stockArrays
+    self.assertEqual(firstStockId, 0)
+    self.assertEqual(qualities.shape, (NUM_STOCKS,))
+    self.assertEqual(priceChangeHistories.shape, (NUM_STOCKS, PRICE_CHANGE_HISTORY_LENGTH))
+    self.assertTrue(np.isin(priceChangeHistories, PRICE_CHANGES).all())
+
+    # Stock objects built on demand carry the same data as the arrays
+    for i, stock in enumerate(self.market.initialStocks):
+      self.assertEqual(stock.quality, QUALITY_NAMES[qualities[i]])
+      self.assertEqual(list(stock.priceChangeHistory), priceChangeHistories[i].tolist())
+      self.assertEqual(stock.periodGenerated, periodGenerated)
+      self.assertEqual(stock.pathSeed, int(pathSeeds[i]))
+
+    newArrays = self.market.updateStocks(4)
+    self.assertIs(newArrays, self.market.stockArrays)
+    self.assertEqual(len(self.market.initialStocks), 4)
+    self.assertEqual(newArrays.firstStockId, NUM_STOCKS)
+
+  # stock IDs stay unique across a market's batches, and their names are the bijective base-26 numerals
+  def test_market_stock_ids(self):
+    self.assertEqual([stockName(stockId) for stockId in (0, 25, 26, 51, 701, 702, 18277, 18278)], ['A', 'Z', 'AA', 'AZ', 'ZZ', 'AAA', 'ZZZ', 'AAAA'])
+    for stockId in list(range(2000)) + [123456789, 2 ** 40]:
+      self.assertEqual(stockIdOfName(stockName(stockId)), stockId)
+    with self.assertRaises(ValueError):
+      stockIdOfName('A1')
+
+    market = Market(MARKET_NAME + ".ids", 30, rng = np.random.default_rng(4))
+    names = [stock.name for stock in market.initialStocks]
+    for period in range(2, 5):
+      market.updateStocks(10)
+      names += [stock.name for stock in market.initialStocks]
+    self.assertEqual(names[:27], list(STOCK_NAME_LETTERS) + ['AA'])
+    self.assertEqual(len(set(names)), 60)
+    self.assertEqual(market.initialStocks[-1].stockId, 59)
+    # and the per-period markets of a shared market continue each other's IDs, as one market's batches do
+    numInvestorColumns = len(Investor.headerCSV().split(CSV_DELIMITER))
+    stocks = {}
+    for investor in simulate_investors(True, 'RANDOM', 'SELL_LOSERS', 4, 7, 5, 4, rng = np.random.default_rng(4)):
+      for stockRow in investor.csvRowsAllStocks():
+        self.assertEqual(stocks.setdefault(stockRow[numInvestorColumns], stockRow[numInvestorColumns + 1:numInvestorColumns + 5]), stockRow[numInvestorColumns + 1:numInvestorColumns + 5])
+
+  def test_market_write_stocks(self):
+    outputTestStockFilename = Market.outputTestStockFilename
+    Market.outputTestStockFilename = 'testStocks_written.json'
+    try:
+      market = Market(MARKET_NAME + ".writeToFile", 6, testMode = TEST_WRITE_STOCKS_TO_FILE, rng = np.random.default_rng(2))
+      writtenStocks = Market.readStocksJSONFromFile('testStocks_written.json')
+      self.assertEqual([stock.descriptionCSV() for stock in writtenStocks], [stock.descriptionCSV() for stock in market.initialStocks])
+    finally:
+      Market.outputTestStockFilename = outputTestStockFilename
+      os.remove('testStocks_written.json')
+
+  # a replayed snapshot reproduces the run whatever the rng, and the batch engine replays the object engine's markets
+  def test_market_snapshot_replay(self):
+    settings = dict(buyStrategy = 'BUY_GAINERS', sellStrategy = 'SELL_LOSERS', numInvestors = 3, numPeriods = 7, portfolioSize = 5, newStocksPerPeriod = 4)
+    for snapshotFileName in ('testSnapshot.ndjson', 'testSnapshot.npy'):
+      try:
+        for useSharedMarket in (True, False):
+          random.seed(3)
+          with MarketSnapshotWriter(snapshotFileName) as snapshot:
+            rows = list(experiment_rows(useSharedMarket, rng = np.random.default_rng(1), snapshot = snapshot, **settings))
+          random.seed(3)
+          with MarketSnapshotReader(snapshotFileName) as replay:
+            replayedRows = list(experiment_rows(useSharedMarket, rng = np.random.default_rng(99), replay = replay, **settings))
+          self.assertEqual(replayedRows, rows)
+
+          with MarketSnapshotReader(snapshotFileName) as replay, MarketSnapshotWriter('testSnapshot_batch' + snapshotFileName[-4:]) as snapshot:
+            BatchEngine(useSharedMarket, rng = np.random.default_rng(99), replay = replay, snapshot = snapshot, **settings).run()
+          with MarketSnapshotReader(snapshotFileName) as original, MarketSnapshotReader('testSnapshot_batch' + snapshotFileName[-4:]) as copy:
+            for originalBatch, copiedBatch in itertools.zip_longest(original, copy):
+              self.assertEqual(originalBatch[:2], copiedBatch[:2])
+              self.assertTrue((originalBatch.quality == copiedBatch.quality).all())
+              self.assertTrue((originalBatch.priceChangeHistory == copiedBatch.priceChangeHistory).all())
+              self.assertTrue((originalBatch.pathSeed == copiedBatch.pathSeed).all())
+
+        # a snapshot of other markets cannot be replayed
+        with MarketSnapshotReader(snapshotFileName) as replay:
+          with self.assertRaises(ValueError):
+            Market('another_market', 7, replay = replay)
+      finally:
+        for fileName in (snapshotFileName, 'testSnapshot_batch' + snapshotFileName[-4:]):
+          if os.path.exists(fileName):
+            os.remove(fileName)
+
   def test_investor_buy_gains(self):
     correctSelection = ["A","G","H","J","O"] # The testStocks_BuyGainers.json file has only these gainers
     # Katrin: I changed this correct selection from ["A","G","J","O","T"] to ["A","G","H","J","O"] because of different buying rule
@@ -571,6 +3483,25 @@ class TestMarketClass(unittest.TestCase):
 
     self.assertEqual(gainersPortfolio, correctSelection)
 
+  def test_market_top_gainers(self):
+    marketName = MARKET_NAME + ".topGainers"
+    self.market = Market(marketName, NUM_STOCKS, "testStocks_17Stocks.json", testMode = "ReadStocksFromFile")
+    stocks = self.market.initialStocks
+
+    # same selection and tie order as a stable sort of the whole market
+    topGainers = self.market.topGainers(6)
+    self.assertEqual(list(topGainers), sorted(stocks, reverse=True, key=Stock.gainsPrevious)[:6])
+    self.assertIs(self.market.topGainers(6), topGainers)
+    # the partial selection gives the order of a full stable sort, rows at a time too
+    scores = np.random.default_rng(5).integers(0, 4, size = (3, 50))
+    for numStocks in (0, 1, 7, 50, 60):
+      self.assertEqual(topScoreIndices(scores, numStocks).tolist(), np.argsort(-scores, axis = 1, kind = 'stable')[:, :numStocks].tolist())
+
+    self.market.currentPeriod = 2
+    self.market.updateStocks(4)
+    self.assertEqual(len(self.market.topGainers(6)), 4)
+    self.assertTrue(all(stock in self.market.initialStocks for stock in self.market.topGainers(6)))
+
 # %% [markdown]
 # Unit tests for selling strategies and calculations
 
@@ -636,6 +3567,45 @@ class TestInvestorClass(unittest.TestCase):
 
         self.assertEqual(sellLoserPortfolio, correctSelection_SL)
 
+# Testing that investors sharing a market hold positions on the same stocks without modifying them
+
+    def test_investor_positions_share_stocks(self):
+        self.market = Market("Market.sharedStocks", 20, "testStocks_BuyGainers.json", testMode = "ReadStocksFromFile")
+        marketStocks = self.market.initialStocks
+
+        investors = [Investor("investor" + str(i), self.market, 'BUY_GAINERS', 'RANDOM') for i in range(2)]
+        for investor in investors:
+            investor.createInitialPortfolioWithNumStocks(5)
+            for position in investor.portfolio:
+                self.assertTrue(any(position.stock is stock for stock in marketStocks))
+
+        self.market.currentPeriod = 2
+        investors[0].sellStocks(1)
+        self.assertEqual(investors[0].soldStocks[0].periodSold, 2)
+        self.assertTrue(all(stock.periodSold is None for stock in marketStocks))
+        self.assertTrue(all(position.periodSold is None for position in investors[1].portfolio))
+
+# Testing that the portfolio's gainer / loser partitions follow buys, sells and period changes
+
+    def test_portfolio_partitions(self):
+        self.market = Market("Market.partitions", 20, rng = np.random.default_rng(2))
+        investor = Investor("investor1", self.market, 'RANDOM', 'SELL_LOSERS')
+        investor.createInitialPortfolioWithNumStocks(15)
+
+        for period in range(2, 8):
+            self.market.currentPeriod = period
+            self.market.updateStocks(4)
+            investor.sellStocks(1)
+            investor.createPeriodPortfolioWithNumStocks(2)
+            for partition, isInPartition in ((investor.portfolio.gainers(period), lambda change: change > 0),
+                                             (investor.portfolio.losers(period), lambda change: change < 0),
+                                             (investor.portfolio.flat(period), lambda change: change == 0)):
+                expected = [holding for holding in investor.portfolio if isInPartition(holding.totalPriceChangeInPeriod(period))]
+                self.assertEqual(sorted(map(id, partition)), sorted(map(id, expected)))
+
+        self.assertEqual(len(investor.portfolio), 15 + 6)
+        self.assertEqual(len(investor.soldStocks), 6)
+
 # Testing calculations for result files
 
     def test_investor_calculations(self):
@@ -672,109 +3642,720 @@ class TestInvestorClass(unittest.TestCase):
         calculationsTestInvestor.totalUpticks()
         self.assertEqual(calculationsTestInvestor.totalUpticks(), 37)
 
+        calculationsTestInvestor.checkMetricsConsistency()
+
+# Testing that the metric counters stay consistent with a full scan through a simulated run
+
+    def test_investor_metrics_consistency(self):
+        for sellStrategy in ('RANDOM', 'SELL_GAINERS', 'SELL_LOSERS'):
+            self.market = Market("Market.metrics", 7, rng = np.random.default_rng(3))
+            investor = Investor("investor1", self.market, 'BUY_GAINERS', sellStrategy)
+            investor.createInitialPortfolioWithNumStocks(5)
+            investor.checkMetricsConsistency()
+            for period in range(2, 8):
+                self.market.currentPeriod = period
+                self.market.updateStocks(4)
+                investor.sellStocks(1)
+                investor.checkMetricsConsistency()
+                investor.createPeriodPortfolioWithNumStocks(1)
+                investor.checkMetricsConsistency()
+
+    def test_investor_disposition_effect(self):
+        for sellStrategy in ('RANDOM', 'SELL_GAINERS', 'SELL_LOSERS'):
+            self.market = Market("Market.disposition", 7, rng = np.random.default_rng(4))
+            investor = Investor("investor1", self.market, 'RANDOM', sellStrategy)
+            investor.createInitialPortfolioWithNumStocks(5)
+            expected = [0, 0, 0, 0]
+            for period in range(2, 8):
+                self.market.currentPeriod = period
+                self.market.updateStocks(4)
+                priceChanges = {holding: holding.totalPriceChangeInPeriod(period) for holding in investor.portfolio}
+                investor.sellStocks(1)
+                soldPriceChange = priceChanges[investor.soldStocks[-1]]
+                expected[0] += soldPriceChange > 0
+                expected[1] += sum(priceChange > 0 for priceChange in priceChanges.values()) - (soldPriceChange > 0)
+                expected[2] += soldPriceChange < 0
+                expected[3] += sum(priceChange < 0 for priceChange in priceChanges.values()) - (soldPriceChange < 0)
+                self.assertEqual([investor.realizedGains(), investor.paperGains(), investor.realizedLosses(), investor.paperLosses()], expected)
+                investor.createPeriodPortfolioWithNumStocks(1)
+            if (expected[0] + expected[1] > 0):
+                self.assertAlmostEqual(investor.pgr(), expected[0] / (expected[0] + expected[1]))
+            if (expected[2] + expected[3] > 0):
+                self.assertAlmostEqual(investor.plr(), expected[2] / (expected[2] + expected[3]))
+        # without any gain held at a sale the proportion is undefined
+        self.assertTrue(np.isnan(Investor("investor2", self.market, 'RANDOM', 'RANDOM').pgr()))
+
+
+# %% [markdown]
+# Unit tests for the batch engine
 
 # %%
-# Run unit tests
+def parseDescriptionCSV(descriptionCSV):
+  fields = descriptionCSV.split(CSV_DELIMITER)
+  return fields[:4] + [int(field) for field in fields[4:]]
 
-if __name__ == '__main__':
-   unittest.main(argv=['first-arg-is-ignored'], exit=False)
+class TestBatchEngine(unittest.TestCase):
+
+  def test_batch_engine_output(self):
+    for useSharedMarket in (True, False):
+      batchEngine = BatchEngine(useSharedMarket, 'BUY_GAINERS', 'SELL_LOSERS', 30, 7, 5, 4, rng = np.random.default_rng(4)).run()
+      self.assertEqual(batchEngine.holdings.shape, (30, 5))
+      self.assertEqual(batchEngine.soldStocks.shape, (30, 6))
+
+      numColumns = len(Investor.headerCSV().split(CSV_DELIMITER))
+      numColumnsAllStocks = len(Investor.headerCSVAllStocks().split(CSV_DELIMITER))
+      for investorCSV, allStocksCSV in zip(batchEngine.descriptionsCSV(), batchEngine.descriptionsCSVAllStocks()):
+        row = parseDescriptionCSV(investorCSV)
+        self.assertEqual(len(row), numColumns)
+        self.assertEqual(row[7], row[5] + row[6])   # numGoodStocksPicked = numGoodStocksSold + numGoodStocksEnd
+        stockRows = allStocksCSV.splitlines()
+        self.assertEqual(len(stockRows), 5 + 6)
+        self.assertTrue(all(len(stockRow.split(CSV_DELIMITER)) == numColumnsAllStocks for stockRow in stockRows))
 
+  def test_batch_engine_long_horizon(self):
+    batchEngine = BatchEngine(False, 'RANDOM', 'SELL_LOSERS', 20, 25, 5, 4, rng = np.random.default_rng(6)).run()
+    self.assertEqual(batchEngine.priceChangeHistory.shape[1], PRICE_CHANGE_HISTORY_LENGTH)
+    # the running totals follow the stocks' paths past the recorded histories
+    for stock, heldPriceChange in zip(batchEngine.holdings[0], batchEngine.heldPriceChange[0]):
+      stop = historyStop(int(batchEngine.periodGenerated[stock]), 25)
+      path = pricePathChanges(batchEngine.pathSeed[[stock]], batchEngine.quality[[stock]], 0, max(stop, PRICE_CHANGE_HISTORY_LENGTH))[0]
+      self.assertEqual(path[:PRICE_CHANGE_HISTORY_LENGTH].tolist(), batchEngine.priceChangeHistory[stock].tolist())
+      self.assertEqual(heldPriceChange, path[WARM_UP_PERIODS:stop].sum())
+    earningsColumn = Investor.headerCSV().split(CSV_DELIMITER).index("totalEarnings")
+    for investorRow, stockRows in batchEngine.csvRows():
+      self.assertEqual(len(stockRows), 5 + 24)
+      self.assertEqual(int(investorRow[earningsColumn]), sum(int(stockRow[-1]) for stockRow in stockRows))
+      self.assertTrue(all(len(stockRow[-5].split(', ')) == PRICE_CHANGE_HISTORY_LENGTH for stockRow in stockRows))
+
+  # compare metric means over many investors; the tolerance is five standard errors of the difference
+  def test_batch_engine_agrees_with_object_engine(self):
+    random.seed(5)
+    for useSharedMarket, buyStrategy, sellStrategy, numInvestors, numReplications in ((False, 'BUY_GAINERS', 'SELL_GAINERS', 2000, 1), (False, 'RANDOM', 'SELL_LOSERS', 2000, 1), (True, 'RANDOM', 'RANDOM', 10, 200)):
+      objectRows = []
+      batchRows = []
+      for replication in range(numReplications):
+        marketInvestors = simulate_investors(useSharedMarket, buyStrategy, sellStrategy, numInvestors, 7, 5, 4, rng = np.random.default_rng(10 + replication))
+        objectReplicationRows = [parseDescriptionCSV(investor.descriptionCSV())[4:] for investor in marketInvestors]
+        batchEngine = BatchEngine(useSharedMarket, buyStrategy, sellStrategy, numInvestors, 7, 5, 4, rng = np.random.default_rng(1000 + replication)).run()
+        batchReplicationRows = [parseDescriptionCSV(descriptionCSV)[4:] for descriptionCSV in batchEngine.descriptionsCSV()]
+        # investors sharing a market are not independent samples, so a shared market counts once, with its mean
+        if (useSharedMarket):
+          objectReplicationRows = [np.mean(objectReplicationRows, axis=0)]
+          batchReplicationRows = [np.mean(batchReplicationRows, axis=0)]
+        objectRows.extend(objectReplicationRows)
+        batchRows.extend(batchReplicationRows)
+      objectRows = np.array(objectRows, dtype=float)
+      batchRows = np.array(batchRows, dtype=float)
+      standardError = np.sqrt(objectRows.var(axis=0) / len(objectRows) + batchRows.var(axis=0) / len(batchRows))
+      difference = np.abs(objectRows.mean(axis=0) - batchRows.mean(axis=0))
+      self.assertTrue((difference <= 5 * standardError + 1e-9).all(), f'{buyStrategy}/{sellStrategy}: {difference} > 5 * {standardError}')
+
+  # a strategy registered from outside runs in both engines on its arrays alone
+  def test_registered_strategies(self):
+    @registerBuyStrategy('BUY_MOMENTUM')
+    def buyMomentum(warmUpPriceChanges, numStocks, keys):
+      return np.argsort(-warmUpPriceChanges.sum(axis=2, dtype=np.int64), axis=1, kind='stable')[:, :numStocks]
+    @registerSellStrategy('SELL_BIGGEST_LOSER')
+    def sellBiggestLoser(priceChanges, keys):
+      return pickAmong(priceChanges == priceChanges.min(axis=1, keepdims=True), keys)
+
+    randomState = random.getstate()
+    try:
+      self.assertTrue(valid_experiment_settings('BUY_MOMENTUM', 'SELL_BIGGEST_LOSER', ENGINE_BATCH))
+      # the enums name the built-in strategies, in registry order
+      self.assertEqual(list(BuyStrategy.__members__), list(BUY_STRATEGIES)[:len(BuyStrategy)])
+      self.assertEqual(list(SellStrategy.__members__), list(SELL_STRATEGIES)[:len(SellStrategy)])
+      # a portfolio larger than the initial market cannot be bought, whatever the engine and strategy (as with random.sample)
+      for engine in ENGINES:
+        for buyStrategy in ('RANDOM', 'BUY_GAINERS', 'BUY_MOMENTUM'):
+          with self.assertRaises(ValueError):
+            list(experiment_rows(False, buyStrategy, 'RANDOM', 2, 4, 5, 4, engine = engine, rng = np.random.default_rng(1)))
+      self.assertEqual(sellBiggestLoser(np.array([[3, -1, 5, -1], [2, 2, 0, 1]]), lambda numKeys: np.array([[0.9], [0.5]])).tolist(), [3, 2])
+
+      # with one stock held, the picks do not depend on the order of the holdings or on random keys: both engines agree row by row
+      settings = dict(buyStrategy = 'BUY_MOMENTUM', sellStrategy = 'SELL_BIGGEST_LOSER', numInvestors = 4, numPeriods = 7, portfolioSize = 1, newStocksPerPeriod = 4)
+      for useSharedMarket in (True, False):
+        snapshot = MarketSnapshotWriter('testStrategies.npy')
+        with snapshot:
+          objectRows = list(experiment_rows(useSharedMarket, rng = np.random.default_rng(11), snapshot = snapshot, **settings))
+        with MarketSnapshotReader('testStrategies.npy') as replay:
+          batchRows = list(experiment_rows(useSharedMarket, engine = ENGINE_BATCH, rng = np.random.default_rng(12), replay = replay, **settings))
+        self.assertEqual(batchRows, objectRows)
+        for investorRow, stockRows in objectRows:
+          self.assertEqual(investorRow[2:4], ['BUY_MOMENTUM', 'SELL_BIGGEST_LOSER'])
+
+      # with several, ties between the biggest losers are broken with keys from each engine's random source
+      settings['portfolioSize'] = 5
+      for engine in ENGINES:
+        rows = list(experiment_rows(False, engine = engine, rng = np.random.default_rng(13), **settings))
+        self.assertEqual([len(stockRows) for investorRow, stockRows in rows], [5 + 6] * 4)
+    finally:
+      del BUY_STRATEGIES['BUY_MOMENTUM'], SELL_STRATEGIES['SELL_BIGGEST_LOSER']
+      random.setstate(randomState)
+      if os.path.exists('testStrategies.npy'):
+        os.remove('testStrategies.npy')
+
+
+# %% [markdown]
+# Unit tests for the experiments, the parameter sweep and the result files
 
 # %%
-# Main: Simulation Experiment
+# The tests that write result files, which readResults reads and removes
+class ResultFilesTestCase(unittest.TestCase):
 
-import datetime
-import os
-# Generate the market
-def market_experiment(experimentId = 'no_experiment_id_set', useSharedMarket = True, buyStrategy = 'BUY_GAINERS', sellStrategy = 'SELL_GAINERS', numInvestors = 20, numPeriods = 7, portfolioSize = 5, newStocksPerPeriod = 4):
-  
-  marketNameBase = "market"
-  NUM_INVESTORS = numInvestors
-  NUM_PERIODS = numPeriods
-  CURRENT_PERIOD = 1
-  PORTFOLIO_SIZE = portfolioSize
-  NEW_STOCKS_PER_PERIOD = newStocksPerPeriod
+  def setUp(self):
+    self.resultsDir = os.path.join(os.path.abspath(''), "results")
+    self.resultsDirExisted = os.path.isdir(self.resultsDir)
 
-  # validate buy and sell strategies
-  if (buyStrategy in BuyStrategy.__members__):
-    BUY_STRATEGY  = buyStrategy
-  else:
-    print(f'{buyStrategy} is not a valid buying strategy')
-    return
-  
-  if (sellStrategy in SellStrategy.__members__):
-    SELL_STRATEGY  = sellStrategy
-  else:
-    print(f'{sellStrategy} is not a valid selling strategy')
-    return
+  # Reads both result files, then removes them (and the results folder if the test created it)
+  def readResults(self, pathInvestors, pathStocks):
+    with open(pathInvestors) as investorFile, open(pathStocks) as stockFile:
+      results = (investorFile.read(), stockFile.read())
+    os.remove(pathInvestors)
+    os.remove(pathStocks)
+    if (not self.resultsDirExisted and not os.listdir(self.resultsDir)):
+      os.rmdir(self.resultsDir)
+    return results
 
-  # if all investors are supposed to share a market, create only one global market
-  if(useSharedMarket == True):
-    globalMarket = Market(marketNameBase + '_global', NUM_PERIODS)
-  
-  # Generate the investors and initial portfolio
-  marketInvestors = []
-  i = 0
-  while (i < NUM_INVESTORS):
-    # if investors get individual market, create one for each investor, otherwise assign global market
-    if(useSharedMarket == False):
-      investorMarket = Market(marketNameBase + '_' + str(i), NUM_PERIODS)
-      newInvestor = Investor("investor" + str(i), investorMarket, BUY_STRATEGY, SELL_STRATEGY)
-    else:
-      newInvestor = Investor("investor" + str(i), globalMarket, BUY_STRATEGY, SELL_STRATEGY)
-    
-    newInvestor.createInitialPortfolioWithNumStocks(PORTFOLIO_SIZE)
-    marketInvestors.append(newInvestor)
-    i = i + 1
+class TestParameterSweep(ResultFilesTestCase):
 
-  # Revise portfolio each period
-  while (CURRENT_PERIOD < NUM_PERIODS):
-    
-    # set market period to next period (both global ind individual markets)
-    CURRENT_PERIOD = CURRENT_PERIOD + 1
-    if(useSharedMarket == True):
-      globalMarket.currentPeriod = CURRENT_PERIOD
-    else:
-      for currentInvestor in marketInvestors:
-        currentInvestor.market.currentPeriod = CURRENT_PERIOD
-    
-    # in each period: generate new stocks and perform buy / sell operations
-    if(useSharedMarket == True):
-      globalMarket.updateStocks(NEW_STOCKS_PER_PERIOD)
-    for currentInvestor in marketInvestors:
-      if(useSharedMarket == False):
-        currentInvestor.market.updateStocks(NEW_STOCKS_PER_PERIOD)
-      currentInvestor.sellStocks(1)
-      currentInvestor.createPeriodPortfolioWithNumStocks(1)
+  def test_sweep_runs(self):
+    runs = sweep_runs({'buyStrategy': ['BUY_GAINERS', 'RANDOM'], 'numInvestors': [3, 4], 'useSharedMarket': False}, 2, seed = 1)
+    self.assertEqual(len(runs), 8)
+    self.assertEqual([sweepRun.run for sweepRun in runs], list(range(8)))
+    self.assertEqual(runs[0].settings, dict(SWEEP_DEFAULTS, numInvestors = 3, useSharedMarket = False))
+    self.assertEqual(runs[-1].settings['buyStrategy'], 'RANDOM')
+    self.assertEqual(len(set(sweepRun.seedSequence.spawn_key for sweepRun in runs)), 8)
+    with self.assertRaises(ValueError):
+      sweep_runs({'numStocks': [10]})
+
+  def test_sweep_reproducible_across_workers(self):
+    grid = {'useSharedMarket': [True, False], 'buyStrategy': ['BUY_GAINERS', 'RANDOM'], 'numInvestors': 3}
+    randomState = random.getstate()
+    for engine in ENGINES:
+      serial = list(map(run_sweep_run, sweep_runs(grid, 2, seed = 11, engine = engine)))
+      with ProcessPoolExecutor(max_workers = 2) as pool:
+        pooled = list(pool.map(run_sweep_run, sweep_runs(grid, 2, seed = 11, engine = engine)))
+      self.assertEqual(serial, pooled)
+      # rerunning a run repeats it, different runs differ
+      runs = sweep_runs(grid, 2, seed = 11, engine = engine)
+      self.assertEqual(run_sweep_run(runs[0]), serial[0])
+      self.assertNotEqual(serial[0], serial[1])
+      self.assertEqual(len(serial[5]), 3)
+      investorRow, stockRows = serial[5][0]
+      self.assertEqual(investorRow[:9], ["5", "1", "False", "BUY_GAINERS", "SELL_GAINERS", "3", "7", "5", "4"])
+      self.assertEqual(len(investorRow), len((sweepHeaderCSV() + CSV_DELIMITER + Investor.headerCSV()).split(CSV_DELIMITER)))
+      self.assertTrue(all(stockRow[:len(investorRow)] == investorRow for stockRow in stockRows))
+    random.setstate(randomState)
+
+  # a sweep from a child seed is reproduced from the seed it returns, on any number of workers
+  def test_market_sweep(self):
+    grid = {'buyStrategy': ['BUY_GAINERS', 'RANDOM'], 'numInvestors': 3, 'useSharedMarket': False}
+    randomState = random.getstate()
+    pathInvestors, pathStocks, seedSequence = market_sweep("sweep_test", grid, 2, seed = np.random.SeedSequence(4).spawn(2)[1], workers = 2)
+    self.assertEqual((seedSequence.entropy, seedSequence.spawn_key), (4, (1,)))
+    swept = self.readResults(pathInvestors, pathStocks)
+    self.assertEqual(len(swept[0].splitlines()), 1 + 2 * 2 * 3)
+    self.assertEqual(self.readResults(*market_sweep("sweep_test", grid, 2, seed = seedSequence, workers = 1)[:2]), swept)
+    random.setstate(randomState)
+
+class TestMarketExperiment(ResultFilesTestCase):
+
+  def test_experiment_shards(self):
+    settings = dict(SWEEP_DEFAULTS, useSharedMarket = False, numInvestors = 8)
+    shards = experiment_shards(settings, seed = 3, shardSize = 3)
+    self.assertEqual([(shard.firstInvestor, shard.settings['numInvestors']) for shard in shards], [(0, 3), (3, 3), (6, 2)])
+    # the children are those of spawn on their own branch, apart from the streams of the seed (the shared market's among them),
+    # and the caller's SeedSequence is left as it was, so passing it again gives the same shards
+    seedSequence = np.random.SeedSequence(3)
+    self.assertEqual([shard.seedSequence.spawn_key for shard in experiment_shards(settings, seedSequence, shardSize = 3)], [(2, 0), (2, 1), (2, 2)])
+    self.assertEqual(seedSequence.n_children_spawned, 0)
+    self.assertEqual([shard.seedSequence.entropy for shard in experiment_shards(settings, seedSequence, shardSize = 3)], [seedSequence.entropy] * 3)
+    self.assertEqual([child.generate_state(2).tolist() for child in child_seed_sequences(np.random.SeedSequence(3), 3)],
+                     [child.generate_state(2).tolist() for child in np.random.SeedSequence(3).spawn(3)[CHILD_BRANCH].spawn(3)])
+    randomState = random.getstate()
+    for engine in ENGINES:
+      serial = list(map(run_experiment_shard, experiment_shards(settings, seed = 3, engine = engine, shardSize = 3)))
+      with ProcessPoolExecutor(max_workers = 3) as pool:
+        pooled = list(pool.map(run_experiment_shard, experiment_shards(settings, seed = 3, engine = engine, shardSize = 3)))
+      self.assertEqual(serial, pooled)
+      # merged in order, the shards name their investors and markets like one experiment
+      investorRows = [investorRow for shardRows in serial for investorRow, stockRows in shardRows]
+      self.assertEqual([investorRow[:2] for investorRow in investorRows], [["investor" + str(i), "market_" + str(i)] for i in range(8)])
+      # and each shard draws its own stocks
+      numInvestorColumns = len(Investor.headerCSV().split(CSV_DELIMITER))
+      self.assertNotEqual(serial[0][0][1][0][numInvestorColumns:], serial[1][0][1][0][numInvestorColumns:])
+    # the shards run in this process draw from their own random state, leaving the caller's alone
+    self.assertEqual(random.getstate(), randomState)
+
+  # a shared market is published once in shared memory: workers attach to the same block, and the results do not depend on them
+  def test_shared_market_store(self):
+    settings = dict(SWEEP_DEFAULTS, useSharedMarket = True, numInvestors = 8)
+    with publish_shared_market(settings, np.random.default_rng(4)) as store:
+      market = Market('market_global', settings['numPeriods'], rng = np.random.default_rng(4))
+      batches = [market.stockArrays]
+      for period in range(2, settings['numPeriods'] + 1):
+        market.currentPeriod = period
+        batches.append(market.updateStocks(settings['newStocksPerPeriod']))
+      self.assertTrue((store.quality == np.concatenate([batch.quality for batch in batches])).all())
+      self.assertTrue((store.priceChangeHistory == np.concatenate([batch.priceChangeHistory for batch in batches])).all())
+      self.assertTrue((store.pathSeed == np.concatenate([batch.pathSeed for batch in batches])).all())
+      # an attached store maps the same memory: a write through one is seen through the other
+      attached = SharedMarketStore.attach(store.layout)
+      attached.quality[0] ^= 1
+      self.assertEqual(store.quality[0], batches[0].quality[0] ^ 1)
+      attached.quality[0] ^= 1
+      attached.close()
+      with self.assertRaises(ValueError):
+        store.writeBatch('market_global', 2, batches[0].quality, batches[0].priceChangeHistory, batches[0].pathSeed)
+
+    global INVESTORS_PER_SHARD
+    investorsPerShard = INVESTORS_PER_SHARD
+    INVESTORS_PER_SHARD = 3
+    randomState = random.getstate()
+    numInvestorColumns = len(Investor.headerCSV().split(CSV_DELIMITER))
+    try:
+      for engine in ENGINES:
+        files = [self.readResults(*market_experiment("shared_store_test", True, 'RANDOM', 'SELL_LOSERS', 8, engine = engine, seed = 5, workers = workers, useCache = False))
+                 for workers in (1, 2)]
+        self.assertEqual(files[0], files[1])
+        # every shard trades on the one market: a stock has the same quality and history for every investor
+        stocks = {}
+        for stockRow in csv.reader(files[0][1].splitlines()[1:], delimiter = CSV_DELIMITER):
+          if (stockRow):
+            self.assertEqual(stocks.setdefault(stockRow[numInvestorColumns], stockRow[numInvestorColumns + 1:numInvestorColumns + 5]), stockRow[numInvestorColumns + 1:numInvestorColumns + 5])
+        self.assertEqual(len(files[0][0].splitlines()), 9)
+    finally:
+      INVESTORS_PER_SHARD = investorsPerShard
+      random.setstate(randomState)
+
+  # shards are submitted a few at a time; above maxMemory the ones in flight are waited for, and then it is an error
+  def test_bounded_pool_map(self):
+    global resident_memory
+    started = []
+    def square(value):
+      started.append(value)
+      return value * value
+    with ThreadPoolExecutor(max_workers = 4) as pool:
+      for index, result in enumerate(bounded_pool_map(pool, square, range(12), maxPending = 3)):
+        self.assertEqual(result, index * index)
+        self.assertLessEqual(len(started), index + 3)
+      self.assertEqual(sorted(started), list(range(12)))
+
+      residentMemory = resident_memory
+      memory = [0]
+      resident_memory = lambda: memory[0]
+      try:
+        started.clear()
+        results = []
+        with self.assertRaises(MemoryError):
+          for result in bounded_pool_map(pool, square, range(12), maxPending = 3, maxMemory = 1):
+            results.append(result)
+            if (len(results) == 6):
+              memory[0] = 2
+        self.assertEqual(results, [index * index for index in range(8)])
+        self.assertEqual(sorted(started), list(range(8)))
+      finally:
+        resident_memory = residentMemory
+    self.assertGreater(resident_memory(), 0)
+
+    randomState = random.getstate()
+    try:
+      for useSharedMarket in (False, True):
+        files = [self.readResults(*market_experiment("bounded_test", useSharedMarket, 'RANDOM', 'SELL_LOSERS', 8, seed = 6, workers = workers, useCache = False, shardSize = 3, maxMemory = maxMemory))
+                 for workers, maxMemory in ((1, None), (2, None), (2, 1 << 50))]
+        self.assertEqual(files[0], files[1])
+        self.assertEqual(files[0], files[2])
+        self.assertEqual(len(files[0][0].splitlines()), 9)
+        # a run that is over maxMemory stops, on workers or in this process
+        for workers, rng in ((2, None), (1, None), (1, np.random.default_rng(6))):
+          with self.assertRaises(MemoryError):
+            market_experiment("bounded_test", useSharedMarket, 'RANDOM', 'SELL_LOSERS', 8, rng = rng, seed = 6, workers = workers, useCache = False, shardSize = 3, maxMemory = 1)
+          self.readResults(result_path_prefix("bounded_test") + "_investors.csv", result_path_prefix("bounded_test") + "_stocks.csv")
+    finally:
+      random.setstate(randomState)
+
+  # in this process the batch engine runs blocks of shardSize investors, on one market when it is shared
+  def test_experiment_blocks(self):
+    snapshotFileName = 'testSnapshot_blocks.ndjson'
+    randomState = random.getstate()
+    numInvestorColumns = len(Investor.headerCSV().split(CSV_DELIMITER))
+    try:
+      for useSharedMarket in (False, True):
+        investorsCSV, stocksCSV = self.readResults(*market_experiment("blocks_test", useSharedMarket, 'RANDOM', 'SELL_LOSERS', 8, engine = ENGINE_BATCH, rng = np.random.default_rng(7),
+                                                                      snapshotFileName = snapshotFileName, shardSize = 3))
+        self.assertEqual([row.split(CSV_DELIMITER)[0] for row in investorsCSV.splitlines()[1:]], ['investor' + str(i) for i in range(8)])
+        with MarketSnapshotReader(snapshotFileName) as snapshot:
+          self.assertEqual(len(list(snapshot)), (1 if useSharedMarket else 8) * 7)
+        if (useSharedMarket):
+          stocks = {}
+          for stockRow in csv.reader(stocksCSV.splitlines()[1:], delimiter = CSV_DELIMITER):
+            if (stockRow):
+              self.assertEqual(stocks.setdefault(stockRow[numInvestorColumns], stockRow[numInvestorColumns + 1:numInvestorColumns + 5]), stockRow[numInvestorColumns + 1:numInvestorColumns + 5])
+        # the snapshot replays in blocks of any size
+        replayed = self.readResults(*market_experiment("blocks_test", useSharedMarket, 'RANDOM', 'SELL_LOSERS', 8, engine = ENGINE_BATCH, rng = np.random.default_rng(7),
+                                                       replayFileName = snapshotFileName, shardSize = 5))
+        self.assertEqual(len(replayed[0].splitlines()), 9)
+      # the object engine draws the same however large the blocks are
+      objectFiles = []
+      for shardSize in (3, 8):
+        random.seed(7)
+        objectFiles.append(self.readResults(*market_experiment("blocks_test", False, 'RANDOM', 'SELL_LOSERS', 8, rng = np.random.default_rng(7), shardSize = shardSize)))
+      self.assertEqual(objectFiles[0], objectFiles[1])
+    finally:
+      if (os.path.exists(snapshotFileName)):
+        os.remove(snapshotFileName)
+      random.setstate(randomState)
+
+  # the run options are a RunOptions or its fields as keywords, which replace those of the RunOptions
+  def test_run_options(self):
+    randomState = random.getstate()
+    try:
+      options = RunOptions(seed = 8, workers = 1, useCache = False, shardSize = 3)
+      self.assertEqual(self.readResults(*market_experiment("options_test", False, 'RANDOM', 'SELL_LOSERS', 5, options = options)),
+                       self.readResults(*market_experiment("options_test", False, 'RANDOM', 'SELL_LOSERS', 5, seed = 8, workers = 1, useCache = False, shardSize = 3)))
+      self.assertEqual(self.readResults(*market_experiment("options_test", False, 'RANDOM', 'SELL_LOSERS', 5, options = options, seed = 9)),
+                       self.readResults(*market_experiment("options_test", False, 'RANDOM', 'SELL_LOSERS', 5, seed = 9, workers = 1, useCache = False, shardSize = 3)))
+      self.assertIsNone(market_experiment("options_test", False, 'RANDOM', 'SELL_LOSERS', 5, options = options, numWorkers = 2))
+    finally:
+      random.setstate(randomState)
+
+class TestResultWriter(ResultFilesTestCase):
+
+  def test_result_writer(self):
+    # the csv writer writes the rows of descriptionCSV and descriptionCSVAllStocks, with an empty line after each investor
+    randomState = random.getstate()
+    random.seed(7)
+    marketInvestors = simulate_investors(True, 'RANDOM', 'SELL_LOSERS', 4, 7, 5, 4, rng = np.random.default_rng(7))
+    for background in [False, True]:
+      investorsCSV, stocksCSV = self.readResults(*write_experiment_results("result_writer_test", Investor.headerCSV(), Investor.headerCSVAllStocks(),
+                                                                           ((investor.csvRow(), investor.csvRowsAllStocks()) for investor in marketInvestors), background))
+      self.assertEqual(investorsCSV, "".join(line + "\n" for line in [Investor.headerCSV()] + [investor.descriptionCSV() for investor in marketInvestors]))
+      self.assertEqual(stocksCSV, Investor.headerCSVAllStocks() + "\n" + "".join(investor.descriptionCSVAllStocks() + "\n" for investor in marketInvestors))
+    # each investor is handed over when it has finished all periods
+    marketInvestors = iter_investors(True, 'BUY_GAINERS', 'SELL_GAINERS', 3, 7, 5, 4, rng = np.random.default_rng(7))
+    firstInvestor = next(marketInvestors)
+    self.assertEqual(firstInvestor.market.currentPeriod, 7)
+    self.assertEqual((len(firstInvestor.portfolio), len(firstInvestor.soldStocks)), (5, 6))
+    random.setstate(randomState)
+
+  def test_background_result_writer_errors(self):
+    results = [(["investor" + str(i), str(i)], [["investor" + str(i), str(i), "A"]]) for i in range(25)]
+    def failingRun():
+      yield from results
+      raise RuntimeError("simulation failed")
+    # small batches and a one-batch queue make the run wait for the writer thread
+    resultWriter = BackgroundResultWriter("result_writer_test", "investorName;value", "investorName;value;stockName", queueSize = 1)
+    resultWriter.BATCH_SIZE = 2
+    with self.assertRaises(RuntimeError):
+      with resultWriter:
+        resultWriter.writeInvestors(failingRun())
+    # a run that raises still leaves both files closed, with every investor handed over before the error
+    self.assertTrue(resultWriter.investorFile.closed and resultWriter.stockFile.closed)
+    investorsCSV, stocksCSV = self.readResults(resultWriter.pathInvestors, resultWriter.pathStocks)
+    self.assertEqual(investorsCSV.splitlines()[1:], [CSV_DELIMITER.join(investorRow) for investorRow, stockRows in results])
+    self.assertEqual(stocksCSV.count("\n\n"), 25)
+    # an error on the writer thread is raised in the caller's thread
+    with self.assertRaises(csv.Error):
+      with BackgroundResultWriter("result_writer_test", "investorName", "investorName") as resultWriter:
+        resultWriter.writeInvestor(None, [])
+    self.assertTrue(resultWriter.investorFile.closed and resultWriter.stockFile.closed)
+    self.readResults(resultWriter.pathInvestors, resultWriter.pathStocks)
+
+class TestCompareStrategies(ResultFilesTestCase):
+
+  def test_compare_strategies(self):
+    global INVESTORS_PER_SHARD
+    investorsPerShard = INVESTORS_PER_SHARD
+    INVESTORS_PER_SHARD = 3
+    randomState = random.getstate()
+    numInvestorColumns = len(Investor.headerCSV().split(CSV_DELIMITER))
+    try:
+      for engine in ENGINES:
+        for useSharedMarket in (False, True):
+          pairFiles = {}
+          # on workers, and under a memory limit, the files are those of one process
+          for workers, maxMemory in ((1, None), (2, None), (2, 1 << 50)):
+            paths = compare_strategies("compare_test", useSharedMarket, numInvestors = 8, engine = engine, seed = 3, workers = workers, maxMemory = maxMemory)
+            self.assertEqual(list(paths), STRATEGY_PAIRS)
+            pairFiles[workers, maxMemory] = {strategyPair: self.readResults(*pairPaths) for strategyPair, pairPaths in paths.items()}
+          self.assertEqual(pairFiles[1, None], pairFiles[2, None])
+          self.assertEqual(pairFiles[1, None], pairFiles[2, 1 << 50])
+
+          # every pair trades on the same stocks: a stock of a market has the same quality and history in all files
+          stocks = {}
+          for strategyPair, (investorsCSV, stocksCSV) in pairFiles[1, None].items():
+            for stockRow in csv.reader(stocksCSV.splitlines()[1:], delimiter = CSV_DELIMITER):
+              if (stockRow):
+                marketName = 'market_global' if useSharedMarket else stockRow[1]
+                stockKey = (marketName, stockRow[numInvestorColumns], stockRow[numInvestorColumns + 4])
+                self.assertEqual(stocks.setdefault(stockKey, stockRow[numInvestorColumns + 1:numInvestorColumns + 4]), stockRow[numInvestorColumns + 1:numInvestorColumns + 4])
+          # and buying gainers picks the same initial portfolios whatever the sell strategy
+          numGoodStocksInitial = {strategyPair: [row.split(CSV_DELIMITER)[4] for row in investorsCSV.splitlines()[1:]] for strategyPair, (investorsCSV, stocksCSV) in pairFiles[1, None].items()}
+          self.assertEqual(numGoodStocksInitial[('BUY_GAINERS', 'SELL_GAINERS')], numGoodStocksInitial[('BUY_GAINERS', 'SELL_LOSERS')])
+      self.assertIsNone(compare_strategies("compare_test", strategyPairs = [('RANDOM', 'SELL_LOSERS'), ('RANDOM', 'SELL_LOSERS')]))
+    finally:
+      INVESTORS_PER_SHARD = investorsPerShard
+      random.setstate(randomState)
+
+class TestReplications(unittest.TestCase):
+
+  def test_replications(self):
+    values = np.random.default_rng(2).normal(size = (50, 3))
+    statistics = OnlineStatistics(['a', 'b', 'c'])
+    for row in values:
+      statistics.add(row)
+    self.assertTrue(np.allclose(statistics.mean, values.mean(axis = 0)))
+    self.assertTrue(np.allclose(statistics.variance(), values.var(axis = 0, ddof = 1)))
+    self.assertTrue(np.allclose(statistics.halfWidth(0.95), 2.009575237129 * values.std(axis = 0, ddof = 1) / np.sqrt(50)))
+    # Student's t quantiles from tables: few degrees of freedom widen the interval, many approach the normal one
+    self.assertAlmostEqual(studentTQuantile(0.975, 1), 12.706204736175, places = 8)
+    self.assertAlmostEqual(studentTQuantile(0.975, 4), 2.776445105198, places = 8)
+    self.assertAlmostEqual(studentTQuantile(0.995, 9), 3.249835541592, places = 8)
+    self.assertAlmostEqual(studentTQuantile(0.975, 100000), 1.959986, places = 5)
+
+    randomState = random.getstate()
+    settings = dict(useSharedMarket = False, buyStrategy = 'RANDOM', sellStrategy = 'SELL_LOSERS', numInvestors = 5, numPeriods = 7, portfolioSize = 5, newStocksPerPeriod = 4)
+    for engine in ENGINES:
+      # the summaries are those of the replications run one by one
+      report = replicate_experiment(engine = engine, seed = 8, maxReplications = 12, **settings)
+      self.assertEqual((report.numReplications, report.converged), (12, False))
+      replications = np.array([replication_metrics(settings, childSeed, engine) for childSeed in child_seed_sequences(np.random.SeedSequence(8), 12)])
+      self.assertTrue(np.allclose([summary.mean for summary in report.summaries.values()], replications.mean(axis = 0)))
+      summary = report.summaries['totalEarnings']
+      self.assertAlmostEqual(summary.high - summary.low, 2 * summary.halfWidth)
+
+      # stopping at the target precision, at the same replication whatever the number of workers
+      stopped = [replicate_experiment(engine = engine, seed = 8, targetMetrics = ['numGoodStocksPicked'], relativeHalfWidth = 0.1, minReplications = 3, workers = workers, **settings)
+                 for workers in (1, 2)]
+      self.assertTrue(stopped[0].converged)
+      self.assertLess(stopped[0].numReplications, 1000)
+      self.assertEqual(stopped[0], stopped[1])
+      summary = stopped[0].summaries['numGoodStocksPicked']
+      self.assertLessEqual(summary.halfWidth, 0.1 * abs(summary.mean))
+    with self.assertRaises(ValueError):
+      replicate_experiment(metrics = ['totalEarnings'], targetMetrics = ['totalUpticks'])
+    random.setstate(randomState)
+
+class TestDispositionEffect(ResultFilesTestCase):
+
+  def test_experiment_disposition_effect(self):
+    randomState = random.getstate()
+    for engine in ENGINES:
+      counts = []
+      for outputFormat in OUTPUT_FORMATS:
+        random.seed(13)
+        dispositionEffect = DispositionEffect()
+        results = market_experiment("disposition_test", False, 'RANDOM', 'SELL_GAINERS', 40, engine = engine, rng = np.random.default_rng(13), outputFormat = outputFormat, dispositionEffect = dispositionEffect)
+        self.assertEqual(dispositionEffect.numInvestors, 40)
+        # the counts taken while writing are those of the written investors
+        writtenCounts = DispositionEffect()
+        writtenCounts.countResultFiles(results)
+        self.assertEqual(writtenCounts.counts, dispositionEffect.counts)
+        counts.append(dispositionEffect.counts)
+        if (outputFormat == OUTPUT_COLUMNS):
+          shutil.rmtree(results)
+        else:
+          self.readResults(*results)
+      self.assertEqual(counts[0], counts[1])
+      self.assertAlmostEqual(dispositionEffect.pgr(), counts[0]['realizedGains'] / (counts[0]['realizedGains'] + counts[0]['paperGains']))
+      self.assertAlmostEqual(dispositionEffect.difference(), dispositionEffect.pgr() - dispositionEffect.plr())
+      # selling gainers realizes gains more readily than losses
+      self.assertGreater(dispositionEffect.difference(), 0)
+    random.setstate(randomState)
+
+class TestResultCache(ResultFilesTestCase):
+
+  def test_result_cache(self):
+    global RESULT_CACHE, INITIAL_PRICE
+    resultCache = RESULT_CACHE
+    temporaryDirectory = tempfile.TemporaryDirectory()
+    RESULT_CACHE = ResultCache(os.path.join(temporaryDirectory.name, 'results'))
+    randomState = random.getstate()
+    try:
+      for useSharedMarket in (False, True):
+        RESULT_CACHE.hits = RESULT_CACHE.misses = 0
+        simulated = self.readResults(*market_experiment("result_cache_test", useSharedMarket, 'RANDOM', 'SELL_LOSERS', 6, seed = 21))
+        cached = self.readResults(*market_experiment("result_cache_test", useSharedMarket, 'RANDOM', 'SELL_LOSERS', 6, seed = 21))
+        self.assertEqual(cached, simulated)
+        self.assertEqual((RESULT_CACHE.hits, RESULT_CACHE.misses), (1, 1))
+        # bypassing the cache simulates the same results again; other settings or seeds are other runs
+        self.assertEqual(self.readResults(*market_experiment("result_cache_test", useSharedMarket, 'RANDOM', 'SELL_LOSERS', 6, seed = 21, useCache = False)), simulated)
+        self.assertNotEqual(self.readResults(*market_experiment("result_cache_test", useSharedMarket, 'RANDOM', 'SELL_LOSERS', 6, seed = 22)), simulated)
+        self.assertEqual((RESULT_CACHE.hits, RESULT_CACHE.misses), (1, 2))
+      # runs drawn from a given generator are never cached
+      self.readResults(*market_experiment("result_cache_test", False, 'RANDOM', 'SELL_LOSERS', 6, rng = np.random.default_rng(21)))
+      self.assertEqual(RESULT_CACHE.stats()['entries'], 4)
+
+      # a cached columnar store is copied with the new experiment id
+      storePath = market_experiment("result_cache_test", False, 'RANDOM', 'SELL_LOSERS', 6, seed = 21, outputFormat = OUTPUT_COLUMNS)
+      shutil.rmtree(storePath)
+      storePath = market_experiment("result_cache_copy_test", False, 'RANDOM', 'SELL_LOSERS', 6, seed = 21, outputFormat = OUTPUT_COLUMNS)
+      manifest, tables = read_result_columns(storePath)
+      self.assertEqual(manifest['experimentId'], "result_cache_copy_test")
+      self.assertEqual(tables['investors']['investorName'].tolist(), list(range(6)))
+      del tables
+      shutil.rmtree(storePath)
+
+      # a run larger than the whole cache is not stored
+      RESULT_CACHE.maxBytes = 1
+      self.readResults(*market_experiment("result_cache_test", False, 'RANDOM', 'SELL_GAINERS', 6, seed = 21))
+      stats = RESULT_CACHE.stats()
+      self.assertEqual((stats['entries'], stats['evictions']), (5, 0))
+
+      # over the size cap the least recently used entries are evicted, the newest is kept (an entry takes about 10 KB)
+      RESULT_CACHE.maxBytes = 16 << 10
+      self.readResults(*market_experiment("result_cache_test", True, 'RANDOM', 'SELL_LOSERS', 6, seed = 21))
+      self.readResults(*market_experiment("result_cache_test", False, 'RANDOM', 'SELL_GAINERS', 6, seed = 21))
+      stats = RESULT_CACHE.stats()
+      self.assertEqual((stats['entries'], stats['evictions']), (1, 5))
+      sellGainers = self.readResults(*market_experiment("result_cache_test", False, 'RANDOM', 'SELL_GAINERS', 6, seed = 21))
+      self.assertEqual(RESULT_CACHE.stats()['hits'], 4)
+
+      # an entry that lost one of its files is a miss: the run is simulated again and stored anew
+      (entryPath,) = [entry.path for entry in os.scandir(RESULT_CACHE.directory) if entry.is_dir()]
+      os.remove(os.path.join(entryPath, 'stocks.csv'))
+      RESULT_CACHE.hits = RESULT_CACHE.misses = 0
+      self.assertEqual(self.readResults(*market_experiment("result_cache_test", False, 'RANDOM', 'SELL_GAINERS', 6, seed = 21)), sellGainers)
+      self.assertEqual((RESULT_CACHE.hits, RESULT_CACHE.misses), (0, 1))
+      self.assertTrue(os.path.exists(os.path.join(entryPath, 'stocks.csv')))
+
+      # the same SeedSequence object passed twice is the same run
+      seedSequence = np.random.SeedSequence(21)
+      self.assertEqual(self.readResults(*market_experiment("result_cache_test", False, 'RANDOM', 'SELL_GAINERS', 6, seed = seedSequence)), sellGainers)
+      self.assertEqual(self.readResults(*market_experiment("result_cache_test", False, 'RANDOM', 'SELL_GAINERS', 6, seed = seedSequence)), sellGainers)
+      self.assertEqual((RESULT_CACHE.hits, RESULT_CACHE.misses), (2, 1))
+
+      # so is the same run after a new version of one of its strategies
+      sellGainersStrategy = SELL_STRATEGIES['SELL_GAINERS']
+      SELL_STRATEGIES['SELL_GAINERS'] = sellGainersStrategy._replace(version = sellGainersStrategy.version + 1)
+      try:
+        self.readResults(*market_experiment("result_cache_test", False, 'RANDOM', 'SELL_GAINERS', 6, seed = 21))
+      finally:
+        SELL_STRATEGIES['SELL_GAINERS'] = sellGainersStrategy
+      self.assertEqual((RESULT_CACHE.hits, RESULT_CACHE.misses), (2, 2))
+
+      # and after a change of the model parameters
+      initialPrice = INITIAL_PRICE
+      INITIAL_PRICE = initialPrice + 1
+      try:
+        self.assertNotEqual(self.readResults(*market_experiment("result_cache_test", False, 'RANDOM', 'SELL_GAINERS', 6, seed = 21)), sellGainers)
+      finally:
+        INITIAL_PRICE = initialPrice
+      self.assertEqual((RESULT_CACHE.hits, RESULT_CACHE.misses), (2, 3))
+
+      # a cache that cannot be written still returns the results
+      RESULT_CACHE.clear()
+      with open(RESULT_CACHE.directory, 'w'):
+        pass
+      with open(os.devnull, 'w') as devnull, contextlib.redirect_stderr(devnull):
+        self.assertEqual(self.readResults(*market_experiment("result_cache_test", False, 'RANDOM', 'SELL_GAINERS', 6, seed = 21)), sellGainers)
+    finally:
+      temporaryDirectory.cleanup()
+      RESULT_CACHE = resultCache
+      random.setstate(randomState)
+      if (not self.resultsDirExisted and os.path.isdir(self.resultsDir) and not os.listdir(self.resultsDir)):
+        os.rmdir(self.resultsDir)
+
+
+# %% [markdown]
+# Unit tests for the columnar results
+
+# %%
+
+class TestColumnarResults(unittest.TestCase):
+
+  def test_columns_match_csv(self):
+    resultsDir = os.path.join(os.path.abspath(''), "results")
+    resultsDirExisted = os.path.isdir(resultsDir)
+    try:
+      for engine in ENGINES:
+        random.seed(9)
+        pathInvestors, pathStocks = market_experiment("columns_test", False, 'RANDOM', 'SELL_GAINERS', 12, engine = engine, rng = np.random.default_rng(9))
+        random.seed(9)
+        storePath = market_experiment("columns_test", False, 'RANDOM', 'SELL_GAINERS', 12, engine = engine, rng = np.random.default_rng(9), outputFormat = OUTPUT_COLUMNS)
+        with open(pathInvestors) as investorFile, open(pathStocks) as stockFile:
+          investorRows = [row for row in csv.reader(investorFile, delimiter = CSV_DELIMITER)][1:]
+          stockRows = [row for row in csv.reader(stockFile, delimiter = CSV_DELIMITER) if row][1:]
+        manifest, tables = read_result_columns(storePath)
+        self.assertEqual(manifest['settings']['engine'], engine)
+        self.assertEqual(manifest['tables']['investors']['numRows'], 12)
+        self.assertEqual(manifest['tables']['stocks']['numRows'], len(stockRows))
+        self.assertIsInstance(tables['stocks']['stockPriceChangeHistory'], np.memmap)
+        self.assertEqual(tables['stocks']['stockPriceChangeHistory'].shape, (len(stockRows), PRICE_CHANGE_HISTORY_LENGTH))
+
+        # decoding the columns gives back the CSV fields
+        def decode(tableName, columnNames):
+          columnSpecs = {column['name']: column for column in manifest['tables'][tableName]['columns']}
+          decodedColumns = []
+          for columnName in columnNames:
+            column = columnSpecs[columnName]
+            values = tables[tableName][columnName].tolist()
+            if ('codes' in column):
+              values = [column['codes'][value] for value in values]
+            elif (column.get('stockIds')):
+              values = [stockName(value) for value in values]
+            elif ('separator' in column):
+              values = [column['separator'].join(map(str, value)) for value in values]
+            else:
+              names = {number: name for name, number in column.get('numbers', {}).items()}
+              values = [column.get('prefix', '') + names.get(value, str(value)) for value in values]
+            decodedColumns.append(values)
+          return [list(row) for row in zip(*decodedColumns)]
+        self.assertEqual(decode('investors', Investor.headerCSV().split(CSV_DELIMITER)), investorRows)
+        investorColumns = len(investorRows[0])
+        self.assertEqual(decode('stocks', Stock.headerCSV().split(CSV_DELIMITER)), [row[investorColumns:] for row in stockRows])
+        self.assertEqual(tables['stocks']['investorRow'].tolist(), [int(row[0][len("investor"):]) for row in stockRows])
+
+        # grouping needs no parsing
+        self.assertEqual(int((tables['stocks']['stockQuality'] == QUALITY_GOOD).sum()), sum(row[investorColumns + 1] == 'good' for row in stockRows))
+
+        # the same rows written in chunks of 5 investors give the same store
+        with open(pathInvestors) as investorFile, open(pathStocks) as stockFile:
+          stockRowsByInvestor = [[row for row in stockBlock.split("\n") if row] for stockBlock in stockFile.read().split("\n\n")][:-1]
+          stockRowsByInvestor[0] = stockRowsByInvestor[0][1:]
+          results = [(investorRow, [row.split(CSV_DELIMITER) for row in stockBlock]) for investorRow, stockBlock in zip(investorRows, stockRowsByInvestor)]
+        chunkedStorePath = write_result_columns("columns_test_chunks", rows_to_result_columns(results, 5))
+        chunkedManifest, chunkedTables = read_result_columns(chunkedStorePath)
+        self.assertEqual(chunkedManifest['tables'], manifest['tables'])
+        for tableName, columns in tables.items():
+          for columnName, values in columns.items():
+            self.assertTrue(np.array_equal(chunkedTables[tableName][columnName], values), columnName)
+        del tables, chunkedTables
+        shutil.rmtree(chunkedStorePath)
+        os.remove(pathInvestors)
+        os.remove(pathStocks)
+        shutil.rmtree(storePath)
+    finally:
+      if (not resultsDirExisted and os.path.isdir(resultsDir) and not os.listdir(resultsDir)):
+        os.rmdir(resultsDir)
+
+  # long runs with large portfolios have metrics and price changes beyond int16, and the columns hold them as the CSV does
+  def test_columns_hold_long_runs(self):
+    settings = dict(useSharedMarket = False, buyStrategy = 'BUY_GAINERS', sellStrategy = 'SELL_LOSERS', numInvestors = 2, numPeriods = 400, portfolioSize = 300, newStocksPerPeriod = 4)
+    metricNames = Investor.headerCSV().split(CSV_DELIMITER)[4:]
+    for engine in ENGINES:
+      randomState = random.getstate()
+      random.seed(11)
+      investorRows = [investorRow for investorRow, stockRows in experiment_results(engine = engine, rng = np.random.default_rng(11), **settings)]
+      random.seed(11)
+      chunks = list(experiment_results(OUTPUT_COLUMNS, engine = engine, rng = np.random.default_rng(11), **settings))
+      random.setstate(randomState)
+      self.assertGreater(max(int(investorRow[4 + metricNames.index('totalEarnings')]) for investorRow in investorRows), np.iinfo(np.int16).max)
+      for metricIndex, metricName in enumerate(metricNames):
+        self.assertEqual(np.concatenate([chunk['investors'][metricName] for chunk in chunks]).tolist(), [int(investorRow[4 + metricIndex]) for investorRow in investorRows], metricName)
+
+
+# %%
+# Run unit tests
+
+if __name__ == '__main__' and SWEEP_ARGUMENTS is None:
+   unittest.main(argv=['first-arg-is-ignored'], exit=False)
+
+
+# %%
+# Main: Simulation Experiment
 
-  # print all investors into verbose output (uncomment to see in terminal)
-  # for currentInvestor in marketInvestors:   
-  #  currentInvestor.description()
-  
-    # create file names and correct path
-  currentTimeString = datetime.datetime.now().strftime("%y%m%d_%H%M")
-  scriptDir = os.path.join(os.path.abspath(''), "results")
-  os.makedirs(scriptDir, exist_ok=True) 
-  
-  # write to file (create if not found, overwrite otherwise)
-  # write investor summary file
-  fileNameInvestors = currentTimeString + "_" + experimentId + "_investors.csv"
-  completePathInvestors = os.path.join(scriptDir, fileNameInvestors)
-  resultFile = open(completePathInvestors,"w") 
-  resultFile.write(Investor.headerCSV() + "\n")
-  for currentInvestor in marketInvestors: 
-    resultFile.write(currentInvestor.descriptionCSV() + "\n")
-  resultFile.close() 
-
-  # write file with complete stock output
-  fileNameStocks = currentTimeString + "_" + experimentId + "_stocks.csv"
-  completePathStocks = os.path.join(scriptDir, fileNameStocks)
-  resultFile = open(completePathStocks,"w") 
-  resultFile.write(Investor.headerCSVAllStocks() + "\n")
-  for currentInvestor in marketInvestors: 
-    resultFile.write(currentInvestor.descriptionCSVAllStocks() + "\n")
-  resultFile.close()
-  
 # run the simulation
 ''' 
 signature: 
@@ -786,15 +4367,73 @@ signature:
   numInvestors = 20, 
   numPeriods = 7, 
   portfolioSize = 5, 
-  newStocksPerPeriod = 4)
+  newStocksPerPeriod = 4,
+  options = None,     # a RunOptions; its fields can also be passed as keywords:
+    engine = 'object',
+    rng = None,
+    seed = None,        # seed of the shards (and of a shared market)
+    workers = None,     # number of processes, defaults to every core
+    outputFormat = 'csv',
+    snapshotFileName = None,
+    replayFileName = None,
+    useCache = True,    # seeded runs: take the results from RESULT_CACHE if the run was done before
+    dispositionEffect = None,   # a DispositionEffect() adding up the run's PGR / PLR counts
+    shardSize = None,   # investors simulated and written as one block, defaults to INVESTORS_PER_SHARD
+    maxMemory = None)   # resident memory of the run in bytes: no shard is started above it, MemoryError if it stays above
+
+  compare_strategies(
+  experimentId = 'no_experiment_id_set',
+  useSharedMarket = True,
+  strategyPairs = None,   # (buyStrategy, sellStrategy) pairs traded on the same markets, defaults to all four
+  numInvestors = 20,
+  numPeriods = 7,
+  portfolioSize = 5,
+  newStocksPerPeriod = 4,
+  engine = 'object',
+  seed = None,
+  workers = None,
+  outputFormat = 'csv',
+  maxMemory = None)   # as in market_experiment
+
+  replicate_experiment(
+  useSharedMarket = True,
+  buyStrategy = 'BUY_GAINERS',
+  sellStrategy = 'SELL_GAINERS',
+  numInvestors = 20,
+  numPeriods = 7,
+  portfolioSize = 5,
+  newStocksPerPeriod = 4,
+  engine = 'object',
+  seed = None,
+  metrics = None,           # metrics of Investor.headerCSV to estimate, defaults to all
+  targetMetrics = None,     # metrics whose precision decides when to stop, defaults to metrics
+  halfWidth = None,         # stop once every confidence interval is at most mean +- halfWidth
+  relativeHalfWidth = None, # or at most mean +- relativeHalfWidth * |mean|
+  confidence = 0.95,
+  minReplications = 10,
+  maxReplications = 1000,
+  workers = 1)
+
+  market_sweep(
+  sweepId = 'no_sweep_id_set',
+  grid = None,        # parameter name -> list of values, e.g. {'buyStrategy': ['BUY_GAINERS', 'RANDOM']}
+  replications = 1,
+  seed = None,
+  engine = 'object',
+  workers = None)     # number of processes, defaults to every core
 '''
 
-#market_experiment("shared_market_test",True)
-#market_experiment("individual_markets_test",False)
-market_experiment("individual_markets-gainers_test",False,'BUY_GAINERS','SELL_GAINERS', 60)
-market_experiment("individual_markets-losers_test",False,'BUY_GAINERS','SELL_LOSERS', 60)
-market_experiment("individual_markets-rand-gainers_test",False,'RANDOM','SELL_GAINERS', 60)
-market_experiment("individual_markets-rand-losers_test",False,'RANDOM','SELL_LOSERS', 60)
+# guarded so worker processes of a sweep do not rerun the experiments when they import this module
+if __name__ == '__main__':
+  if (SWEEP_ARGUMENTS is not None):
+    print(sweep_from_arguments(SWEEP_ARGUMENTS))
+  else:
+    #market_experiment("shared_market_test",True)
+    #market_experiment("individual_markets_test",False)
+    market_experiment("individual_markets-gainers_test",False,'BUY_GAINERS','SELL_GAINERS', 60)
+    market_experiment("individual_markets-losers_test",False,'BUY_GAINERS','SELL_LOSERS', 60)
+    market_experiment("individual_markets-rand-gainers_test",False,'RANDOM','SELL_GAINERS', 60)
+    market_experiment("individual_markets-rand-losers_test",False,'RANDOM','SELL_LOSERS', 60)
 
 
 # %%